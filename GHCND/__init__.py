@@ -1 +1 @@
-__all__ = ["preprocessor","stats","plotter","conversion"]
\ No newline at end of file
+__all__ = ["preprocessor","stats","plotter","conversion","dlyreader","filters","cache","catalog","cube","store","columnar","gapfill","neighbors","gridding"]
\ No newline at end of file
@@ -0,0 +1,298 @@
+import os
+import json
+import numpy as np
+from GHCND import dlyreader
+from GHCND import filters
+
+"""
+A persistent on-disk cache of parsed .dly files.
+
+Parsing the raw text is the slowest part of reading the GHCND data, yet
+most .dly files don't change between downloads. The cache stores the parsed
+arrays of each station in one .npz file in the cache directory. An entry
+is only used if the size and modification time of the source .dly file and
+the fingerprint of the filter rules it was parsed with (see the filters module)
+still match, so a stale entry is never
+returned. Once the cache grows past its maximum size, the least recently used
+entries are removed.
+
+Usually the cache is used through the StationPreprocessor:
+    sp.setCache("D:/GHCND_data/cache")
+    sp.processDlyFiles(["TMAX","TMIN","PRCP"]) # parses the text and fills the cache
+    sp.processDlyFiles(["TMAX","TMIN","PRCP"]) # reads the cache
+"""
+
+
+class DlyCache(object):
+
+    def __init__(self,initCacheDirectory,initMaxSize=2*1024**3,initFilterSpec=None):
+        """
+        Parameters:
+        -----------
+        initCacheDirectory: string
+            path to the directory that holds the cached files. It is created if it doesn't exist
+        initMaxSize: int
+            the maximum size of the cache in bytes. default is 2 GB
+        initFilterSpec: filters.FilterSpec
+            the filter rules of the data that is put in and taken out of the cache. Entries
+            parsed with other rules are stale. default is None (filters.DEFAULT_FILTER)
+        """
+        self.cacheDir = initCacheDirectory
+        self.maxSize = initMaxSize
+        self.filterSpec = initFilterSpec if initFilterSpec is not None else filters.DEFAULT_FILTER
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def entryPath(self,stationId):
+        return os.path.join(self.cacheDir, stationId + ".npz")
+
+    def get(self,filename,variablesOfInterest):
+        """
+        returns the cached contents of a .dly file in the same form as
+        StationPreprocessor parses them (a dictionary of (data, days) tuples),
+        or None if the file is not cached, the cached entry is stale, or it
+        doesn't cover all the variablesOfInterest.
+        """
+        entry = self.__load(filename)
+        if entry == None:
+            return None
+        meta, arrays = entry
+        if not set(variablesOfInterest).issubset(meta["variables"]):
+            return None
+        os.utime(self.entryPath(_stationIdOf(filename)), None) # mark the entry as recently used
+        parsed = {}
+        for varName in meta["present"]:
+            if varName in variablesOfInterest:
+                parsed[varName] = (arrays[varName + "_data"], arrays[varName + "_days"])
+        return parsed
+
+    def put(self,filename,variablesOfInterest,parsed,resume=None):
+        """
+        stores the parsed contents of a .dly file. Variables that were already
+        cached for the same version of the file are kept.
+
+        Parameters:
+        -----------
+        filename: string
+            the .dly file that was parsed
+        variablesOfInterest: list
+            the variables the file was parsed for. Variables in this list that are
+            not in parsed are recorded as not being in the file.
+        parsed: dict
+            variable names mapped to (data, days) tuples of float32 and int32 arrays
+        resume: tuple
+            (offset, guard, checksum) where to resume reading the file when it changes.
+            see dlyreader.resumePoint. default is None (the entry can't be updated incrementally)
+        """
+        variables = set(variablesOfInterest)
+        present = list(parsed) # in the order the variables appear in the file
+        arrays = {}
+        entry = self.__load(filename)
+        if entry != None: # merge with the variables that are already cached
+            meta, oldArrays = entry
+            for varName in meta["present"]:
+                if varName not in variables:
+                    arrays[varName + "_data"] = oldArrays[varName + "_data"]
+                    arrays[varName + "_days"] = oldArrays[varName + "_days"]
+                    present.append(varName)
+            variables.update(meta["variables"])
+        for varName in parsed:
+            arrays[varName + "_data"] = parsed[varName][0]
+            arrays[varName + "_days"] = parsed[varName][1]
+        meta = _sourceKey(filename, self.filterSpec)
+        meta["variables"] = sorted(variables)
+        meta["present"] = present
+        self.__setResumePoint(meta, resume)
+        self.__write(filename, meta, arrays)
+
+    def refresh(self,filename,baseVersion,verify=True):
+        """
+        brings the entry of a .dly file that changed since it was cached up to date
+        by parsing only the lines past the stored byte offset (the lines of the latest
+        cached month and everything appended after them). The new values replace the
+        cached values from their first day onwards.
+
+        Parameters:
+        -----------
+        filename: string
+            the .dly file
+        baseVersion: dict
+            the version of the file the caller's data came from (see version). The
+            entry is only updated incrementally if it is still at this version, so
+            the returned values are exactly what the caller is missing.
+        verify: boolean
+            if True (the default), the part of the file before the offset is read and
+            compared with a stored checksum, so changes anywhere in the file are caught.
+            This reads the whole file but only parses the new lines. If False, only the
+            line just before the offset is compared and the rest of the file is trusted
+            to be unchanged.
+
+        Returns:
+        ---------
+        a dictionary of (data, days) tuples holding only the re-read values. It is
+        empty if the file hasn't changed since baseVersion. Returns None if the entry
+        can't be updated incrementally, for example if there is no entry, it has no
+        offset, it is not at baseVersion, or the part of the file before the offset
+        was changed. The caller must then read the file in full (from the cache if
+        it is up to date).
+        """
+        entry = self.__load(filename, False)
+        if entry == None:
+            return None
+        meta, arrays = entry
+        key = _sourceKey(filename, self.filterSpec)
+        if baseVersion == None or meta.get("filter") != key["filter"]:
+            return None
+        if baseVersion["size"] == key["size"] and baseVersion["mtime"] == key["mtime"]:
+            return {}
+        if meta.get("size") != baseVersion["size"] or meta.get("mtime") != baseVersion["mtime"] or meta.get("offset") == None:
+            return None
+        offset = meta["offset"]
+        guard = meta["guard"].encode("latin-1")
+        if key["size"] < offset:
+            return None
+        infile = open(filename, "rb")
+        if verify:
+            prefix = infile.read(offset)
+        else:
+            infile.seek(offset - len(guard))
+            prefix = infile.read(len(guard))
+        buf = infile.read()
+        infile.close()
+        if not prefix.endswith(guard): # the file was rewritten, not appended to
+            return None
+        if verify and dlyreader.checksum(dlyreader.toCharArray(prefix)) != meta["checksum"]:
+            return None
+        chars = dlyreader.toCharArray(buf)
+        lastMonth = None # the latest month in the cached data
+        for varName in meta["present"]:
+            days = arrays[varName + "_days"]
+            if len(days) > 0:
+                month = days[-1:].astype("datetime64[D]").astype("datetime64[M]").astype(int)[0]
+                lastMonth = month if lastMonth == None else max(lastMonth, month)
+        if len(chars) > 0 and lastMonth != None and dlyreader.monthsOf(chars).min() < lastMonth:
+            return None # the new lines are not in time order after the cached data
+        tail = dlyreader.compact(dlyreader.parseLines(chars, meta["variables"], self.filterSpec))
+
+        for varName in tail:
+            data, days = tail[varName]
+            if varName in meta["present"]:
+                keep = arrays[varName + "_days"] < days[0]
+                data = np.concatenate([arrays[varName + "_data"][keep], data])
+                days = np.concatenate([arrays[varName + "_days"][keep], days])
+            else:
+                meta["present"].append(varName)
+            arrays[varName + "_data"] = data
+            arrays[varName + "_days"] = days
+        tailOffset, tailGuard, tailChecksum = dlyreader.resumePoint(chars, len(buf), meta["checksum"])
+        if tailOffset == None:
+            self.__setResumePoint(meta, None)
+        elif tailOffset > 0: # the latest month moved forward
+            self.__setResumePoint(meta, (offset + tailOffset, tailGuard, tailChecksum))
+        meta.update(key)
+        self.__write(filename, meta, arrays)
+        return tail
+
+    def version(self,filename):
+        """
+        returns the version of a .dly file as the cache sees it (its size,
+        modification time, and the fingerprint of the filter rules)
+        """
+        return _sourceKey(filename, self.filterSpec)
+
+    def __setResumePoint(self,meta,resume):
+        if resume == None or resume[0] == None:
+            meta["offset"] = None
+            meta["guard"] = None
+            meta["checksum"] = None
+        else:
+            meta["offset"] = resume[0]
+            meta["guard"] = resume[1].decode("latin-1") # json can't hold bytes
+            meta["checksum"] = resume[2]
+
+    def __write(self,filename,meta,arrays):
+        arrays = dict(arrays)
+        arrays["meta"] = np.array(json.dumps(meta))
+        path = self.entryPath(_stationIdOf(filename))
+        tmpPath = path + "." + str(os.getpid()) + ".tmp"
+        outfile = open(tmpPath, "wb")
+        np.savez(outfile, **arrays)
+        outfile.close()
+        os.rename(tmpPath, path) # other processes never see a partly written entry
+
+    def invalidate(self,stationIds=None):
+        """
+        removes cached entries.
+
+        Parameters:
+        -----------
+        stationIds: list
+            the station IDs whose entries are removed. default is None (remove every entry)
+        """
+        if stationIds == None:
+            stationIds = [f[:-4] for f in os.listdir(self.cacheDir) if f.endswith(".npz")]
+        for stationId in stationIds:
+            if os.path.isfile(self.entryPath(stationId)):
+                os.remove(self.entryPath(stationId))
+
+    def size(self):
+        """
+        returns the size of the cache in bytes
+        """
+        return sum([os.path.getsize(os.path.join(self.cacheDir, f)) for f in os.listdir(self.cacheDir) if f.endswith(".npz")])
+
+    def evict(self):
+        """
+        removes the least recently used entries until the cache is no
+        larger than its maximum size
+        """
+        entries = []
+        for f in os.listdir(self.cacheDir):
+            if f.endswith(".npz"):
+                info = os.stat(os.path.join(self.cacheDir, f))
+                entries.append((info.st_mtime, info.st_size, f))
+        entries.sort()
+        total = sum([e[1] for e in entries])
+        for mtime, size, f in entries: # oldest first
+            if total <= self.maxSize:
+                break
+            os.remove(os.path.join(self.cacheDir, f))
+            total -= size
+
+    def __load(self,filename,checkSource=True):
+        """
+        returns (metadata, arrays) for the cached entry of filename, or None
+        if there is no entry or (when checkSource is True) it doesn't match the
+        current version of the file
+        """
+        path = self.entryPath(_stationIdOf(filename))
+        if not os.path.isfile(path) or not os.path.isfile(filename):
+            return None
+        try:
+            npz = np.load(path)
+            arrays = dict([(k, npz[k]) for k in npz.files])
+            npz.close()
+        except (IOError, ValueError): # a corrupt entry is treated as missing
+            return None
+        meta = json.loads(str(arrays.pop("meta")))
+        if not checkSource:
+            return meta, arrays
+        key = _sourceKey(filename, self.filterSpec)
+        for k in key:
+            if meta.get(k) != key[k]:
+                return None
+        return meta, arrays
+
+
+def _stationIdOf(filename):
+    return os.path.basename(filename)[:-4] # the file name without .dly
+
+def _sourceKey(filename,filterSpec):
+    """
+    what a cached entry must match to be valid: the size and modification
+    time of the .dly file, and the fingerprint of the filter rules used to parse it
+    """
+    info = os.stat(filename)
+    return {"size": info.st_size,
+            "mtime": repr(info.st_mtime),
+            "filter": filterSpec.fingerprint()}
@@ -0,0 +1,481 @@
+import os
+import json
+import numpy as np
+
+"""
+An indexed catalog of the GHCND station metadata (ghcnd-stations.txt).
+
+The text file is parsed once into columns (one numpy array per field) and
+saved next to the text file (or in the cache directory) as a .npz file.
+Later sessions load the columns without reading the text, as long as the
+text file's size and modification time haven't changed.
+
+The catalog keeps hash indexes (dictionaries of row numbers) by country,
+state, network (HCN, CRN, GSN) and WMO id, so selecting stations is a lookup
+instead of a scan of the file. For spatial queries (bounding boxes and radius
+searches) the stations are bucketed into a grid of 1 by 1 degree cells. The rows
+are sorted by cell, so the stations of a run of neighboring cells in a row of the
+grid are one slice of the sorted rows. A query only looks at the stations in the
+cells it overlaps.
+
+The inventory (ghcnd-inventory.txt) is kept the same way by StationInventory.
+It lists the period of record of every element of every station, so stations
+that can't have the data of interest are skipped without opening their .dly files.
+
+DlyIndex keeps the byte offset and number of lines of every element and year of
+every .dly file, saved next to the catalog the first time the file is read. The
+lines are sorted by element and year, so reading only some variables or years
+is a few seeks and reads of contiguous blocks instead of reading the whole file.
+
+The layout of a line in ghcnd-stations.txt is:
+    ID            1-11   character
+    LATITUDE     13-20   real
+    LONGITUDE    22-30   real
+    ELEVATION    32-37   real
+    STATE        39-40   character
+    NAME         42-71   character
+    GSN FLAG     73-75   character
+    HCN/CRN FLAG 77-79   character
+    WMO ID       81-85   character
+
+The layout of a line in ghcnd-inventory.txt is:
+    ID            1-11   character
+    LATITUDE     13-20   real
+    LONGITUDE    22-30   real
+    ELEMENT      32-35   character
+    FIRSTYEAR    37-40   integer
+    LASTYEAR     42-45   integer
+"""
+
+STATIONS_LINE_LENGTH = 85
+INVENTORY_LINE_LENGTH = 45
+EARTH_RADIUS = 6371.0 # mean radius of the earth in km
+GRID_COLUMNS = 360 # the spatial grid has 1 degree cells
+GRID_ROWS = 180
+NETWORKS = ["HCN","CRN","GSN"]
+# one block of lines of a .dly file in a DlyIndex. see dlyreader.blockIndex
+INDEX_DTYPE = np.dtype([("element", "S4"), ("year", "<i2"), ("offset", "<i8"), ("lines", "<i4"),
+                        ("firstMonth", "i1"), ("lastMonth", "i1")])
+
+# the columns of the catalog: (name, first character, last character + 1).
+# None reads to the end of the line
+STATION_COLUMNS = [("stationId", 0, 11),
+                   ("country", 0, 2),
+                   ("lat", 12, 20),
+                   ("lon", 21, 30),
+                   ("elev", 31, 37),
+                   ("state", 38, 40),
+                   ("name", 41, 71),
+                   ("gsn", 72, 75),
+                   ("hcncrn", 76, 79),
+                   ("wmoId", 80, None)]
+INVENTORY_COLUMNS = [("stationId", 0, 11),
+                     ("element", 31, 35),
+                     ("firstYear", 36, 40),
+                     ("lastYear", 41, 45)]
+
+
+class StationCatalog(object):
+
+    def __init__(self,initStationsMetadata,initCatalogFile=None):
+        """
+        Parameters:
+        -----------
+        initStationsMetadata: string
+            full file path to the ghcnd stations metadata file (ghcnd-stations.txt)
+        initCatalogFile: string
+            where the parsed catalog is saved. default is None (save it next
+            to ghcnd-stations.txt, with the extension .npz)
+        """
+        self.stationsFile = initStationsMetadata
+        if initCatalogFile == None:
+            initCatalogFile = os.path.splitext(initStationsMetadata)[0] + ".npz"
+        self.catalogFile = initCatalogFile
+
+        self.columns = {} # field name -> numpy array with one value per station
+        self.countryIndex = {} # country abbreviation -> array of row numbers
+        self.stateIndex = {} # state abbreviation -> array of row numbers
+        self.networkIndex = {} # "HCN", "CRN" or "GSN" -> array of row numbers
+        self.wmoIndex = {} # wmo id -> array of row numbers (stations can share a wmo id)
+        self.idIndex = {} # station id -> row number
+        self.gridOrder = None # row numbers sorted by grid cell. see __buildGrid
+        self.gridStarts = None # position in gridOrder where each grid cell starts
+
+        self.columns = _loadColumns(self.catalogFile, self.stationsFile)
+        if self.columns == None:
+            self.columns = _parseColumns(self.stationsFile, STATION_COLUMNS, STATIONS_LINE_LENGTH)
+            for name in ["lat","lon","elev"]:
+                self.columns[name] = self.columns[name].astype(np.float64)
+            _saveColumns(self.catalogFile, self.stationsFile, self.columns)
+        self.__buildIndexes()
+
+    def __len__(self):
+        return len(self.columns["stationId"])
+
+    def select(self,countries=None,states=None,networks=None,wmoIds=None,stationIds=None):
+        """
+        returns the row numbers (in file order) of the stations that match every
+        given criteria. A criteria that is None is not used.
+
+        Parameters:
+        -----------
+        countries: list
+            country abbreviations ("US","CA",...)
+        states: list
+            state abbreviations. Only stations in the United States and Canada
+            are filtered by state. Stations in other countries are always kept.
+        networks: list
+            any of "HCN", "CRN", "GSN". Stations in at least one of the networks are kept.
+        wmoIds: list
+            WMO station ids
+        stationIds: list
+            GHCND station ids. For example the ids returned by StationInventory.stationsWith
+
+        Returns:
+        ---------
+        numpy array of row numbers
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if countries is not None:
+            keep &= self.__lookup(self.countryIndex, countries)
+        if states is not None and len(states) > 0:
+            keep &= self.__lookup(self.stateIndex, states) | ~self.__lookup(self.countryIndex, ["US","CA"])
+        if networks is not None:
+            keep &= self.__lookup(self.networkIndex, networks)
+        if wmoIds is not None:
+            keep &= self.__lookup(self.wmoIndex, wmoIds)
+        if stationIds is not None:
+            keep &= np.isin(self.columns["stationId"], np.asarray(stationIds, dtype=self.columns["stationId"].dtype))
+        return np.nonzero(keep)[0]
+
+    def inBBox(self,minLat,minLon,maxLat,maxLon):
+        """
+        returns the row numbers (in file order) of the stations inside a bounding
+        box (edges included). If minLon is larger than maxLon, the box crosses the
+        180th meridian.
+
+        Parameters:
+        -----------
+        minLat, minLon, maxLat, maxLon: float
+            the edges of the box in decimal degrees
+        """
+        if self.gridOrder is None:
+            self.__buildGrid()
+        if minLon <= maxLon:
+            candidates = self.__cellRange(minLat, maxLat, minLon, maxLon)
+        else: # split the box at the 180th meridian
+            candidates = np.concatenate([self.__cellRange(minLat, maxLat, minLon, 180.),
+                                         self.__cellRange(minLat, maxLat, -180., maxLon)])
+        lat = self.columns["lat"][candidates]
+        lon = self.columns["lon"][candidates]
+        inLon = (lon >= minLon) & (lon <= maxLon) if minLon <= maxLon else (lon >= minLon) | (lon <= maxLon)
+        return np.sort(candidates[(lat >= minLat) & (lat <= maxLat) & inLon])
+
+    def near(self,lat,lon,radius):
+        """
+        returns the row numbers (in file order) of the stations within a
+        great circle distance of a point, and their distances
+
+        Parameters:
+        -----------
+        lat, lon: float
+            the point in decimal degrees
+        radius: float
+            the search radius in km
+
+        Returns:
+        ---------
+        (rows, distances) numpy arrays. distances are in km
+        """
+        angle = radius / EARTH_RADIUS # the radius in radians
+        minLat = lat - np.degrees(angle)
+        maxLat = lat + np.degrees(angle)
+        if minLat <= -90. or maxLat >= 90. or angle >= np.pi / 2: # the circle holds a pole, so it spans every longitude
+            rows = self.inBBox(max(minLat, -90.), -180., min(maxLat, 90.), 180.)
+        else:
+            # the widest longitude span of the circle, see http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+            dLon = np.degrees(np.arcsin(min(1., np.sin(angle) / np.cos(np.radians(lat)))))
+            west = (lon - dLon + 180.) % 360. - 180.
+            east = (lon + dLon + 180.) % 360. - 180.
+            if 2 * dLon >= 360.:
+                west, east = -180., 180.
+            rows = self.inBBox(minLat, west, maxLat, east)
+        distances = distance(lat, lon, self.columns["lat"][rows], self.columns["lon"][rows])
+        keep = distances <= radius
+        return rows[keep], distances[keep]
+
+    def rowOf(self,stationId):
+        """
+        returns the row number of a station id, or None if it isn't in the catalog
+        """
+        if len(self.idIndex) == 0: # built on first use, most sessions never need it
+            self.idIndex = dict(zip(self.columns["stationId"].tolist(), range(len(self))))
+        return self.idIndex.get(stationId)
+
+    def stationArgs(self,rows):
+        """
+        returns a list with the arguments to construct a preprocessor.Station for
+        each of the rows of the catalog:
+        (name, stationId, country, state, lat, lon, elev, hcn, crn, gsn, wmoId).
+        state is None outside the United States and Canada and wmoId is None
+        if the station has no WMO id.
+        """
+        c = dict([(name, self.columns[name][rows].tolist()) for name in self.columns])
+        inUSCA = [country == "US" or country == "CA" for country in c["country"]]
+        states = [state if usca else None for state, usca in zip(c["state"], inUSCA)]
+        return list(zip(c["name"], c["stationId"], c["country"], states,
+                        c["lat"], c["lon"], c["elev"],
+                        [h == "HCN" for h in c["hcncrn"]], [h == "CRN" for h in c["hcncrn"]],
+                        [g == "GSN" for g in c["gsn"]], [w or None for w in c["wmoId"]]))
+
+    def __lookup(self,index,keys):
+        """
+        returns a boolean mask of the rows that hold any of the keys
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        for k in keys:
+            if k in index:
+                mask[index[k]] = True
+        return mask
+
+    def __cellRange(self,minLat,maxLat,minLon,maxLon):
+        """
+        returns the rows in the grid cells that overlap a box that doesn't cross the 180th meridian
+        """
+        i0, j0 = _gridCell(minLat, minLon)
+        i1, j1 = _gridCell(maxLat, maxLon)
+        slices = []
+        for i in range(i0, i1 + 1): # the cells j0 to j1 of a grid row are next to each other in gridOrder
+            slices.append(self.gridOrder[self.gridStarts[i*GRID_COLUMNS + j0]:self.gridStarts[i*GRID_COLUMNS + j1 + 1]])
+        return np.concatenate(slices)
+
+    def __buildGrid(self):
+        i, j = _gridCell(self.columns["lat"], self.columns["lon"])
+        cells = i * GRID_COLUMNS + j
+        self.gridOrder = np.argsort(cells, kind="mergesort")
+        self.gridStarts = np.searchsorted(cells[self.gridOrder], np.arange(GRID_ROWS*GRID_COLUMNS + 1))
+
+    def __buildIndexes(self):
+        self.countryIndex = _groupRows(self.columns["country"])
+        self.stateIndex = _groupRows(self.columns["state"])
+        self.networkIndex = {}
+        for network in NETWORKS:
+            column = self.columns["gsn"] if network == "GSN" else self.columns["hcncrn"]
+            self.networkIndex[network] = np.nonzero(column == network)[0]
+        wmo = self.columns["wmoId"]
+        hasWmo = np.nonzero(wmo != "")[0]
+        self.wmoIndex = dict((wmoId, hasWmo[rows]) for wmoId, rows in _groupRows(wmo[hasWmo]).items())
+
+
+class StationInventory(object):
+
+    def __init__(self,initInventoryMetadata,initInventoryFile=None):
+        """
+        Parameters:
+        -----------
+        initInventoryMetadata: string
+            full file path to the ghcnd inventory metadata file (ghcnd-inventory.txt)
+        initInventoryFile: string
+            where the parsed inventory is saved. default is None (save it next
+            to ghcnd-inventory.txt, with the extension .npz)
+        """
+        self.inventoryFile = initInventoryMetadata
+        if initInventoryFile == None:
+            initInventoryFile = os.path.splitext(initInventoryMetadata)[0] + ".npz"
+        self.catalogFile = initInventoryFile
+
+        self.columns = _loadColumns(self.catalogFile, self.inventoryFile) # one row per station and element
+        if self.columns == None:
+            self.columns = _parseColumns(self.inventoryFile, INVENTORY_COLUMNS, INVENTORY_LINE_LENGTH)
+            for name in ["firstYear","lastYear"]:
+                self.columns[name] = self.columns[name].astype(np.int16)
+            _saveColumns(self.catalogFile, self.inventoryFile, self.columns)
+
+    def __len__(self):
+        return len(self.columns["stationId"])
+
+    def stationsWith(self,variables,startYear=None,endYear=None):
+        """
+        returns the ids of the stations that recorded at least one of the variables
+        during the years from startYear to endYear (inclusive). A station counts if
+        the period of record of the variable overlaps those years.
+
+        Parameters:
+        -----------
+        variables: list
+            variable names ("TMAX","TMIN","PRCP", etc...)
+        startYear: int
+            default is None (no lower bound)
+        endYear: int
+            default is None (no upper bound)
+
+        Returns:
+        ---------
+        numpy array of station ids, sorted
+        """
+        c = self.columns
+        keep = np.isin(c["element"], np.asarray(variables, dtype=c["element"].dtype))
+        if startYear != None:
+            keep &= c["lastYear"] >= startYear
+        if endYear != None:
+            keep &= c["firstYear"] <= endYear
+        return np.unique(c["stationId"][keep])
+
+    def periodOf(self,stationId,variable):
+        """
+        returns the (firstYear, lastYear) of a variable of a station, or None
+        if the variable isn't in the inventory for the station
+        """
+        rows = np.nonzero((self.columns["stationId"] == stationId) & (self.columns["element"] == variable))[0]
+        if len(rows) == 0:
+            return None
+        return int(self.columns["firstYear"][rows[0]]), int(self.columns["lastYear"][rows[0]])
+
+
+class DlyIndex(object):
+
+    def __init__(self,initIndexDirectory):
+        """
+        the byte offsets of the blocks of lines in the .dly files (see dlyreader.blockIndex),
+        saved as one small file per station. An index is only used while the size and
+        modification time of its .dly file haven't changed.
+
+        Each file is a line of JSON holding the size and modification time of the .dly
+        file, followed by the blocks as raw records of INDEX_DTYPE, so reading an index
+        is a single read without unzipping or parsing.
+
+        Parameters:
+        -----------
+        initIndexDirectory: string
+            path to the directory that holds the index files. It is created if it doesn't exist
+        """
+        self.indexDir = initIndexDirectory
+        if not os.path.isdir(self.indexDir):
+            try:
+                os.makedirs(self.indexDir)
+            except OSError: # the index still works, it just won't be saved
+                pass
+
+    def entryPath(self,stationId):
+        return os.path.join(self.indexDir, stationId + ".idx")
+
+    def get(self,filename):
+        """
+        returns the block index of a .dly file as a structured array with the fields of
+        dlyreader.blockIndex, or None if it isn't saved or the file changed since it was indexed
+        """
+        path = self.entryPath(_stationIdOf(filename))
+        if not os.path.isfile(path):
+            return None
+        infile = open(path, "rb")
+        buf = infile.read()
+        infile.close()
+        header, newline, records = buf.partition(b"\n")
+        try:
+            if json.loads(header.decode("ascii")) != _sourceKey(filename) or len(records) % INDEX_DTYPE.itemsize != 0:
+                return None
+        except ValueError: # a corrupt index is treated as missing
+            return None
+        return np.frombuffer(records, dtype=INDEX_DTYPE)
+
+    def put(self,filename,index):
+        """
+        saves the block index of a .dly file. An index of None (a file whose lines
+        aren't fixed width) is not saved
+        """
+        if index is None:
+            return
+        records = np.zeros(len(index["offset"]), dtype=INDEX_DTYPE)
+        for name in INDEX_DTYPE.names:
+            records[name] = index[name]
+        path = self.entryPath(_stationIdOf(filename))
+        tmpPath = path + "." + str(os.getpid()) + ".tmp"
+        try:
+            outfile = open(tmpPath, "wb")
+            outfile.write(json.dumps(_sourceKey(filename)).encode("ascii") + b"\n")
+            outfile.write(records.tobytes())
+            outfile.close()
+            os.rename(tmpPath, path) # other processes never see a partly written index
+        except (IOError, OSError):
+            pass
+
+
+def distance(lat1,lon1,lat2,lon2):
+    """
+    returns the great circle distance in km between points given in decimal
+    degrees (haversine formula). The arguments can be numbers or numpy arrays.
+    """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+def _gridCell(lat,lon):
+    """
+    returns the (row, column) of the spatial grid cell that holds a point
+    """
+    i = np.clip(np.floor(np.asarray(lat) + 90.).astype(np.int64), 0, GRID_ROWS - 1)
+    j = np.clip(np.floor(np.asarray(lon) + 180.).astype(np.int64), 0, GRID_COLUMNS - 1)
+    return i, j
+
+def _parseColumns(filename,columns,lineLength):
+    """
+    reads a fixed width text file into a dictionary of numpy arrays of strings,
+    one per column. columns is a list of (name, first character, last character + 1)
+    """
+    infile = open(filename, "rb")
+    lines = [line for line in infile.read().splitlines() if line.strip() != b""]
+    infile.close()
+    width = max([lineLength] + [len(line) for line in lines])
+    chars = np.frombuffer(b"".join([line.ljust(width) for line in lines]), dtype=np.uint8).reshape(-1, width)
+    out = {}
+    for name, first, last in columns:
+        if last == None:
+            last = width
+        column = np.ascontiguousarray(chars[:, first:last]).view("S" + str(last - first)).ravel()
+        out[name] = np.char.strip(np.char.decode(column, "latin-1"))
+    return out
+
+def _stationIdOf(filename):
+    return os.path.basename(filename)[:-4] # the file name without .dly
+
+def _sourceKey(filename):
+    info = os.stat(filename)
+    return {"size": info.st_size, "mtime": repr(info.st_mtime)}
+
+def _saveColumns(catalogFile,sourceFile,columns):
+    arrays = dict(columns)
+    arrays["meta"] = np.array(json.dumps(_sourceKey(sourceFile)))
+    try:
+        outfile = open(catalogFile, "wb")
+        np.savez(outfile, **arrays)
+        outfile.close()
+    except (IOError, OSError): # the catalog still works, it just won't be saved for the next session
+        pass
+
+def _loadColumns(catalogFile,sourceFile):
+    """
+    returns the columns saved in catalogFile, or None if there is no saved
+    file or sourceFile changed since it was saved
+    """
+    if not os.path.isfile(catalogFile):
+        return None
+    try:
+        npz = np.load(catalogFile)
+        arrays = dict([(k, npz[k]) for k in npz.files])
+        npz.close()
+    except (IOError, ValueError):
+        return None
+    if json.loads(str(arrays.pop("meta"))) != _sourceKey(sourceFile):
+        return None
+    return arrays
+
+def _groupRows(column):
+    """
+    returns a dictionary mapping each distinct value of column to the
+    rows (in order) that hold it
+    """
+    values, inverse = np.unique(column, return_inverse=True)
+    order = np.argsort(inverse, kind="mergesort") # stable, so rows stay in file order
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(values)))[:-1]
+    groups = np.split(order, bounds)
+    return dict(zip(values.tolist(), groups))
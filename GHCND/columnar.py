@@ -0,0 +1,267 @@
+import os
+import json
+import numpy as np
+from GHCND import store
+from GHCND import filters
+from GHCND import conversion
+
+"""
+A columnar export of station data in long format: one row per value, with the
+columns stationId, variable, date and value.
+
+Rather than one text line or one JSON list element per value, the rows are
+written in row groups. A row group is one .npz file holding one typed array
+per column. The station ids and variables are dictionary encoded: the
+stationId column holds int32 codes into the list of station ids, and the
+variable column holds int16 codes into the list of variables. Dates are int32
+days since 1970-01-01 and values are float32.
+
+A JSON manifest (manifest.json) holds the dictionaries (each variable with its
+dataDescription and unit, see the conversion module), the Station attributes,
+the filter rules the values passed (see the filters module) and the statistics
+of each row group: the range of station codes, the range of dates and the
+variables it holds. Stations are coded in the order they are
+written, so each row group covers a narrow range of codes. A read for some
+stations, variables or dates only opens the row groups whose statistics can
+match (predicate pushdown), then filters their rows.
+
+Usually the export is used through the StationPreprocessor:
+    sp.exportToColumnar("D:/GHCND_data/columnar", sp.iterStations(["TMAX","PRCP"]))
+    reader = columnar.ColumnarReader("D:/GHCND_data/columnar")
+    rows = reader.read(stationIds=["USC00011084"], start="1980-01-01", end="2009-12-31")
+"""
+
+MANIFEST_FILE = "manifest.json"
+COLUMNS = [("stationId", np.int32), ("variable", np.int16), ("date", np.int32), ("value", np.float32)]
+
+
+class ColumnarWriter(object):
+
+    def __init__(self,initDirectory,initRowGroupSize=1000000,initCompress=False,initFilterSpec=None):
+        """
+        starts a new export. Write the stations with writeStation, then call close to
+        write the manifest.
+
+        Parameters:
+        -----------
+        initDirectory: string
+            path to the directory of the export. It is created if it doesn't exist.
+            An existing export there is replaced
+        initRowGroupSize: int
+            the number of rows buffered before they are written as a row group. This
+            bounds the memory used while writing. default is 1000000
+        initCompress: boolean
+            if True, the row groups are zlib compressed. They are smaller, but slower to
+            write and read. default is False
+        initFilterSpec: filters.FilterSpec
+            the filter rules of the data, recorded in the manifest. default is None
+            (filters.DEFAULT_FILTER)
+        """
+        self.directory = initDirectory
+        self.rowGroupSize = initRowGroupSize
+        self.compress = initCompress
+        self.filterSpec = initFilterSpec
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for f in os.listdir(self.directory): # the old export is invalid once its row groups are rewritten
+            if f == MANIFEST_FILE or (f.startswith("rowgroup_") and f.endswith(".npz")):
+                os.remove(os.path.join(self.directory, f))
+        self.stations = dict([(field, []) for field in store.STATION_FIELDS])
+        self.stationCodes = {} # station id -> code
+        self.variables = [] # [name, dataDescription, unit] of each variable code
+        self.variableCodes = {}
+        self.rowGroups = []
+        self.buffer = dict([(name, []) for name, dtype in COLUMNS])
+        self.buffered = 0
+
+    def writeStation(self,station,keepNaN=False):
+        """
+        adds the values of all the ClimateVars of a station. The values of a variable are in
+        the unit of the first ClimateVar written with its name and dataDescription. The values
+        of ClimateVars in other units of the same quantity are converted as they are written.
+
+        Parameters:
+        -----------
+        station: Station
+            the station to write
+        keepNaN: boolean
+            if True, NaN values are written too. default is False (long format
+            doesn't need rows for missing values)
+        """
+        if station.stationId not in self.stationCodes:
+            self.stationCodes[station.stationId] = len(self.stationCodes)
+            for field in store.STATION_FIELDS:
+                self.stations[field].append(getattr(station, field))
+        code = self.stationCodes[station.stationId]
+        for varName in station.variables:
+            climateVariable = station.variables[varName]
+            key = (varName, climateVariable.dataDescription)
+            if key not in self.variableCodes:
+                self.variableCodes[key] = len(self.variables)
+                self.variables.append(list(key) + [climateVariable.unit])
+            unit = self.variables[self.variableCodes[key]][2]
+            values = np.asarray(climateVariable.data, dtype=np.float32)
+            if climateVariable.unit != unit:
+                values = conversion.convertArray(np.array(values), climateVariable.unit, unit) # a copy, the ClimateVar isn't changed
+            days = climateVariable.days
+            if not keepNaN:
+                isValid = ~np.isnan(values)
+                values = values[isValid]
+                days = days[isValid]
+            if len(values) == 0:
+                continue
+            self.buffer["stationId"].append(np.full(len(values), code, dtype=np.int32))
+            self.buffer["variable"].append(np.full(len(values), self.variableCodes[key], dtype=np.int16))
+            self.buffer["date"].append(days.astype(np.int32))
+            self.buffer["value"].append(values)
+            self.buffered += len(values)
+            if self.buffered >= self.rowGroupSize:
+                self.__flush()
+
+    def __flush(self):
+        if self.buffered == 0:
+            return
+        columns = dict([(name, np.concatenate(self.buffer[name]).astype(dtype)) for name, dtype in COLUMNS])
+        filename = "rowgroup_%05d.npz" % len(self.rowGroups)
+        outfile = open(os.path.join(self.directory, filename), "wb")
+        if self.compress:
+            np.savez_compressed(outfile, **columns)
+        else:
+            np.savez(outfile, **columns)
+        outfile.close()
+        self.rowGroups.append({"file": filename, "rows": self.buffered,
+                               "stationIds": [int(columns["stationId"].min()), int(columns["stationId"].max())],
+                               "dates": [int(columns["date"].min()), int(columns["date"].max())],
+                               "variables": np.unique(columns["variable"]).tolist()})
+        self.buffer = dict([(name, []) for name, dtype in COLUMNS])
+        self.buffered = 0
+
+    def close(self):
+        """
+        writes the last row group and the manifest. Returns the opened ColumnarReader
+        """
+        self.__flush()
+        manifest = {"columns": [[name, np.dtype(dtype).str] for name, dtype in COLUMNS],
+                    "filter": filters.describe(self.filterSpec),
+                    "stations": self.stations,
+                    "variables": self.variables,
+                    "rowGroups": self.rowGroups}
+        tmpPath = os.path.join(self.directory, MANIFEST_FILE + ".tmp")
+        outfile = open(tmpPath, "w")
+        json.dump(manifest, outfile)
+        outfile.close()
+        os.rename(tmpPath, os.path.join(self.directory, MANIFEST_FILE))
+        return ColumnarReader(self.directory)
+
+
+class ColumnarReader(object):
+
+    def __init__(self,initDirectory):
+        """
+        opens an export written by ColumnarWriter. Only the manifest is read until
+        rows are requested.
+
+        Parameters:
+        -----------
+        initDirectory: string
+            path to the directory of the export
+        """
+        self.directory = initDirectory
+        infile = open(os.path.join(self.directory, MANIFEST_FILE), "r")
+        self.manifest = json.load(infile)
+        infile.close()
+        self.stationIds = self.manifest["stations"]["stationId"]
+        self.stationCodes = dict(zip(self.stationIds, range(len(self.stationIds))))
+        self.variables = [tuple(v) if len(v) == 3 else tuple(v) + (None,) for v in self.manifest["variables"]] # (name, dataDescription, unit). older exports have no unit
+        self.filter = self.manifest.get("filter") # {"fingerprint": ..., "rules": ...} of the filter rules. None for older exports
+
+    def __len__(self):
+        return sum([rowGroup["rows"] for rowGroup in self.manifest["rowGroups"]])
+
+    def stationArgs(self):
+        """
+        returns a list with the arguments to construct a preprocessor.Station for each
+        station in the export (see catalog.StationCatalog.stationArgs)
+        """
+        stations = self.manifest["stations"]
+        return list(zip(*[stations[field] for field in store.STATION_FIELDS]))
+
+    def rowGroups(self,stationIds=None,variables=None,start=None,end=None):
+        """
+        returns the numbers of the row groups whose statistics can match the predicates
+        (see read). The other row groups can't hold any matching row.
+        """
+        stationCodes, variableCodes, first, last = self.__predicates(stationIds, variables, start, end)
+        matches = []
+        for i, rowGroup in enumerate(self.manifest["rowGroups"]):
+            if first is not None and rowGroup["dates"][1] < first:
+                continue
+            if last is not None and rowGroup["dates"][0] > last:
+                continue
+            if stationCodes is not None and not ((stationCodes >= rowGroup["stationIds"][0]) & (stationCodes <= rowGroup["stationIds"][1])).any():
+                continue
+            if variableCodes is not None and len(set(variableCodes) & set(rowGroup["variables"])) == 0:
+                continue
+            matches.append(i)
+        return matches
+
+    def read(self,stationIds=None,variables=None,start=None,end=None):
+        """
+        returns the rows that match all the predicates that are not None, as a dictionary
+        of columns: "stationId" (array of strings), "variable" (array of strings),
+        "dataDescription" (array of strings), "unit" (array of strings, "" if the unit isn't
+        known), "date" (datetime64[D]) and "value" (float32).
+        Only the row groups that can match are read (see rowGroups).
+
+        Parameters:
+        -----------
+        stationIds: list
+            the station ids to read. default is None (every station)
+        variables: list
+            the variable names to read ("TMAX","TMIN","PRCP", etc...). default is None (every variable)
+        start: date
+            the first date to read (a datetime.date, numpy.datetime64 or string like "1980-01-01").
+            default is None (no lower bound)
+        end: date
+            the last date to read (inclusive). default is None (no upper bound)
+        """
+        stationCodes, variableCodes, first, last = self.__predicates(stationIds, variables, start, end)
+        parts = dict([(name, []) for name, dtype in COLUMNS])
+        for i in self.rowGroups(stationIds, variables, start, end):
+            npz = np.load(os.path.join(self.directory, self.manifest["rowGroups"][i]["file"]))
+            columns = dict([(name, npz[name]) for name, dtype in COLUMNS])
+            npz.close()
+            keep = np.ones(len(columns["date"]), dtype=bool)
+            if first is not None:
+                keep &= columns["date"] >= first
+            if last is not None:
+                keep &= columns["date"] <= last
+            if stationCodes is not None:
+                keep &= np.isin(columns["stationId"], stationCodes)
+            if variableCodes is not None:
+                keep &= np.isin(columns["variable"], variableCodes)
+            for name, dtype in COLUMNS:
+                parts[name].append(columns[name][keep])
+        columns = dict([(name, np.concatenate(parts[name]) if len(parts[name]) > 0 else np.zeros(0, dtype=dtype)) for name, dtype in COLUMNS])
+        variableCodes = columns["variable"].astype(np.int64)
+        return {"stationId": np.array(self.stationIds + [""])[columns["stationId"]],
+                "variable": np.array([v[0] for v in self.variables] + [""])[variableCodes],
+                "dataDescription": np.array([v[1] for v in self.variables] + [""])[variableCodes],
+                "unit": np.array([v[2] or "" for v in self.variables] + [""])[variableCodes],
+                "date": columns["date"].astype(np.int64).astype("datetime64[D]"),
+                "value": columns["value"]}
+
+    def __predicates(self,stationIds,variables,start,end):
+        """
+        returns the predicates in the encoding of the row groups: the station codes,
+        the variable codes, and the first and last day number. None means no predicate
+        """
+        stationCodes = None
+        if stationIds is not None:
+            stationCodes = np.array([self.stationCodes[s] for s in stationIds if s in self.stationCodes], dtype=np.int32)
+        variableCodes = None
+        if variables is not None:
+            variableCodes = [code for code, v in enumerate(self.variables) if v[0] in variables]
+        first = None if start is None else int(np.datetime64(start, "D").astype(np.int64))
+        last = None if end is None else int(np.datetime64(end, "D").astype(np.int64))
+        return stationCodes, variableCodes, first, last
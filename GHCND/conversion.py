@@ -1,34 +1,208 @@
 import numpy as np
+from fractions import Fraction
 
-# conversion functions
+"""
+Unit conversions of the data of stations, ClimateVars and DataCubes.
+
+Every ClimateVar knows the unit of its data (its unit attribute). The data
+read from the .dly files is in the units of the files (see NATIVE_UNITS), for
+example tenths of a degree celsius for TMAX and tenths of a mm for PRCP.
+Converting to the unit a variable is already in does nothing, so the
+conversions can be called any number of times.
+
+Every unit of a quantity is an affine transform of the quantity's base unit
+(see UNITS). A conversion from any unit to any other is fused into a single
+scale and offset (kept as exact fractions, so a round trip is exact), and is
+applied in place to the data array: one pass over the values, no new array.
+Arrays that can't be written to (for example read only memory maps of a store)
+are converted into a new array instead.
+
+    conversion.convert(sp, "F") # every temperature variable to fahrenheit
+    conversion.convert(sp, "in", ["PRCP"])
+    conversion.convertCube(sp.toCube("TMAX", "month"), "F")
+"""
+
+# unit -> (quantity, scale, offset). value in the base unit = value * scale + offset
+UNITS = {"tenths_C": ("temperature", Fraction(1, 10), Fraction(0)),
+         "C": ("temperature", Fraction(1), Fraction(0)),
+         "F": ("temperature", Fraction(5, 9), Fraction(-160, 9)),
+         "K": ("temperature", Fraction(1), Fraction(-27315, 100)),
+         "tenths_mm": ("length", Fraction(1, 10), Fraction(0)),
+         "mm": ("length", Fraction(1), Fraction(0)),
+         "cm": ("length", Fraction(10), Fraction(0)),
+         "in": ("length", Fraction(254, 10), Fraction(0))}
+
+# the units of the elements in the .dly files. Other elements have no known unit (None)
+NATIVE_UNITS = {"TMAX": "tenths_C", "TMIN": "tenths_C", "TAVG": "tenths_C", "TOBS": "tenths_C",
+                "MNPN": "tenths_C", "MXPN": "tenths_C",
+                "PRCP": "tenths_mm", "MDPR": "tenths_mm", "EVAP": "tenths_mm", "WESD": "tenths_mm", "WESF": "tenths_mm",
+                "SNOW": "mm", "SNWD": "mm"}
+
+
+def nativeUnit(varName):
+	"""
+	returns the unit of a variable in the .dly files, or None if it's not known
+	"""
+	return NATIVE_UNITS.get(varName)
+
+def transform(fromUnit,toUnit):
+	"""
+	returns the (scale, offset) as Fractions that converts values in fromUnit to
+	toUnit (new value = value * scale + offset). Returns None if either unit is None
+	or unknown, or the units measure different quantities.
+	"""
+	if fromUnit not in UNITS or toUnit not in UNITS:
+		return None
+	fromQuantity, fromScale, fromOffset = UNITS[fromUnit]
+	toQuantity, toScale, toOffset = UNITS[toUnit]
+	if fromQuantity != toQuantity:
+		return None
+	return fromScale / toScale, (fromOffset - toOffset) / toScale
+
+def convertArray(values,fromUnit,toUnit):
+	"""
+	converts an array of values from fromUnit to toUnit and returns it. Float arrays
+	that can be written to are converted in place (the returned array is values).
+	The values are returned as they are if the units are the same or can't be converted.
+	"""
+	affine = transform(fromUnit, toUnit)
+	if affine is None:
+		return values
+	return _apply(values, *affine)
+
+def convertVariable(climateVariable,unit):
+	"""
+	converts the data of a ClimateVar to unit, in place. Does nothing if the ClimateVar
+	is already in unit, or its unit is None or measures a different quantity.
+	Returns True if the ClimateVar is in unit afterwards.
+	"""
+	if climateVariable.unit == unit:
+		return True
+	affine = transform(climateVariable.unit, unit)
+	if affine is None:
+		return False
+	if len(climateVariable.data) > 0:
+		climateVariable.setData(_apply(climateVariable.data, *affine))
+	climateVariable.unit = unit
+	return True
+
+def convert(stationCollection,unit,variables=None):
+	"""
+	converts every variable of the stations that measures the same quantity as unit
+	(temperature or length) to unit, in place. Variables that are already in unit are
+	not changed, so this can be called any number of times.
+
+	Parameters:
+	------------
+	stationCollection: StationPreprocessor object
+		can also be a single Station object or any iterable of Station objects
+	unit: string
+		one of the units in UNITS ("C", "F", "K", "mm", "in", etc...)
+	variables: list
+		only convert these variables ("TMAX","PRCP", etc...). default is None (every variable)
+
+	Returns:
+	----------
+	None
+	"""
+	if unit not in UNITS:
+		print("error: did not enter a valid unit")
+		print("please enter a unit from the following: ")
+		print(sorted(UNITS))
+		return
+	for s in __stationsOf(stationCollection):
+		for v in s.variables:
+			if variables == None or v in variables:
+				convertVariable(s.variables[v], unit)
+
+def convertCube(dataCube,unit):
+	"""
+	converts the data of a cube.DataCube to unit, in place (one pass over the stacked
+	array). A cube that is a read only view of a store gets a new array.
+	Returns True if the cube is in unit afterwards.
+	"""
+	if dataCube.unit == unit:
+		return True
+	affine = transform(dataCube.unit, unit)
+	if affine is None:
+		print("error: can't convert " + str(dataCube.unit) + " to " + str(unit))
+		return False
+	dataCube.data = _apply(dataCube.data, *affine)
+	dataCube.unit = unit
+	return True
+
+def __stationsOf(stationCollection):
+	"""
+	lets the conversion functions take a StationPreprocessor,
+	a single Station, or a list of Station objects
+	"""
+	if hasattr(stationCollection, "stations"):
+		return stationCollection.stations
+	if hasattr(stationCollection, "variables"):
+		return [stationCollection]
+	return stationCollection
+
+def __convertFrom(stationCollection,fromUnits,unit):
+	for s in __stationsOf(stationCollection):
+		for v in s.variables:
+			if s.variables[v].unit in fromUnits:
+				convertVariable(s.variables[v], unit)
+
+def _apply(values,scale,offset):
+	"""
+	applies value * scale + offset to an array, in place if it's a float array that can be
+	written to. A scale of 1/n is applied as a division by n, so tenths are converted exactly
+	as values / 10.
+	"""
+	values = np.asarray(values)
+	if values.dtype.kind != "f" or not values.flags.writeable:
+		values = values.astype(np.float64 if values.dtype.kind != "f" else values.dtype)
+	if scale.numerator == 1 and scale.denominator != 1:
+		np.divide(values, scale.denominator, out=values)
+	elif scale != 1:
+		np.multiply(values, float(scale), out=values)
+	if offset != 0:
+		np.add(values, float(offset), out=values)
+	return values
 
 def TenthsCelsiusToCelsius(stationCollection):
 	"""
 	The station data is in tenths of a degree celsius.
 	This will convert all temperature data in the station
-	collection to Celsius
+	collection that is in tenths of a degree to Celsius.
+	Variables that are already converted are not changed.
 
 	Parameters:
 	------------
 	stationCollection: StationPreprocessor object
+		can also be a single Station object or a list of Station objects
 
 	Returns:
 	----------
 	None
 	"""
-	for s in stationCollection.stations:
-		for v in s.variables:
-			if v == "TMAX" or v == "TMIN" or v == "TAVG":
-				s.variables[v].setData(np.array(s.variables[v].data) / 10.)
+	__convertFrom(stationCollection, ["tenths_C"], "C")
 
 def CelsiusToFahrenheit(stationCollection):
-	return NotImplemented
+	"""
+	converts all temperature data (in Celsius or tenths of a degree) to Fahrenheit
+	"""
+	__convertFrom(stationCollection, ["C", "tenths_C"], "F")
 
 def FahrenheitToCelsius(stationCollection):
-	return NotImplemented
+	"""
+	converts all temperature data in Fahrenheit to Celsius
+	"""
+	__convertFrom(stationCollection, ["F"], "C")
 
 def MillimetersToInches(stationCollection):
-	return NotImplemented
+	"""
+	converts all precipitation and snow data (in mm or tenths of a mm) to inches
+	"""
+	__convertFrom(stationCollection, ["mm", "tenths_mm"], "in")
 
 def InchesToMillimeters(stationCollection):
-	return NotImplemented
\ No newline at end of file
+	"""
+	converts all precipitation and snow data in inches to mm
+	"""
+	__convertFrom(stationCollection, ["in"], "mm")
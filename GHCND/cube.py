@@ -0,0 +1,247 @@
+import numpy as np
+from GHCND import stats
+from GHCND import conversion
+
+"""
+A dense station x time array of one variable of a collection of stations.
+
+Calculations over many stations (climatologies, trends, spatial means, etc...)
+are single NumPy operations on the cube, instead of a loop over thousands of
+Station and ClimateVar objects. The rows of the cube are the stations and the
+columns are a time axis shared by all the stations: every day, month, season
+or year from the earliest to the latest date of any station. Values a station
+doesn't have are NaN. All the values of a cube are in one unit (see the
+conversion module), so conversion.convertCube converts the whole cube in place.
+
+A cube is usually made by the StationPreprocessor:
+    cube = sp.toCube("TMAX", "month")
+    cube.data -= np.nanmean(cube.data, axis=1)[:, None]
+    cube.writeBack(sp)
+"""
+
+validtimeframes = ["day"] + stats.validtimeframes
+# the data descriptions of the ClimateVars that can be stacked for each timeframe
+cubeDescriptions = {"day": ["daily"],
+                    "month": ["monthly_mean", "monthly_anomaly"],
+                    "season": ["seasonal_mean", "seasonal_anomaly"],
+                    "year": ["annual_mean", "annual_anomaly"]}
+
+
+class DataCube(object):
+
+    def __init__(self,initVariable,initTimeframe,initData,initStationIds,initTimes,initSpans=None,initUnit=None):
+        """
+        Parameters:
+        -----------
+        initVariable: string
+            the variable name ("TMAX","TMIN","PRCP", etc...)
+        initTimeframe: string
+            "day", "month", "season" or "year"
+        initData: numpy array
+            float32 array with one row per station and one column per time
+        initStationIds: list
+            the station id of each row
+        initTimes: numpy array
+            datetime64[D] date of each column (the first day of each period)
+        initSpans: numpy array
+            the first and last column (inclusive) of each station's record, with shape
+            (stations, 2). default is None (the whole time axis)
+        initUnit: string
+            the unit of the data (see the conversion module). default is None (not known)
+        """
+        self.variable = initVariable
+        self.timeframe = initTimeframe
+        self.data = initData
+        self.stationIds = list(initStationIds)
+        self.index = dict(zip(self.stationIds, range(len(self.stationIds)))) # station id -> row
+        self.times = initTimes
+        if initSpans is None:
+            initSpans = np.tile([0, len(initTimes) - 1], (len(self.stationIds), 1))
+        self.spans = initSpans
+        self.unit = initUnit
+
+    def __len__(self):
+        return len(self.stationIds)
+
+    def row(self,stationId):
+        """
+        returns the values of a station (a view into data)
+        """
+        return self.data[self.index[stationId]]
+
+    def timeIndex(self,date):
+        """
+        returns the column that holds a date, or None if it's outside the time axis
+        """
+        key = _timeKeys([date], self.timeframe)[0]
+        column = int(key - _timeKeys(self.times[:1], self.timeframe)[0])
+        if column < 0 or column >= len(self.times):
+            return None
+        return column
+
+    def spatialMean(self):
+        """
+        returns the mean over all the stations of each time (NaN values are ignored)
+        """
+        isValid = ~np.isnan(self.data)
+        counts = isValid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(isValid, self.data, 0.).sum(axis=0, dtype=np.float64) / counts
+
+    def climatology(self,baselinePeriod=None):
+        """
+        returns the mean of every calendar month (or season) of every station, with
+        shape (stations, 12) for months, (stations, 4) for seasons and (stations, 1)
+        for years. Days are not supported.
+
+        Parameters:
+        -----------
+        baselinePeriod: list
+            two dates that bound the period (inclusive). default is None (the whole record)
+        """
+        if self.timeframe == "day":
+            print("error: climatologies need monthly, seasonal or annual data")
+            return
+        periodsPerYear = {"month": 12, "season": 4, "year": 1}[self.timeframe]
+        firstKey = _timeKeys(self.times[:1], self.timeframe)[0]
+        lead = firstKey % periodsPerYear # position of the first column in its year
+        years = -(-(lead + len(self.times)) // periodsPerYear)
+        padded = np.full((len(self), years * periodsPerYear), np.nan)
+        padded[:, lead:lead+len(self.times)] = self.data
+        if baselinePeriod is not None:
+            keys = firstKey - lead + np.arange(years * periodsPerYear)
+            baselineKeys = _timeKeys(baselinePeriod, self.timeframe)
+            padded[:, (keys < baselineKeys[0]) | (keys > baselineKeys[1])] = np.nan
+        padded = padded.reshape(len(self), years, periodsPerYear)
+        isValid = ~np.isnan(padded)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(isValid, padded, 0.).sum(axis=1) / isValid.sum(axis=1)
+
+    def trend(self):
+        """
+        returns the least squares linear trend of every station in units per year.
+        NaN values are ignored. Stations with fewer than two values are NaN.
+        """
+        years = (self.times - self.times[0]).astype(np.float64) / 365.25
+        isValid = ~np.isnan(self.data)
+        counts = isValid.sum(axis=1)
+        x = np.where(isValid, years, 0.)
+        y = np.where(isValid, self.data, 0.).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            xMean = x.sum(axis=1) / counts
+            yMean = y.sum(axis=1) / counts
+            dx = np.where(isValid, years - xMean[:, None], 0.)
+            slope = (dx * (y - yMean[:, None])).sum(axis=1) / (dx**2).sum(axis=1)
+        slope[counts < 2] = np.nan
+        return slope
+
+    def writeBack(self,stationCollection,dataDescription=None):
+        """
+        copies the values of the cube back to the ClimateVars of the stations. Each
+        station gets the columns of its own record (see spans), so the values keep their dates.
+        The ClimateVars get the unit of the cube.
+
+        Parameters:
+        -----------
+        stationCollection: StationPreprocessor or iterable
+            the stations the cube was made from (or new Station objects with the same ids).
+            Stations that are not in the cube, or don't have the variable, are not changed
+        dataDescription: string
+            the new data description of the ClimateVars, for example "monthly_anomaly".
+            default is None (keep the data description)
+        """
+        stations = stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection
+        for station in stations:
+            if station.stationId not in self.index or self.variable not in station.variables:
+                continue
+            row = self.index[station.stationId]
+            first, last = self.spans[row]
+            climateVariable = station.variables[self.variable]
+            values = self.data[row, first:last+1]
+            if climateVariable.dataDescription != "daily":
+                values = values.astype(np.float64) # means are stored as float64
+            climateVariable.setAll(values.copy(), self.times[first:last+1])
+            climateVariable.unit = self.unit
+            if dataDescription != None:
+                climateVariable.dataDescription = dataDescription
+
+
+def stackStations(stationCollection,variable,timeframe):
+    """
+    returns a DataCube of a variable of the stations. Only ClimateVars holding data of
+    the timeframe are stacked (daily data for "day", monthly means or anomalies for
+    "month", etc...). The cube is in the unit of the first stacked ClimateVar. The values
+    of ClimateVars in other units of the same quantity are converted as they are stacked.
+    see StationPreprocessor.toCube
+
+    Parameters:
+    -----------
+    stationCollection: StationPreprocessor or iterable
+        a StationPreprocessor object, or any iterable of Station objects
+    variable: string
+        the variable name ("TMAX","TMIN","PRCP", etc...)
+    timeframe: string
+        "day", "month", "season" or "year"
+    """
+    if timeframe not in validtimeframes:
+        print("error: did not enter a valid timeframe")
+        print("please enter a timeframe from the following: ")
+        print(validtimeframes)
+        return
+    stations = stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection
+    stationIds = []
+    keys = []
+    values = []
+    units = []
+    for station in stations:
+        if variable in station.variables:
+            climateVariable = station.variables[variable]
+            if climateVariable.dataDescription in cubeDescriptions[timeframe] and len(climateVariable.data) > 0:
+                stationIds.append(station.stationId)
+                keys.append(_timeKeys(climateVariable.days, timeframe))
+                values.append(climateVariable.data)
+                units.append(climateVariable.unit)
+    if len(stationIds) == 0:
+        return DataCube(variable, timeframe, np.zeros((0, 0), dtype=np.float32), [], np.zeros(0, dtype="datetime64[D]"))
+    firstKey = min([k.min() for k in keys])
+    lastKey = max([k.max() for k in keys])
+    data = np.full((len(stationIds), lastKey - firstKey + 1), np.nan, dtype=np.float32)
+    spans = np.zeros((len(stationIds), 2), dtype=np.int64)
+    for i in range(len(stationIds)):
+        columns = keys[i] - firstKey
+        data[i, columns] = values[i]
+        if units[i] != units[0]:
+            conversion.convertArray(data[i, columns.min():columns.max()+1], units[i], units[0]) # in place, a view of the row
+        spans[i] = columns.min(), columns.max()
+    return DataCube(variable, timeframe, data, stationIds, _timeStarts(np.arange(firstKey, lastKey + 1), timeframe), spans, units[0])
+
+def _seasonalCycle(dataCube):
+    """
+    returns the climatology of each station (see DataCube.climatology) spread over
+    the columns of the cube, with the same shape as the cube's data
+    """
+    periodsPerYear = {"month": 12, "season": 4, "year": 1}[dataCube.timeframe]
+    phase = _timeKeys(dataCube.times, dataCube.timeframe) % periodsPerYear
+    return dataCube.climatology()[:, phase]
+
+def _timeKeys(dates,timeframe):
+    """
+    returns the number of the day, month, season or year of each date (see stats._periodKeys).
+    dates can be datetime64, date objects or day numbers (days since 1970-01-01)
+    """
+    dates = np.asarray(dates)
+    if dates.dtype.kind in "iu":
+        dates = dates.astype(np.int64).astype("datetime64[D]")
+    else:
+        dates = np.asarray(dates, dtype="datetime64[D]")
+    if timeframe == "day":
+        return dates.astype(np.int64)
+    return stats._periodKeys(dates, timeframe)
+
+def _timeStarts(keys,timeframe):
+    """
+    returns the first day of each day, month, season or year numbered by _timeKeys
+    """
+    if timeframe == "day":
+        return np.asarray(keys, dtype=np.int64).astype("datetime64[D]")
+    return stats._periodStarts(keys, timeframe)
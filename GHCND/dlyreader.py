@@ -0,0 +1,376 @@
+import zlib
+import numpy as np
+from GHCND import filters
+
+"""
+Reads the fixed width .dly files of the GHCND dataset.
+
+Rather than walking every line character by character, a whole file
+is read into one byte buffer and viewed as a (lines x 269) array of
+characters. All 31 day columns of every line (VALUE, MFLAG, QFLAG, SFLAG)
+are then decoded at once with NumPy, and the filtering criteria are applied
+as boolean masks.
+
+The layout of a line in a .dly file is:
+    ID       1-11   character
+    YEAR    12-15   integer
+    MONTH   16-17   integer
+    ELEMENT 18-21   character
+    VALUE1  22-26   integer
+    MFLAG1  27-27   character
+    QFLAG1  28-28   character
+    SFLAG1  29-29   character
+    ...
+    VALUE31 262-266 integer
+    MFLAG31 267-267 character
+    QFLAG31 268-268 character
+    SFLAG31 269-269 character
+"""
+
+LINE_LENGTH = 269 # number of characters in a line (without the newline)
+NUM_DAYS = 31 # every line holds 31 day values, no matter how many days are in the month
+DAY_WIDTH = 8 # VALUE (5) + MFLAG (1) + QFLAG (1) + SFLAG (1)
+NODATA = -9999
+READ_GAP = 64 * 1024 # runs of unwanted lines up to this many bytes long are read through rather than seeked over
+
+# lookup tables indexed by character code. used to decode integers without python loops
+__digitTable = np.zeros(256, dtype=np.int32) # spaces and the minus sign count as zero
+__digitTable[ord("0"):ord("9")+1] = np.arange(10)
+__signTable = np.ones(256, dtype=np.int32)
+__signTable[ord("-")] = -1
+
+
+def readDlyFile(filename):
+    """
+    reads a .dly file into a two dimensional array of characters
+
+    Parameters:
+    -----------
+    filename: string
+        full file path to the .dly file
+
+    Returns:
+    ---------
+    numpy array of uint8 with shape (number of lines, 269)
+    """
+    infile = open(filename, "rb")
+    buf = infile.read()
+    infile.close()
+    return toCharArray(buf)
+
+
+def toCharArray(buf):
+    """
+    converts the raw contents of a .dly file to a (lines x 269) array of characters.
+
+    The files are fixed width, so in the common case the buffer is
+    viewed in place without copying. Files with windows line endings
+    or short lines are padded line by line.
+    """
+    record = LINE_LENGTH + 1
+    if len(buf) % record == 0:
+        chars = np.frombuffer(buf, dtype=np.uint8).reshape(-1, record)
+        if np.all(chars[:, LINE_LENGTH] == ord("\n")):
+            return chars[:, :LINE_LENGTH]
+    lines = [line.ljust(LINE_LENGTH) for line in buf.splitlines() if line.strip() != b""]
+    if len(lines) == 0:
+        return np.zeros((0, LINE_LENGTH), dtype=np.uint8)
+    return np.frombuffer(b"".join(lines), dtype=np.uint8).reshape(-1, LINE_LENGTH)
+
+
+def parseInts(chars):
+    """
+    decodes right justified integers from an array of characters.
+    the last axis of chars holds the characters of a single integer.
+    """
+    magnitude = np.zeros(chars.shape[:-1], dtype=np.int32)
+    sign = np.ones(chars.shape[:-1], dtype=np.int32)
+    for i in range(chars.shape[-1]): # one pass per character position, not per value
+        column = chars[..., i]
+        magnitude *= 10
+        magnitude += __digitTable[column]
+        sign *= __signTable[column]
+    return magnitude * sign
+
+
+def elementsOf(chars):
+    """
+    returns the element name (TMAX, TMIN, PRCP, etc...) of every line
+    """
+    return np.ascontiguousarray(chars[:, 17:21]).view("S4").ravel()
+
+
+def yearsOf(chars):
+    """
+    returns the year of every line
+    """
+    return parseInts(chars[:, 11:15])
+
+
+def monthsOf(chars):
+    """
+    returns the month of every line as the number of months since January 1970
+    """
+    return (yearsOf(chars) - 1970) * 12 + parseInts(chars[:, 15:17]) - 1
+
+
+def lastMonthStart(chars):
+    """
+    returns the index of the first line of the block of lines at the end of the
+    file that all belong to the file's last month. When NOAA updates a .dly file,
+    the lines of the latest month are rewritten and new months are appended, so
+    every line before this index stays the same.
+    """
+    if len(chars) == 0:
+        return 0
+    months = monthsOf(chars)
+    different = np.nonzero(months != months[-1])[0]
+    if len(different) == 0:
+        return 0
+    return int(different[-1]) + 1
+
+
+def parseLines(chars, variablesOfInterest, filterSpec=None):
+    """
+    decodes the lines of a .dly file.
+
+    Daily data values are set to NaN if they are missing or fail
+    the rules of filterSpec. Day columns that fall past the end of
+    the month are dropped.
+
+    Parameters:
+    -----------
+    chars: numpy array
+        a (lines x 269) array of characters. see readDlyFile
+    variablesOfInterest: list
+        the variables ("TMAX","TMIN","PRCP", etc...) to decode.
+    filterSpec: filters.FilterSpec
+        the rules the values must pass. default is None (filters.DEFAULT_FILTER)
+
+    Returns:
+    ---------
+    dict where the keys are variable names and the values are
+    (data, dates) tuples. data is an array of float64 values and
+    dates is an array of datetime64[D]. Variables that don't appear
+    in the file are not included.
+    """
+    if filterSpec is None:
+        filterSpec = filters.DEFAULT_FILTER
+    out = {}
+    if len(chars) == 0:
+        return out
+    elements = elementsOf(chars)
+    names, firstIdx = np.unique(elements, return_index=True)
+    names = [name for name in names[np.argsort(firstIdx)] if name.decode("ascii").strip() in variablesOfInterest] # keep the order the variables appear in the file
+    if len(names) == 0:
+        return out
+    codes = np.full(len(chars), -1, dtype=np.int32)
+    for i, name in enumerate(names):
+        codes[elements == name] = i
+    order = np.nonzero(codes >= 0)[0]
+    order = order[np.argsort(codes[order], kind="stable")] # the lines of each variable together, in file order
+    lines = chars[order]
+
+    # decode and filter the lines of all the variables as one block
+    days = lines[:, 21:].reshape(-1, NUM_DAYS, DAY_WIDTH)
+    values = parseInts(days[:, :, :5])
+    passed = (values != NODATA) & filterSpec.mask(elements[order], values, days)
+    monthStart = monthsOf(lines).astype("datetime64[M]")
+    firstDay = monthStart.astype("datetime64[D]")
+    daysInMonth = ((monthStart + 1).astype("datetime64[D]") - firstDay).astype(np.int32)
+    inMonth = np.arange(NUM_DAYS) < daysInMonth[:, None] # only process data in the time range of the month
+    data = np.where(passed, values.astype(np.float64), np.nan)[inMonth]
+    dates = (firstDay[:, None] + np.arange(NUM_DAYS))[inMonth]
+
+    lineBounds = np.concatenate([[0], np.cumsum(np.bincount(codes[order], minlength=len(names)))])
+    bounds = np.concatenate([[0], np.cumsum(daysInMonth)])[lineBounds] # where the values of each variable start and end
+    for i, name in enumerate(names):
+        out[name.decode("ascii").strip()] = (data[bounds[i]:bounds[i+1]], dates[bounds[i]:bounds[i+1]])
+    return out
+
+
+def compact(parsed):
+    """
+    converts the output of parseLines to (data, days) tuples where data is a
+    float32 array and days is an int32 array of days since 1970-01-01.
+    The values are integers, so float32 holds them exactly.
+    """
+    out = {}
+    for varName in parsed:
+        data, dates = parsed[varName]
+        out[varName] = (data.astype(np.float32), dates.astype(np.int32))
+    return out
+
+
+def checksum(chars, previous=0):
+    """
+    returns a CRC-32 checksum of the lines in chars (without the newlines).
+    Pass the checksum of the lines before chars as previous to continue it.
+    """
+    return zlib.crc32(np.ascontiguousarray(chars).tobytes(), previous) & 0xffffffff
+
+
+def resumePoint(chars, fileSize, previousChecksum=0):
+    """
+    returns (offset, guard, checksum) for reading only the changed part of the
+    file later. offset is the byte offset of lastMonthStart, guard is the line
+    just before it (with its newline), and checksum is the checksum of all the
+    lines before offset (see checksum). If the bytes before offset still match
+    guard and checksum, everything before offset is unchanged. Returns
+    (None, None, None) if the file is not made of fixed width lines, because then
+    the byte offsets aren't known.
+
+    chars can also be the end of a file. Then fileSize is the size of that end,
+    previousChecksum is the checksum of the lines before it, and the returned
+    offset is relative to the start of chars.
+    """
+    record = LINE_LENGTH + 1
+    if len(chars) * record != fileSize:
+        return None, None, None
+    start = lastMonthStart(chars)
+    if start == 0:
+        return 0, b"", previousChecksum
+    return start * record, chars[start-1].tobytes() + b"\n", checksum(chars[:start], previousChecksum)
+
+
+def blockIndex(chars, fileSize):
+    """
+    indexes the lines of a .dly file without decoding any values. The lines are
+    sorted by element and year, so the lines of one element in one year are a
+    contiguous block of the file.
+
+    Parameters:
+    -----------
+    chars: numpy array
+        a (lines x 269) array of characters. see readDlyFile
+    fileSize: int
+        the size of the file in bytes
+
+    Returns:
+    ---------
+    dict of arrays with one value per block: "element" (S4), "year" (int16),
+    "offset" (int64 byte offset of the first line), "lines" (int32 number of lines),
+    and "firstMonth" and "lastMonth" (int8, 1-12) of the first and last line.
+    Returns None if the file is not made of fixed width lines, because then the
+    byte offsets aren't known.
+    """
+    record = LINE_LENGTH + 1
+    if len(chars) * record != fileSize:
+        return None
+    elements = elementsOf(chars)
+    years = yearsOf(chars)
+    months = parseInts(chars[:, 15:17])
+    starts = np.nonzero(np.concatenate([[True], (elements[1:] != elements[:-1]) | (years[1:] != years[:-1])]))[0] if len(chars) > 0 else np.zeros(0, dtype=np.int64)
+    ends = np.append(starts[1:], len(chars)) # one past the last line of each block
+    return {"element": elements[starts],
+            "year": years[starts].astype(np.int16),
+            "offset": starts.astype(np.int64) * record,
+            "lines": (ends - starts).astype(np.int32),
+            "firstMonth": months[starts].astype(np.int8),
+            "lastMonth": months[ends - 1].astype(np.int8)}
+
+
+def blockRanges(index, variablesOfInterest, startYear=None, endYear=None, gap=READ_GAP):
+    """
+    returns the byte ranges of the lines of each variable in a range of years.
+
+    Parameters:
+    -----------
+    index: dict
+        the block index of a file. see blockIndex
+    variablesOfInterest: list
+        the variables ("TMAX","TMIN","PRCP", etc...) to find
+    startYear: int
+        the first year. default is None (the first year in the file)
+    endYear: int
+        the last year (inclusive). default is None (the last year in the file)
+    gap: int
+        blocks no more than this many bytes apart are read as one range (see mergeRanges)
+
+    Returns:
+    ---------
+    dict where the keys are variable names and the values are (ranges, firstMonth, lastMonth)
+    tuples. ranges is a list of (byte offset, byte length) tuples, and firstMonth and lastMonth
+    are months since January 1970 (see monthsOf). A range can hold lines of other variables,
+    which parseLines skips. Variables with no lines in the years are not included. The
+    variables are in the order they appear in the file.
+    """
+    record = LINE_LENGTH + 1
+    elements = index["element"]
+    keep = np.isin(elements, np.array([varName.encode("ascii") for varName in variablesOfInterest], dtype="S4"))
+    if startYear is not None:
+        keep &= index["year"] >= startYear
+    if endYear is not None:
+        keep &= index["year"] <= endYear
+    blocks = np.nonzero(keep)[0]
+    yearMonths = (index["year"][blocks].astype(np.int64) - 1970) * 12 - 1
+    firstMonths = yearMonths + index["firstMonth"][blocks]
+    lastMonths = yearMonths + index["lastMonth"][blocks]
+    offsets = index["offset"][blocks]
+    ends = offsets + index["lines"][blocks].astype(np.int64) * record
+    names, firstIdx = np.unique(elements[blocks], return_index=True)
+    out = {}
+    for name in names[np.argsort(firstIdx)]:
+        isVar = elements[blocks] == name
+        out[name.decode("ascii").strip()] = (mergeRanges(offsets[isVar], ends[isVar], gap),
+                                     int(firstMonths[isVar].min()), int(lastMonths[isVar].max()))
+    return out
+
+
+def mergeRanges(starts, ends, gap=READ_GAP):
+    """
+    merges byte ranges that overlap or are no more than gap bytes apart, so the lines
+    in between are read through instead of seeking over them.
+
+    Parameters:
+    -----------
+    starts: numpy array
+        the first byte of each range
+    ends: numpy array
+        one past the last byte of each range
+
+    Returns:
+    ---------
+    a list of (byte offset, byte length) tuples, sorted by offset
+    """
+    if len(starts) == 0:
+        return []
+    order = np.argsort(starts, kind="stable")
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    ends = np.maximum.accumulate(np.asarray(ends, dtype=np.int64)[order])
+    breaks = np.nonzero(starts[1:] - ends[:-1] > gap)[0]
+    first = np.concatenate([starts[:1], starts[breaks + 1]])
+    last = np.concatenate([ends[breaks], ends[-1:]])
+    return list(zip(first.tolist(), (last - first).tolist()))
+
+
+def elementRanges(chars, variablesOfInterest, fileSize):
+    """
+    finds the lines of each variable without decoding any values. Returns the same
+    as blockRanges, or None if the file is not made of fixed width lines (see blockIndex)
+    """
+    index = blockIndex(chars, fileSize)
+    if index is None:
+        return None
+    return blockRanges(index, variablesOfInterest)
+
+
+def readRanges(filename, ranges):
+    """
+    reads only the given byte ranges of a .dly file (see elementRanges) into a
+    (lines x 269) array of characters
+    """
+    infile = open(filename, "rb")
+    parts = []
+    for offset, length in ranges:
+        infile.seek(offset)
+        parts.append(infile.read(length))
+    infile.close()
+    return toCharArray(b"".join(parts))
+
+
+def parseDlyFile(filename, variablesOfInterest, filterSpec=None):
+    """
+    reads and decodes a .dly file. see parseLines
+    """
+    return parseLines(readDlyFile(filename), variablesOfInterest, filterSpec)
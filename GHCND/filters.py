@@ -0,0 +1,161 @@
+import json
+import hashlib
+import numpy as np
+
+"""
+The rules that decide which daily values of the .dly files are kept.
+
+Every day value in a .dly file has a measurement flag (MFLAG), a quality flag
+(QFLAG) and a source flag (SFLAG). A FilterSpec lists the flags that are
+accepted and the physical range of each element. Values that fail any rule
+are set to NaN when the lines are decoded (see dlyreader.parseLines).
+
+The rules are compiled once, when the FilterSpec is made: each flag rule
+becomes a 256 entry lookup table indexed by the character code of the flag,
+so checking every value of a whole block of lines is one table lookup per
+flag. The range checks are compared against the raw integer values of the
+lines of each element at once.
+
+The default rules keep the data that passed NOAA's quality assurance and
+come from U.S. and Canadian sources (see DEFAULT_SOURCE_FLAGS). For other
+countries, give the StationPreprocessor different rules:
+    sp.setFilter(filters.FilterSpec(sourceFlags=None, ranges=filters.PHYSICAL_RANGES))
+
+The fingerprint of a FilterSpec identifies its rules. It's stored with the
+cached data and written to the exports, so data filtered by different rules
+is never mixed up.
+"""
+
+# accepted source flags of the default rules:
+# 0 U.S. Cooperative Summary of the Day (NCDC DSI-3200)
+# 6 CDMP Cooperative Summary of the Day (NCDC DSI-3206)
+# 7 U.S. Cooperative Summary of the Day -- Transmitted via WxCoder3 (NCDC DSI-3207)
+# A U.S. Automated Surface Observing System (ASOS) real-time data
+# C Environment Canada
+# G Official Global Climate Observing System (GCOS) or other government-supplied data
+# R NCEI Reference Network Database (Climate Reference Network and Regional Climate Reference Network)
+DEFAULT_SOURCE_FLAGS = ["0","6","7","A","C","G","R"]
+DEFAULT_QUALITY_FLAGS = [" "] # only values that did not fail a quality assurance check
+
+# plausible limits of some elements, in the units of the .dly files (tenths of
+# degrees C, tenths of mm for PRCP, mm for SNOW and SNWD). Just beyond the world records
+PHYSICAL_RANGES = {"TMAX": (-900, 600),
+                   "TMIN": (-900, 600),
+                   "TAVG": (-900, 600),
+                   "PRCP": (0, 20000),
+                   "SNOW": (0, 2000),
+                   "SNWD": (0, 12000)}
+
+
+class FilterSpec(object):
+
+    def __init__(self,sourceFlags=DEFAULT_SOURCE_FLAGS,qualityFlags=DEFAULT_QUALITY_FLAGS,measurementFlags=None,ranges=None):
+        """
+        Parameters:
+        -----------
+        sourceFlags: list
+            the accepted source flags (one character each, " " for no flag). default is
+            DEFAULT_SOURCE_FLAGS. None accepts every source
+        qualityFlags: list
+            the accepted quality flags. default is [" "] (values that passed every quality
+            assurance check). None accepts every value, even the ones that failed a check
+        measurementFlags: list
+            the accepted measurement flags. default is None (every measurement flag)
+        ranges: dict
+            element name -> (minimum, maximum) of the accepted values (inclusive), in the
+            units of the .dly files. see PHYSICAL_RANGES. default is None (no range checks)
+        """
+        self.sourceFlags = None if sourceFlags is None else sorted(set(sourceFlags))
+        self.qualityFlags = None if qualityFlags is None else sorted(set(qualityFlags))
+        self.measurementFlags = None if measurementFlags is None else sorted(set(measurementFlags))
+        self.ranges = {}
+        if ranges is not None:
+            for element in ranges:
+                self.ranges[element] = (int(ranges[element][0]), int(ranges[element][1]))
+        # compiled rules. None means the rule accepts everything and is skipped
+        self.__tables = [(column, _flagTable(flags)) for column, flags in
+                         [(5, self.measurementFlags), (6, self.qualityFlags), (7, self.sourceFlags)] if flags is not None]
+        self.__ranges = [(element.ljust(4).encode("ascii"), low, high) for element, (low, high) in sorted(self.ranges.items())]
+        self.__fingerprint = hashlib.sha1(json.dumps(self.toDict(), sort_keys=True).encode("ascii")).hexdigest()[:16]
+
+    def mask(self,elements,values,days):
+        """
+        returns a boolean array that is True for the values that pass every rule
+
+        Parameters:
+        -----------
+        elements: numpy array
+            the element name of every line (see dlyreader.elementsOf)
+        values: numpy array
+            the decoded integer values, with shape (lines, 31)
+        days: numpy array
+            the characters of the day columns, with shape (lines, 31, 8): VALUE (5), MFLAG, QFLAG and SFLAG
+        """
+        passed = np.ones(values.shape, dtype=bool)
+        for column, table in self.__tables:
+            passed &= table[days[:, :, column]]
+        for element, low, high in self.__ranges:
+            rows = elements == element
+            if rows.any():
+                passed[rows] &= (values[rows] >= low) & (values[rows] <= high)
+        return passed
+
+    def fingerprint(self):
+        """
+        returns a short string that identifies the rules. Data filtered with a different
+        fingerprint was filtered differently
+        """
+        return self.__fingerprint
+
+    def toDict(self):
+        """
+        returns the rules as a dictionary that can be written to JSON. FilterSpec(**rules) makes them again
+        """
+        return {"sourceFlags": self.sourceFlags,
+                "qualityFlags": self.qualityFlags,
+                "measurementFlags": self.measurementFlags,
+                "ranges": dict([(element, list(self.ranges[element])) for element in self.ranges])}
+
+    def __eq__(self,other):
+        return isinstance(other, FilterSpec) and self.fingerprint() == other.fingerprint()
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__fingerprint)
+
+    def __str__(self):
+        return json.dumps(self.toDict(), sort_keys=True)
+
+
+def loadFilterSpec(filename):
+    """
+    reads a FilterSpec from a JSON file holding the rules (see FilterSpec.toDict).
+    Rules missing from the file keep their default
+    """
+    infile = open(filename, "r")
+    rules = json.load(infile)
+    infile.close()
+    return FilterSpec(**rules)
+
+def describe(filterSpec):
+    """
+    returns what an export records about the rules its data was filtered with:
+    {"fingerprint": ..., "rules": ...}. filterSpec can be None (the default rules)
+    """
+    if filterSpec is None:
+        filterSpec = DEFAULT_FILTER
+    return {"fingerprint": filterSpec.fingerprint(), "rules": filterSpec.toDict()}
+
+def _flagTable(flags):
+    """
+    returns a lookup table indexed by the character code of a flag that is True for the accepted flags
+    """
+    table = np.zeros(256, dtype=bool)
+    for flag in flags:
+        table[ord(flag)] = True
+    return table
+
+
+DEFAULT_FILTER = FilterSpec()
@@ -0,0 +1,261 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from GHCND import cube
+from GHCND import conversion
+from GHCND import neighbors
+
+"""
+Fills the gaps (NaN values) of monthly, seasonal or annual series in process,
+instead of exporting the stations with exportToDat and running an external
+gap filling tool.
+
+The series of one variable of all the stations are stacked into a DataCube
+(see the cube module), and every method fills the gaps of all the stations at
+once. Only the gaps inside each station's record are filled. The methods are
+applied in order, and each one only fills what the methods before it left
+missing, so a method that can't fill every gap can be followed by one that can:
+    gapfill.fillGaps(sp, "TMAX", "month", ["ssa", "seasonal", "climatology"])
+
+The methods are:
+- "climatology": the mean of the same calendar month (or season) of the station,
+    from the observed values only (not the ones filled by earlier methods)
+- "linear": linear interpolation between the values before and after the gap
+- "seasonal": linear interpolation of the anomalies from the climatology, plus
+    the climatology. Follows the seasonal cycle through the gap
+- "ssa": iterative singular spectrum analysis (the method of the ssa-mtm
+    toolkit). The gaps start as the climatology and are replaced by the
+    reconstruction from the leading components of the lag covariance matrix of
+    the station's anomalies until they converge. The lag covariance matrices of
+    a batch of stations are decomposed in one batched call, and the
+    reconstructions are batched matrix products
+- "neighbor": the regressions of the station's anomalies on the anomalies of
+    its best correlated neighbors that have a value (see the neighbors module)
+
+The filled values are written back to the ClimateVars, and each ClimateVar's
+fillFlags record how every value was filled (see OBSERVED and methodFlags).
+"""
+
+OBSERVED = 0 # the fill flag of a value that wasn't filled
+validmethods = ["climatology","linear","seasonal","ssa","neighbor"]
+methodFlags = {"climatology": 1, "linear": 2, "seasonal": 3, "ssa": 4, "neighbor": 5} # the fill flag of the values filled by each method
+defaultWindows = {"month": 24, "season": 8, "year": 8} # the SSA window (in periods) of each timeframe
+periodsPerYear = {"month": 12, "season": 4, "year": 1}
+
+
+def fillGaps(stationCollection,variable,timeframe="month",methods=["seasonal","climatology"],maxGap=None,window=None,components=4,maxIterations=50,tolerance=1e-3,batchSize=256,graph=None):
+    """
+    fills the gaps of a variable of all the stations and writes the filled series back
+    to the ClimateVars, with their fill flags. Only ClimateVars holding means (or anomalies)
+    of the timeframe are filled. Periods a series doesn't have between its first and last
+    value are added as gaps.
+
+    Parameters:
+    -----------
+    stationCollection: StationPreprocessor or list
+        a StationPreprocessor object, or a list of Station objects
+    variable: string
+        the variable name ("TMAX","TMIN","PRCP", etc...)
+    timeframe: string
+        "month", "season" or "year". default is "month"
+    methods: list
+        the methods to apply in order (see validmethods). default is ["seasonal","climatology"]
+    maxGap: int
+        the longest gap (in periods) the "linear" and "seasonal" methods fill. default is None (any gap)
+    window: int
+        the SSA window (the number of lags) in periods. default is None (see defaultWindows)
+    components: int
+        the number of leading SSA components used to reconstruct the gaps. default is 4
+    maxIterations: int
+        the maximum number of SSA iterations. default is 50
+    tolerance: float
+        SSA stops when no filled value changes by more than this many standard deviations of
+        the station's anomalies. default is 1e-3
+    batchSize: int
+        the number of stations decomposed at once by SSA. Bounds the memory used. default is 256
+    graph: neighbors.NeighborGraph
+        the neighbors of the stations, for the "neighbor" method. default is None (a graph of the
+        stations is built with neighbors.buildGraph when "neighbor" is one of the methods)
+
+    Returns:
+    ---------
+    (dataCube, flags). The filled cube.DataCube and a uint8 array with the fill flag of every
+    value of the cube (OBSERVED outside the stations' records)
+    """
+    stations = list(stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection)
+    dataCube = cube.stackStations(stations, variable, timeframe)
+    if dataCube is None:
+        return
+    if "neighbor" in methods and graph is None:
+        graph = neighbors.buildGraph(stations)
+    oldFlags = __stackFlags(dataCube, stations)
+    newFlags = fillCube(dataCube, methods, maxGap, window, components, maxIterations, tolerance, batchSize, graph)
+    if newFlags is None:
+        return
+    flags = np.where(oldFlags != OBSERVED, oldFlags, newFlags) # values filled before keep their flags
+    __writeFilled(dataCube, stations, newFlags)
+    for station in stations:
+        if station.stationId in dataCube.index and variable in station.variables:
+            row = dataCube.index[station.stationId]
+            first, last = dataCube.spans[row]
+            station.variables[variable].fillFlags = flags[row, first:last+1].copy()
+    return dataCube, flags
+
+def fillCube(dataCube,methods=["seasonal","climatology"],maxGap=None,window=None,components=4,maxIterations=50,tolerance=1e-3,batchSize=256,graph=None):
+    """
+    fills the gaps in the records of the stations of a cube.DataCube in place (a cube that
+    is a read only view of a store gets a new array). The arguments are the same as fillGaps.
+
+    Returns:
+    ---------
+    a uint8 array with the fill flag of every value of the cube
+    """
+    if dataCube.timeframe not in periodsPerYear:
+        print("error: gaps can only be filled in monthly, seasonal or annual data")
+        return
+    for method in methods:
+        if method not in validmethods:
+            print("error: did not enter a valid method")
+            print("please enter methods from the following: ")
+            print(validmethods)
+            return
+    if "neighbor" in methods and graph is None:
+        print("error: the neighbor method needs the graph of the stations (see neighbors.buildGraph)")
+        return
+    if not dataCube.data.flags.writeable:
+        dataCube.data = np.array(dataCube.data)
+    data = dataCube.data
+    flags = np.zeros(data.shape, dtype=np.uint8)
+    if data.size == 0:
+        return flags
+    columns = np.arange(data.shape[1])
+    inSpan = (columns >= dataCube.spans[:, :1]) & (columns <= dataCube.spans[:, 1:])
+    climatology = None
+    if any(method != "linear" for method in methods) and (np.isnan(data) & inSpan).any():
+        climatology = cube._seasonalCycle(dataCube) # before any method runs, so it's the climatology of the observed values only
+    for method in methods:
+        isGap = np.isnan(data) & inSpan
+        if not isGap.any():
+            break
+        if method == "climatology":
+            filled = climatology
+        elif method == "linear":
+            filled = _interpolate(data, maxGap)
+        elif method == "seasonal":
+            filled = _interpolate(data - climatology, maxGap) + climatology
+        elif method == "neighbor":
+            filled = graph.predict(dataCube, climatology=climatology)
+        else:
+            filled = np.full(data.shape, np.nan)
+            rows = np.nonzero(isGap.any(axis=1))[0] # stations without gaps aren't decomposed
+            if window is None:
+                window = defaultWindows[dataCube.timeframe]
+            for i in range(0, len(rows), batchSize):
+                batch = rows[i:i+batchSize]
+                anomalies = _ssaFill(data[batch] - climatology[batch], inSpan[batch], window, components, maxIterations, tolerance)
+                filled[batch] = anomalies + climatology[batch]
+        fill = isGap & ~np.isnan(filled)
+        data[fill] = filled[fill]
+        flags[fill] = methodFlags[method]
+    return flags
+
+def __writeFilled(dataCube,stations,newFlags):
+    """
+    writes the values filled in the cube (newFlags is not OBSERVED) into the ClimateVars of the
+    stations. The observed values keep their own array and precision (the cube is float32), and
+    the periods the ClimateVars don't have inside their records are added
+    """
+    firstKey = cube._timeKeys(dataCube.times[:1], dataCube.timeframe)[0]
+    for station in stations:
+        if station.stationId not in dataCube.index or dataCube.variable not in station.variables:
+            continue
+        row = dataCube.index[station.stationId]
+        first, last = dataCube.spans[row]
+        isFilled = newFlags[row, first:last+1] != OBSERVED
+        climateVariable = station.variables[dataCube.variable]
+        columns = cube._timeKeys(climateVariable.days, dataCube.timeframe) - firstKey - first
+        if not isFilled.any() and len(columns) == last - first + 1:
+            continue
+        conversion.convertVariable(climateVariable, dataCube.unit) # stackStations converted the cube's copy
+        dtype = climateVariable.data.dtype if climateVariable.data.dtype.kind == "f" else np.float64
+        values = np.full(last - first + 1, np.nan, dtype=dtype)
+        values[columns] = climateVariable.data
+        values[isFilled] = dataCube.data[row, first:last+1][isFilled]
+        climateVariable.setAll(values, dataCube.times[first:last+1])
+
+def __stackFlags(dataCube,stations):
+    """
+    returns the fill flags the ClimateVars of the cube already have, on the cube's grid
+    """
+    flags = np.zeros(dataCube.data.shape, dtype=np.uint8)
+    for station in stations:
+        if station.stationId in dataCube.index and dataCube.variable in station.variables:
+            climateVariable = station.variables[dataCube.variable]
+            if climateVariable.fillFlags is not None:
+                row = dataCube.index[station.stationId]
+                flags[row, cube._timeKeys(climateVariable.days, dataCube.timeframe) - cube._timeKeys(dataCube.times[:1], dataCube.timeframe)[0]] = climateVariable.fillFlags
+    return flags
+
+def _interpolate(data,maxGap=None):
+    """
+    returns data with every gap between two values linearly interpolated, for all the rows at
+    once. Gaps before the first or after the last value of a row, and gaps longer than maxGap,
+    are left NaN.
+    """
+    rows, length = data.shape
+    columns = np.arange(length)
+    isValid = ~np.isnan(data)
+    before = np.maximum.accumulate(np.where(isValid, columns, -1), axis=1) # the last valid column at or before each column
+    after = np.minimum.accumulate(np.where(isValid, columns, length)[:, ::-1], axis=1)[:, ::-1] # the first valid column at or after
+    inside = (before >= 0) & (after < length)
+    if maxGap is not None:
+        inside &= (after - before - 1) <= maxGap
+    before = np.where(inside, before, 0)
+    after = np.where(inside, after, 0)
+    left = np.take_along_axis(data, before, axis=1)
+    right = np.take_along_axis(data, after, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = (columns - before) / (after - before).astype(np.float64)
+        filled = np.where(isValid, data, left + (right - left) * weight)
+    filled[~inside] = np.nan
+    return filled
+
+def _ssaFill(anomalies,inSpan,window,components,maxIterations,tolerance):
+    """
+    fills the gaps of a batch of anomaly series (rows) by iterative SSA and returns the filled
+    anomalies. Only lag vectors entirely inside a row's record (inSpan) are used, so the rows
+    can have records of any length. Rows whose record is shorter than window are left as they are.
+    """
+    rows, length = anomalies.shape
+    lags = length - window + 1
+    if lags < 1:
+        return anomalies
+    isGap = np.isnan(anomalies) & inSpan
+    scale = np.sqrt(np.nanmean(np.where(inSpan, anomalies, np.nan)**2, axis=1))
+    scale[~(scale > 0)] = 1.
+    x = np.where(isGap | ~inSpan, 0., anomalies) / scale[:, None] # the gaps start at the climatology (anomaly 0)
+    useLag = sliding_window_view(inSpan, window, axis=1).all(axis=2) # (rows x lags) lag vectors entirely inside the record
+    counts = np.zeros((rows, length)) # how many lag vectors hold each column, for the diagonal averaging
+    for m in range(window):
+        counts[:, m:m+lags] += useLag
+    update = isGap & (counts > 0)
+    active = np.nonzero(update.any(axis=1))[0] # rows that haven't converged yet
+    components = min(components, window)
+    for iteration in range(maxIterations):
+        if len(active) == 0:
+            break
+        trajectory = sliding_window_view(x[active], window, axis=1) * useLag[active, :, None] # (rows x lags x window)
+        covariance = np.matmul(trajectory.transpose(0, 2, 1), trajectory) / useLag[active].sum(axis=1)[:, None, None]
+        values, vectors = np.linalg.eigh(covariance) # in ascending order of the eigenvalues
+        leading = vectors[:, :, -components:]
+        reconstructed = np.matmul(np.matmul(trajectory, leading), leading.transpose(0, 2, 1)) # (rows x lags x window)
+        series = np.zeros((len(active), length))
+        for m in range(window):
+            series[:, m:m+lags] += reconstructed[:, :, m]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            series /= counts[active]
+        gaps = update[active]
+        change = np.where(gaps, np.abs(series - x[active]), 0.).max(axis=1)
+        x[active] = np.where(gaps, series, x[active])
+        active = active[change >= tolerance]
+    filled = x * scale[:, None]
+    return np.where(update, filled, anomalies)
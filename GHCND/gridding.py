@@ -0,0 +1,212 @@
+import numpy as np
+import osgeo.gdal as gdal
+import osgeo.osr as osr
+from GHCND import cube
+from GHCND import neighbors
+
+"""
+Interpolates the monthly, seasonal or annual values of the stations onto a
+regular lat/lon grid, one grid per time step.
+
+A Gridder holds the grid and the weights of the stations of every grid cell.
+The stations around each cell center are found with the spatial grid of the
+neighbors module (see neighbors.nearest), once, and the weights are kept as a
+sparse matrix in compressed sparse row (CSR) form: the stations of cell i are
+indices[indptr[i]:indptr[i+1]], nearest first, with their weights in weights.
+Gridding a cube applies the same matrix to every time step: the values of a
+batch of time steps are gathered for every entry of the matrix and summed by
+cell, so nothing is searched or weighted again per time step.
+
+The methods are:
+- "idw": inverse distance weighting of the k nearest stations that have a value
+- "nearest": the value of the nearest of the k nearest stations that has one
+
+Stations without a value at a time step are left out of that time step, and
+the weights of the others are normalized again. Cells with no station within
+radius (if it's given) are NaN.
+
+The grids are written to a memory mapped .npy file with shape (times, rows,
+columns), row 0 at the north, so they don't have to fit in memory, and can be
+written to a GeoTIFF with one band per time step:
+    gridder, grids, times = gridding.gridStations(sp, "TMAX", "month", (24., -125., 50., -66.), 0.25,
+                                                  filename="D:/GHCND_data/tmax.npy")
+    gridder.writeGeoTIFF("D:/GHCND_data/tmax.tif", grids, times)
+"""
+
+validmethods = ["idw","nearest"]
+MIN_DISTANCE = 1e-3 # km. A station closer to a cell center than this is weighted as if it were this close
+
+
+class Gridder(object):
+
+    def __init__(self,initStationIds,initLats,initLons,initBounds,initResolution,initMethod="idw",initK=8,initPower=2.,initRadius=None):
+        """
+        Parameters:
+        -----------
+        initStationIds: list
+            the station ids
+        initLats, initLons: array
+            the latitude and longitude of each station in decimal degrees
+        initBounds: tuple
+            (minLat, minLon, maxLat, maxLon) of the grid in decimal degrees
+        initResolution: float
+            the size of the grid cells in degrees
+        initMethod: string
+            "idw" or "nearest". default is "idw"
+        initK: int
+            the number of nearest stations of each cell. default is 8
+        initPower: float
+            the power of the inverse distance weights. default is 2
+        initRadius: float
+            stations further than this (km) from a cell center are not used. default is None (no limit)
+        """
+        if initMethod not in validmethods:
+            print("error: did not enter a valid method")
+            print("please enter a method from the following: ")
+            print(validmethods)
+            return
+        self.stationIds = list(initStationIds)
+        self.method = initMethod
+        self.k = initK
+        self.power = initPower
+        self.radius = initRadius
+        minLat, minLon, maxLat, maxLon = initBounds
+        self.resolution = initResolution
+        self.rows = int(round((maxLat - minLat) / initResolution))
+        self.columns = int(round((maxLon - minLon) / initResolution))
+        self.bounds = (minLat, minLon, minLat + self.rows * initResolution, minLon + self.columns * initResolution)
+        self.lats = self.bounds[2] - (np.arange(self.rows) + 0.5) * initResolution # the cell centers, north first
+        self.lons = minLon + (np.arange(self.columns) + 0.5) * initResolution
+
+        cellLats = np.repeat(self.lats, self.columns)
+        cellLons = np.tile(self.lons, self.rows)
+        indices, distances = neighbors.nearest(initLats, initLons, cellLats, cellLons, initK)
+        isUsed = np.ones(indices.shape, dtype=bool)
+        if initRadius is not None:
+            isUsed = distances <= initRadius
+        if initMethod == "idw":
+            weights = (np.maximum(distances[:, :1], MIN_DISTANCE) / np.maximum(distances, MIN_DISTANCE))**initPower # relative to the nearest station, so they are at most 1
+        else:
+            weights = np.ones(distances.shape)
+        self.indptr = np.concatenate([[0], np.cumsum(isUsed.sum(axis=1))]).astype(np.int64)
+        self.indices = indices[isUsed].astype(np.int32) # the rows are still nearest first
+        self.weights = weights[isUsed]
+
+    def __len__(self):
+        return self.rows * self.columns
+
+    def geoTransform(self):
+        """
+        returns the GDAL geotransform of the grid: (west, resolution, 0, north, 0, -resolution)
+        """
+        return (self.bounds[1], self.resolution, 0., self.bounds[2], 0., -self.resolution)
+
+    def grid(self,dataCube,filename=None,batchSize=64):
+        """
+        returns the grids of every time step of a cube.DataCube, as a float32 array with shape
+        (times, rows, columns). Row 0 is the north edge of the grid
+
+        Parameters:
+        -----------
+        dataCube: cube.DataCube
+            the values of the stations. Stations that aren't in the Gridder are not used
+        filename: string
+            the .npy file the grids are written to, as a memory map. default is None (in memory)
+        batchSize: int
+            the number of time steps gridded at once. Bounds the memory used. default is 64
+        """
+        times = dataCube.data.shape[1]
+        if filename is not None:
+            grids = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32, shape=(times, self.rows, self.columns))
+        else:
+            grids = np.zeros((times, self.rows, self.columns), dtype=np.float32)
+        stationRows = np.array([dataCube.index.get(s, -1) for s in self.stationIds], dtype=np.int64)
+        entryRows = stationRows[self.indices] # the row of the cube of every entry of the matrix (-1 if the station isn't in the cube)
+        isInCube = (entryRows >= 0)[:, None]
+        entryRows = np.maximum(entryRows, 0)
+        hasStations = np.nonzero(np.diff(self.indptr) > 0)[0]
+        starts = self.indptr[hasStations] # empty cells are skipped, so each sum covers exactly one cell's entries
+        positions = np.arange(len(self.indices))
+        weights = self.weights.astype(np.float32)[:, None]
+        for first in range(0, times, batchSize):
+            last = min(first + batchSize, times)
+            values = dataCube.data[entryRows, first:last] # (entries x time steps)
+            isValid = ~np.isnan(values) & isInCube
+            result = np.full((len(self), last - first), np.nan, dtype=np.float32)
+            if len(starts) > 0:
+                if self.method == "idw":
+                    w = np.where(isValid, weights, np.float32(0))
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        result[hasStations] = np.add.reduceat(w * np.where(isValid, values, np.float32(0)), starts, axis=0) / np.add.reduceat(w, starts, axis=0)
+                else: # the first valid entry of each cell is its nearest station with a value
+                    firstValid = np.minimum.reduceat(np.where(isValid, positions[:, None], len(positions)), starts, axis=0)
+                    isFound = firstValid < self.indptr[hasStations + 1][:, None]
+                    found = np.where(isFound, values[np.minimum(firstValid, len(positions) - 1), np.arange(last - first)], np.nan)
+                    result[hasStations] = found
+            grids[first:last] = result.T.reshape(last - first, self.rows, self.columns)
+        if filename is not None:
+            grids.flush()
+        return grids
+
+    def writeGeoTIFF(self,filename,grids,times=None,compress=True):
+        """
+        writes grids (see grid) to a GeoTIFF with one float32 band per time step, in WGS84.
+        NaN is the nodata value
+
+        Parameters:
+        -----------
+        filename: string
+            the output .tif file
+        grids: array
+            the grids, with shape (times, rows, columns)
+        times: array
+            the date of each grid, written as the description of its band. default is None
+        compress: boolean
+            deflate compress the bands. default is True
+        """
+        driver = gdal.GetDriverByName("GTiff")
+        options = ["COMPRESS=DEFLATE"] if compress else []
+        dataset = driver.Create(filename, self.columns, self.rows, len(grids), gdal.GDT_Float32, options)
+        dataset.SetGeoTransform(self.geoTransform())
+        spatialRef = osr.SpatialReference()
+        spatialRef.SetWellKnownGeogCS("WGS84")
+        dataset.SetProjection(spatialRef.ExportToWkt())
+        for i in range(len(grids)):
+            band = dataset.GetRasterBand(i + 1)
+            band.SetNoDataValue(float("nan"))
+            if times is not None:
+                band.SetDescription(str(np.datetime64(times[i], "D")))
+            band.WriteArray(np.asarray(grids[i]))
+        dataset.FlushCache()
+        dataset = None # closes the file
+
+
+def gridStations(stationCollection,variable,timeframe,bounds,resolution,method="idw",k=8,power=2.,radius=None,filename=None):
+    """
+    grids a variable of the stations. Returns (gridder, grids, times): the Gridder, the grids
+    (see Gridder.grid) and the date of each grid
+
+    Parameters:
+    -----------
+    stationCollection: StationPreprocessor or list
+        a StationPreprocessor object, or a list of Station objects
+    variable: string
+        the variable name ("TMAX","TMIN","PRCP", etc...)
+    timeframe: string
+        "month", "season" or "year"
+    bounds: tuple
+        (minLat, minLon, maxLat, maxLon) of the grid in decimal degrees
+    resolution: float
+        the size of the grid cells in degrees
+    method, k, power, radius:
+        see Gridder
+    filename: string
+        the .npy file the grids are written to, as a memory map. default is None (in memory)
+    """
+    stations = list(stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection)
+    dataCube = cube.stackStations(stations, variable, timeframe)
+    if dataCube is None:
+        return
+    gridder = Gridder([s.stationId for s in stations], [s.lat for s in stations], [s.lon for s in stations],
+                      bounds, resolution, method, k, power, radius)
+    return gridder, gridder.grid(dataCube, filename), dataCube.times
@@ -0,0 +1,392 @@
+import os
+import json
+import hashlib
+import numpy as np
+from GHCND import catalog
+from GHCND import cube
+
+"""
+A k nearest neighbor graph of stations, for filling the gaps of a station from
+the stations around it.
+
+The graph is built from the lat, lon and elevation of the stations. The
+distance between two stations is the great circle distance, with the
+elevation difference added as a vertical distance (see elevationWeight). The
+stations are bucketed into the 1 by 1 degree cells of the catalog's grid, and
+the neighbors of the stations of a cell are only searched in the cells around
+it, so building the graph doesn't compare every pair of stations.
+
+The graph is kept in compressed sparse row (CSR) form: the neighbors of the
+station in row i are indices[indptr[i]:indptr[i+1]], in order of distance,
+with their distances in distances.
+
+The statistics of every edge (the correlation, the regression of the station's
+anomalies on its neighbor's, and the number of periods both have a value) are
+computed once for the stacked cube of a variable and kept with the graph.
+They are computed for the edges of a batch of stations at once over the whole
+station x time stack. The predictions of a station's gaps are the regressions
+of its best correlated neighbors that have a value, weighted by how much of
+the variance they explain. They are also made for a batch of stations at once.
+
+The graph and the statistics are saved to graphFile, if it's given, and loaded
+from it in the next session as long as the stations didn't change:
+    graph = neighbors.buildGraph(sp, 8, graphFile="D:/GHCND_data/neighbors.npz")
+    gapfill.fillGaps(sp, "TMAX", "month", ["neighbor", "seasonal", "climatology"], graph=graph)
+"""
+
+DEGREE_KM = catalog.EARTH_RADIUS * np.pi / 180. # km in a degree of latitude
+MISSING_ELEVATION = -999.9 # the elevation of the stations that don't have one in ghcnd-stations.txt
+
+
+class NeighborGraph(object):
+
+    def __init__(self,initStationIds,initLats,initLons,initElevs,initK=8,initElevationWeight=0.1,initGraphFile=None):
+        """
+        Parameters:
+        -----------
+        initStationIds: list
+            the station ids, one per row of the graph
+        initLats, initLons, initElevs: array
+            the latitude, longitude (decimal degrees) and elevation (m) of each station.
+            Elevations of -999.9 (unknown) are not used
+        initK: int
+            the number of neighbors of each station. default is 8
+        initElevationWeight: float
+            km of distance added for each m of elevation difference. default is 0.1
+            (100 m higher counts as 10 km further away)
+        initGraphFile: string
+            where the graph and its statistics are saved. default is None (not saved)
+        """
+        self.stationIds = list(initStationIds)
+        self.lats = np.asarray(initLats, dtype=np.float64)
+        self.lons = np.asarray(initLons, dtype=np.float64)
+        self.elevs = np.asarray(initElevs, dtype=np.float64)
+        self.k = min(initK, max(len(self.stationIds) - 1, 0))
+        self.elevationWeight = initElevationWeight
+        self.graphFile = initGraphFile
+        self.index = dict(zip(self.stationIds, range(len(self.stationIds))))
+        self.statistics = {} # fingerprint of a cube -> statistics of the edges, see edgeStatistics
+
+        self.indptr = None
+        self.indices = None
+        self.distances = None
+        if not self.__load():
+            self.__build()
+            self.__save()
+
+    def __len__(self):
+        return len(self.stationIds)
+
+    def neighborsOf(self,stationId):
+        """
+        returns a list of (stationId, distance in km) of the neighbors of a station, nearest first
+        """
+        row = self.index[stationId]
+        edges = range(self.indptr[row], self.indptr[row+1])
+        return [(self.stationIds[self.indices[e]], float(self.distances[e])) for e in edges]
+
+    def edgeStatistics(self,dataCube,batchSize=1024):
+        """
+        returns the statistics of every edge for the data of a cube.DataCube of monthly,
+        seasonal or annual values, as a dictionary of arrays in the order of indices:
+        "correlation" and "overlap" (the number of periods both stations have a value), and
+        "slope" and "intercept" of the regression of the station's anomalies (from its
+        climatology) on its neighbor's. The statistics are computed once for each cube's data
+        and kept (and saved to the graph file). Edges with a station that isn't in the cube
+        have an overlap of 0.
+        """
+        key = _fingerprint(dataCube)
+        if key in self.statistics:
+            return self.statistics[key]
+        anomalies, isValid, rows = self.__anomalies(dataCube)
+        # the sums over the overlap of both stations of an edge are products of the
+        # station's (valid, x, x^2) with the neighbor's (valid, y, y^2), one matmul per batch
+        features = np.stack([isValid, anomalies], axis=1) # (stations x 2 x times). the squares are made for each batch
+        sums = np.zeros((len(self), 3, self.k, 3))
+        for first in range(0, len(self), batchSize):
+            last = min(first + batchSize, len(self))
+            own = features[rows[first:last]]
+            own = np.concatenate([own, own[:, 1:] ** 2], axis=1)
+            other = features[rows[self.indices[self.indptr[first]:self.indptr[last]]]] # (edges x 2 x times), k edges per station
+            other = np.concatenate([other, other[:, 1:] ** 2], axis=1)
+            other = other.reshape(last - first, self.k * 3, -1).transpose(0, 2, 1)
+            sums[first:last] = np.matmul(own, other).reshape(last - first, 3, self.k, 3)
+        sums = sums.transpose(0, 2, 1, 3).reshape(len(self.indices), 3, 3)
+        n = sums[:, 0, 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            aMean = sums[:, 1, 0] / n
+            bMean = sums[:, 0, 1] / n
+            covariance = sums[:, 1, 1] / n - aMean * bMean
+            aVariance = sums[:, 2, 0] / n - aMean * aMean
+            bVariance = sums[:, 0, 2] / n - bMean * bMean
+            slope = covariance / bVariance
+            statistics = {"correlation": covariance / np.sqrt(aVariance * bVariance),
+                          "overlap": n,
+                          "slope": slope,
+                          "intercept": aMean - slope * bMean}
+        for name in statistics:
+            statistics[name][~np.isfinite(statistics[name])] = 0.
+        self.statistics[key] = statistics
+        self.__save()
+        return statistics
+
+    def predict(self,dataCube,minCorrelation=0.5,minOverlap=60,maxNeighbors=3,climatology=None,batchSize=1024):
+        """
+        returns the predictions of every value of a cube.DataCube from the neighbors of each
+        station, with the same shape as the data. A value is predicted from (at most) the
+        maxNeighbors best correlated neighbors that have a value at that time, as their
+        regressions (see edgeStatistics) weighted by r^2 / (1 - r^2). Values no neighbor can
+        predict, and the stations that aren't in the graph, are NaN.
+
+        Parameters:
+        -----------
+        dataCube: cube.DataCube
+            monthly, seasonal or annual values
+        minCorrelation: float
+            neighbors less correlated than this are not used. default is 0.5
+        minOverlap: int
+            neighbors with fewer periods in common are not used. default is 60
+        maxNeighbors: int
+            the number of neighbors a value is predicted from. default is 3
+        climatology: array
+            the climatology of each station spread over the columns of the cube.
+            default is None (calculated from the cube)
+        batchSize: int
+            the number of stations predicted at once. Bounds the memory used. default is 1024
+        """
+        if climatology is None:
+            climatology = cube._seasonalCycle(dataCube)
+        statistics = self.edgeStatistics(dataCube, batchSize)
+        anomalies, isValid, rows = self.__anomalies(dataCube, climatology)
+        predictions = np.full(dataCube.data.shape, np.nan)
+        if self.k == 0:
+            return predictions
+        correlation = statistics["correlation"]
+        useEdge = (correlation >= minCorrelation) & (statistics["overlap"] >= minOverlap)
+        weight = np.where(useEdge, correlation**2 / np.maximum(1. - correlation**2, 1e-6), 0.)
+        edges = np.arange(len(self.indices)).reshape(len(self), self.k) # every row has k neighbors
+        edges = np.take_along_axis(edges, np.argsort(-weight[edges], axis=1, kind="mergesort"), axis=1) # the best correlated first
+        edgeWeight = weight[edges].astype(np.float32)
+        edgeSlope = (weight * statistics["slope"])[edges].astype(np.float32)
+        edgeIntercept = (weight * statistics["intercept"])[edges].astype(np.float32)
+        isValid = isValid.astype(bool)
+        for first in range(0, len(self), batchSize):
+            last = min(first + batchSize, len(self))
+            batch = np.arange(first, last)[rows[first:last] < len(dataCube)] # the stations in the cube
+            if len(batch) == 0:
+                continue
+            neighborRows = rows[self.indices[edges[batch]]]
+            isUsed = isValid[neighborRows] & (edgeWeight[batch] > 0)[:, :, None] # (stations x k x times)
+            isUsed &= np.cumsum(isUsed, axis=1, dtype=np.int16) <= maxNeighbors
+            used = isUsed.astype(np.float32)
+            # sum over the neighbors of weight * (slope * anomaly + intercept), and of weight
+            numerator = np.einsum("skt,sk,skt->st", used, edgeSlope[batch], anomalies[neighborRows]) + np.einsum("skt,sk->st", used, edgeIntercept[batch])
+            denominator = np.einsum("skt,sk->st", used, edgeWeight[batch])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                predictions[rows[batch]] = numerator / denominator + climatology[rows[batch]]
+        return predictions
+
+    def __anomalies(self,dataCube,climatology=None):
+        """
+        returns the anomalies of the cube from each station's climatology as float32, with the
+        missing values set to 0 and a row of zeros appended, the matching float32 array that is
+        1 for the values that aren't missing, and the row of every station of the graph (the
+        appended row for the stations that aren't in the cube)
+        """
+        if climatology is None:
+            climatology = cube._seasonalCycle(dataCube)
+        anomalies = np.zeros((len(dataCube) + 1, dataCube.data.shape[1]), dtype=np.float32)
+        anomalies[:-1] = dataCube.data - climatology
+        isValid = ~np.isnan(anomalies)
+        isValid[-1] = False
+        anomalies[~isValid] = 0.
+        rows = np.array([dataCube.index.get(s, len(dataCube)) for s in self.stationIds], dtype=np.int64)
+        return anomalies, isValid.astype(np.float32), rows
+
+    def __build(self):
+        """
+        finds the k nearest neighbors of every station (see nearest)
+        """
+        n = len(self)
+        self.indptr = np.arange(n + 1, dtype=np.int64) * self.k
+        self.indices = np.zeros(n * self.k, dtype=np.int32)
+        self.distances = np.zeros(n * self.k, dtype=np.float32)
+        if self.k == 0:
+            return
+        indices, distances = nearest(self.lats, self.lons, self.lats, self.lons, self.k, self.elevs, self.elevs, self.elevationWeight, True)
+        self.indices[:] = indices.ravel()
+        self.distances[:] = distances.ravel()
+
+    def __key(self):
+        """
+        identifies the stations and parameters of the graph, so a saved graph of other stations isn't loaded
+        """
+        h = hashlib.sha1(json.dumps([self.stationIds, self.k, self.elevationWeight]).encode("utf-8"))
+        for column in [self.lats, self.lons, self.elevs]:
+            h.update(column.tobytes())
+        return h.hexdigest()
+
+    def __save(self):
+        if self.graphFile is None:
+            return
+        arrays = {"indptr": self.indptr, "indices": self.indices, "distances": self.distances}
+        for key in self.statistics:
+            for name in self.statistics[key]:
+                arrays["statistics_" + key + "_" + name] = self.statistics[key][name]
+        arrays["meta"] = np.array(json.dumps({"key": self.__key(), "statistics": sorted(self.statistics)}))
+        try:
+            outfile = open(self.graphFile, "wb")
+            np.savez(outfile, **arrays)
+            outfile.close()
+        except (IOError, OSError): # the graph still works, it just won't be saved for the next session
+            pass
+
+    def __load(self):
+        """
+        loads the graph and statistics saved in the graph file. Returns False if there is no
+        saved graph of these stations
+        """
+        if self.graphFile is None or not os.path.isfile(self.graphFile):
+            return False
+        try:
+            npz = np.load(self.graphFile)
+            arrays = dict([(k, npz[k]) for k in npz.files])
+            npz.close()
+        except (IOError, ValueError):
+            return False
+        meta = json.loads(str(arrays["meta"]))
+        if meta["key"] != self.__key():
+            return False
+        self.indptr = arrays["indptr"]
+        self.indices = arrays["indices"]
+        self.distances = arrays["distances"]
+        for key in meta["statistics"]:
+            self.statistics[key] = dict([(name, arrays["statistics_" + key + "_" + name])
+                                         for name in ["correlation", "overlap", "slope", "intercept"]])
+        return True
+
+
+def buildGraph(stationCollection,k=8,elevationWeight=0.1,graphFile=None):
+    """
+    returns the NeighborGraph of the stations
+
+    Parameters:
+    -----------
+    stationCollection: StationPreprocessor or list
+        a StationPreprocessor object, or a list of Station objects
+    k: int
+        the number of neighbors of each station. default is 8
+    elevationWeight: float
+        km of distance added for each m of elevation difference. default is 0.1
+    graphFile: string
+        where the graph and its statistics are saved. default is None (not saved)
+    """
+    stations = list(stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection)
+    return NeighborGraph([s.stationId for s in stations], [s.lat for s in stations], [s.lon for s in stations],
+                         [s.elev for s in stations], k, elevationWeight, graphFile)
+
+def nearest(lats,lons,queryLats,queryLons,k,elevs=None,queryElevs=None,elevationWeight=0.,excludeSelf=False):
+    """
+    returns the k nearest points of each query point, as (indices, distances) arrays with shape
+    (queries, k), nearest first. distances are in km. The points are bucketed into the catalog's
+    grid. The queries of a grid cell are compared with the points in the square of cells around
+    it, and the square grows until the kth nearest point of each query is closer than any point
+    outside it can be.
+
+    Parameters:
+    -----------
+    lats, lons: array
+        the points in decimal degrees
+    queryLats, queryLons: array
+        the query points in decimal degrees
+    k: int
+        the number of nearest points. If there are fewer points (minus 1 with excludeSelf),
+        all of them are returned
+    elevs, queryElevs: array
+        the elevations (m) of the points and query points, used with elevationWeight. default is None
+    elevationWeight: float
+        km of distance added for each m of elevation difference. default is 0 (not used)
+    excludeSelf: boolean
+        the query points are the points, and a point isn't its own nearest point. default is False
+    """
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    queryLats, queryLons = np.asarray(queryLats, dtype=np.float64), np.asarray(queryLons, dtype=np.float64)
+    if not elevationWeight:
+        elevs = queryElevs = None
+    k = max(min(k, len(lats) - int(excludeSelf)), 0)
+    indices = np.zeros((len(queryLats), k), dtype=np.int64)
+    distances = np.zeros((len(queryLats), k))
+    i, j = catalog._gridCell(lats, lons)
+    cells = i * catalog.GRID_COLUMNS + j
+    gridOrder = np.argsort(cells, kind="mergesort")
+    sortedCells = cells[gridOrder]
+    i, j = catalog._gridCell(queryLats, queryLons)
+    queryCells = i * catalog.GRID_COLUMNS + j
+    queryOrder = np.argsort(queryCells, kind="mergesort")
+    occupied, starts, counts = np.unique(queryCells[queryOrder], return_index=True, return_counts=True)
+    if k == 0:
+        return indices, distances
+    for cell, start, count in zip(occupied, starts, counts):
+        members = queryOrder[start:start+count]
+        cellRow, cellColumn = divmod(int(cell), catalog.GRID_COLUMNS)
+        radius = 1
+        while True:
+            candidates, isEverything = _window(gridOrder, sortedCells, cellRow, cellColumn, radius)
+            if len(candidates) >= k + excludeSelf:
+                d = catalog.distance(queryLats[members][:, None], queryLons[members][:, None], lats[candidates][None, :], lons[candidates][None, :])
+                if elevs is not None:
+                    e1 = np.asarray(queryElevs, dtype=np.float64)[members][:, None]
+                    e2 = np.asarray(elevs, dtype=np.float64)[candidates][None, :]
+                    height = np.where((e1 > MISSING_ELEVATION) & (e2 > MISSING_ELEVATION), (e1 - e2) * elevationWeight, 0.)
+                    d = np.sqrt(d * d + height * height)
+                if excludeSelf:
+                    d[members[:, None] == candidates[None, :]] = np.inf
+                closest = np.argpartition(d, k - 1, axis=1)[:, :k]
+                closestDistances = np.take_along_axis(d, closest, axis=1)
+                if isEverything or closestDistances.max() <= _searchedDistance(cellRow, radius):
+                    break
+            radius *= 2
+        order = np.argsort(closestDistances, axis=1, kind="mergesort")
+        indices[members] = candidates[np.take_along_axis(closest, order, axis=1)]
+        distances[members] = np.take_along_axis(closestDistances, order, axis=1)
+    return indices, distances
+
+def _window(gridOrder,sortedCells,cellRow,cellColumn,radius):
+    """
+    returns the stations in the square of grid cells within radius cells of a cell (the
+    longitudes wrap around), and whether the square covers the whole grid
+    """
+    rows = np.arange(max(cellRow - radius, 0), min(cellRow + radius, catalog.GRID_ROWS - 1) + 1)
+    if 2 * radius + 1 >= catalog.GRID_COLUMNS:
+        ranges = [(0, catalog.GRID_COLUMNS - 1)]
+    elif cellColumn - radius < 0:
+        ranges = [(0, cellColumn + radius), (cellColumn - radius + catalog.GRID_COLUMNS, catalog.GRID_COLUMNS - 1)]
+    elif cellColumn + radius >= catalog.GRID_COLUMNS:
+        ranges = [(cellColumn - radius, catalog.GRID_COLUMNS - 1), (0, cellColumn + radius - catalog.GRID_COLUMNS)]
+    else:
+        ranges = [(cellColumn - radius, cellColumn + radius)]
+    slices = []
+    for first, last in ranges: # the cells first to last of a grid row are next to each other in gridOrder
+        starts = np.searchsorted(sortedCells, rows * catalog.GRID_COLUMNS + first)
+        ends = np.searchsorted(sortedCells, rows * catalog.GRID_COLUMNS + last + 1)
+        slices += [gridOrder[s:e] for s, e in zip(starts, ends)]
+    isEverything = len(rows) == catalog.GRID_ROWS and ranges == [(0, catalog.GRID_COLUMNS - 1)]
+    return np.concatenate(slices), isEverything
+
+def _searchedDistance(cellRow,radius):
+    """
+    returns the shortest distance (km) from a point in a grid cell to a point outside the square
+    of cells within radius cells of it. No station outside the square is closer
+    """
+    latitude = max(abs(cellRow - 90), abs(cellRow + 1 - 90)) # the latitude of the cell's edge nearest a pole
+    toMeridian = catalog.EARTH_RADIUS * np.arcsin(np.sin(np.radians(min(radius, 90))) * np.cos(np.radians(latitude)))
+    return min(radius * DEGREE_KM, toMeridian)
+
+def _fingerprint(dataCube):
+    """
+    identifies the data of a cube: its variable, timeframe, stations, dates and values
+    """
+    h = hashlib.sha1(json.dumps([dataCube.variable, dataCube.timeframe, list(dataCube.stationIds)]).encode("utf-8"))
+    h.update(np.ascontiguousarray(dataCube.times).tobytes())
+    h.update(np.ascontiguousarray(dataCube.data).tobytes())
+    return h.hexdigest()[:16]
@@ -1,11 +1,21 @@
-import datetime
-import calendar
 import os
 import time
 import json
+import tarfile
+import collections
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 import osgeo.ogr as ogr
 import osgeo.osr as osr
+from GHCND import dlyreader
+from GHCND import filters
+from GHCND import cache
+from GHCND import catalog
+from GHCND import cube
+from GHCND import store
+from GHCND import columnar
+from GHCND import stats
+from GHCND import conversion
 
 """
 High level description of how this is used. It's easy to think of
@@ -29,13 +39,18 @@ a list of variables you are interested in. Note: this loads a lot of data
 into main memory (in some cases 120 years of daily data).
 Be wise about how many countries and states you use to
 define the stations. Furthermore, be wise about how many variables
-you would like data for. (perhaps at a later date I will incorporate
- file and data queues so large amounts of data can be
-processed without the user having to manually chunk up data themselves).
+you would like data for.
 At the end of this step your StationPreprocessor will contain all the
 stations you have defined and all their daily data for the variables 
 you defined.
 
+To process large amounts of data without chunking it up yourself, use
+iterStations(vars) instead. It yields one parsed and filtered station at a
+time. The stats, conversion and export functions can all consume the stations
+one at a time. For example:
+    stations = sp.iterStations(["TMAX","TMIN"])
+    sp.exportToJSON(filename, stats.iterMeans(stations, "month"))
+
 The next step is convert the daily data to monthly means. To do this,
 you must use the GHCND.stats module. At present, the stats module only
 supports monthly mean calculation for temperature and precipitation.
@@ -43,11 +58,12 @@ supports monthly mean calculation for temperature and precipitation.
 over the month)
 
 Behind the scenes there has been some filtering going on to remove unwanted
-data. The current hard-coded settings for filtering and reading the data are:
-(These hard-coded settings should be modified if you are interested in data outside
-Canada and the United States)
+data. The default rules for filtering the data are listed below. They are made
+for stations in Canada and the United States. If you are interested in data
+outside Canada and the United States, give the StationPreprocessor other rules
+with setFilter (see the filters module) before reading the data.
 
-Daily data values that do not pass this criteria are set to NaN
+Daily data values that do not pass these rules are set to NaN
 1. only include data that has passed the quality check of NOAA NCDC
 2. only include data from the sources:
     - U.S. Cooperative Summary of the Day
@@ -86,6 +102,14 @@ There are three ways of exporting:
         metadata for each file. 
 """
 
+# the attributes of the points written by exportToShapefile and exportToGeoPackage
+VECTOR_VARIABLES = ["TMAX","TMIN","PRCP"] # a 0/1 field and the first and last date are written for each
+VECTOR_FIELDS = ([("name", ogr.OFTString), ("stationID", ogr.OFTString), ("country", ogr.OFTString), ("state", ogr.OFTString),
+                  ("lat", ogr.OFTReal), ("lon", ogr.OFTReal), ("elev", ogr.OFTReal)] +
+                 [field for varName in VECTOR_VARIABLES for field in [(varName, ogr.OFTInteger), (varName + "_Begin", ogr.OFTString), (varName + "_End", ogr.OFTString)]] +
+                 [("hcn", ogr.OFTInteger), ("crn", ogr.OFTInteger), ("gsn", ogr.OFTInteger), ("wmoID", ogr.OFTString)])
+VECTOR_TRANSACTION_SIZE = 50000 # features written per transaction, for drivers that support transactions
+
 
 class StationPreprocessor(object):
     
@@ -98,11 +122,20 @@ class StationPreprocessor(object):
         initInventoryMetadata: string
             full file path to the ghcnd inventory metadata file (ghcnd-inventory.txt)
         initDlyFileDirectory: string
-            path to the directory holding the ghcnd dly files (ghcnd_all)
+            path to the directory holding the ghcnd dly files (ghcnd_all), or to the
+            ghcnd_all.tar.gz (or .tar) archive itself. An archive is read without
+            extracting it (see iterStations)
         """
         self.stationsFile = initStationsMetadata
         self.inventoryFile = initInventoryMetadata
         self.dlyFileDir = initDlyFileDirectory
+        self.cache = None # a cache.DlyCache of parsed .dly files. see setCache
+        self.dlyVersions = {} # the version of each station's .dly file that was read when using the cache. see refreshDlyFiles
+        self.dlyYears = {} # the (startYear, endYear) range each station's .dly file was read for, or None. see refreshDlyFiles
+        self.catalog = None # a catalog.StationCatalog of ghcnd-stations.txt. see getCatalog
+        self.inventory = None # a catalog.StationInventory of ghcnd-inventory.txt. see getInventory
+        self.dlyIndex = None # a catalog.DlyIndex of the byte offsets of the lines in the .dly files. see getDlyIndex
+        self.filterSpec = filters.DEFAULT_FILTER # the rules the daily values must pass. see setFilter
         
         self.stations = [] # stations of interest: a list of Station objects
         self.states = [] # a list of state abreviations
@@ -473,76 +506,200 @@ class StationPreprocessor(object):
         self.clearStations()
         self.addStations()
         
-    def addStations(self):
+    def addStations(self,networks=None,wmoIds=None,variables=None,startYear=None,endYear=None):
         """
         Adds stations to the StationPreproccessor's station attribute
+
+        Parameters:
+        -----------
+        networks: list
+            only add stations in at least one of these networks ("HCN", "CRN", "GSN").
+            default is None (don't filter by network)
+        wmoIds: list
+            only add stations with these WMO ids. default is None (don't filter by WMO id)
+        variables: list
+            only add stations that recorded at least one of these variables according
+            to the inventory (ghcnd-inventory.txt). default is None (don't filter by variable)
+        startYear: int
+            only add stations whose record (of one of the variables, if given) reaches
+            this year or later. For example 2016 for stations that are still operating.
+            default is None
+        endYear: int
+            only add stations whose record (of one of the variables, if given) starts
+            in this year or earlier. default is None
         """
         if len(self.countries) == 0:
             print("error: no stations added. must specify countries")
             return
         self.countries.sort()
         self.states.sort()
-        
-        infile = open(self.stationsFile,"r")
-        line = infile.readline()
-        while line != "":
-            if line[:2] in self.countries:
-                newStation = None
-                name = line[41:71].strip() 
-                stationId = line[:11].strip()
-                c = line[:2]
-                s = line[38:40].strip()
-                lat = float(line[12:20].strip())
-                lon = float(line[21:30].strip())
-                elev = float(line[31:37].strip())
-                gsn = line[72:75].strip()
-                hcncrn = line[76:79].strip()
-                wmo = line[80:].strip()
-                if wmo == "":
-                    wmo = None
-                if gsn == "GSN":
-                    gsn = True
-                else:
-                    gsn = False
-                if hcncrn == "HCN":
-                    hcn = True
-                    crn = False
-                elif hcncrn == "CRN":
-                    hcn = False
-                    crn = True
-                else:
-                    hcn = False
-                    crn = False
-                if line[:2] == "CA" or line[:2] == "US": # if the country is the united states or canada, check the state in case there needs to be more filtering
-                    if len(self.states) == 0: # if no states are defined, add all stations for the country
-                        newStation = Station(name,stationId,c,s,lat,lon,elev,hcn,crn,gsn,wmo)
-                    elif s in self.states:    
-                        newStation = Station(name,stationId,c,s,lat,lon,elev,hcn,crn,gsn,wmo)
-                else: # else the country is not canada or the united states and therefore there is no state
-                    newStation = Station(name,stationId,c,None,lat,lon,elev,hcn,crn,gsn,wmo)
-                if newStation != None:
-                    self.stations.append(newStation)
-            line = infile.readline()
-        infile.close()
+        self.__addRows(None, networks, wmoIds, variables, startYear, endYear)
+
+    def addStationsInBBox(self,minLat,minLon,maxLat,maxLon,networks=None,wmoIds=None,variables=None,startYear=None,endYear=None):
+        """
+        Adds the stations inside a bounding box (edges included) to the StationPreproccessor's
+        station attribute. The countries and states of the StationPreprocessor are not used.
+
+        Parameters:
+        -----------
+        minLat, minLon, maxLat, maxLon: float
+            the edges of the box in decimal degrees. If minLon is larger than maxLon,
+            the box crosses the 180th meridian.
+        networks, wmoIds, variables, startYear, endYear:
+            see addStations
+        """
+        rows = self.getCatalog().inBBox(minLat, minLon, maxLat, maxLon)
+        self.__addRows(rows, networks, wmoIds, variables, startYear, endYear)
+
+    def addStationsNear(self,lat,lon,radius,networks=None,wmoIds=None,variables=None,startYear=None,endYear=None):
+        """
+        Adds the stations within a distance of a point to the StationPreproccessor's
+        station attribute. The countries and states of the StationPreprocessor are not used.
+
+        Parameters:
+        -----------
+        lat, lon: float
+            the point in decimal degrees
+        radius: float
+            the great circle distance from the point in km
+        networks, wmoIds, variables, startYear, endYear:
+            see addStations
+        """
+        rows, distances = self.getCatalog().near(lat, lon, radius)
+        self.__addRows(rows, networks, wmoIds, variables, startYear, endYear)
+
+    def __addRows(self,rows,networks,wmoIds,variables,startYear,endYear):
+        """
+        adds the stations in rows of the catalog (or of the countries and states if
+        rows is None) that match the rest of the criteria. see addStations
+        """
+        stationIds = None
+        if variables is not None or startYear is not None or endYear is not None:
+            inventory = self.getInventory()
+            if inventory == None:
+                print("error: no stations added. filtering by variables or years needs the inventory file")
+                return
+            if variables is None: # any variable
+                variables = np.unique(inventory.columns["element"])
+            stationIds = inventory.stationsWith(variables, startYear, endYear)
+
+        stationCatalog = self.getCatalog()
+        if rows is None:
+            rows = stationCatalog.select(self.countries, self.states, networks, wmoIds, stationIds) # rows are in the order of the stations file
+        elif networks is not None or wmoIds is not None or stationIds is not None:
+            rows = np.intersect1d(rows, stationCatalog.select(None, None, networks, wmoIds, stationIds))
+        for args in stationCatalog.stationArgs(rows):
+            self.stations.append(Station(*args))
+
+    def getCatalog(self):
+        """
+        returns the catalog.StationCatalog of the stations metadata file. It is
+        built on first use and saved, so later sessions don't read the text file
+        again. If a cache is set (see setCache) the catalog is saved in the cache
+        directory, otherwise next to the stations metadata file.
+        """
+        if self.catalog == None:
+            catalogFile = None
+            if self.cache != None:
+                catalogFile = os.path.join(self.cache.cacheDir, "ghcnd-stations.catalog")
+            self.catalog = catalog.StationCatalog(self.stationsFile, catalogFile)
+        return self.catalog
+
+    def getInventory(self):
+        """
+        returns the catalog.StationInventory of the inventory metadata file, or None
+        if the file doesn't exist. Like the station catalog (see getCatalog), it is
+        built on first use and saved.
+        """
+        if self.inventory == None and os.path.isfile(self.inventoryFile):
+            inventoryFile = None
+            if self.cache != None:
+                inventoryFile = os.path.join(self.cache.cacheDir, "ghcnd-inventory.catalog")
+            self.inventory = catalog.StationInventory(self.inventoryFile, inventoryFile)
+        return self.inventory
+
+    def getDlyIndex(self):
+        """
+        returns the catalog.DlyIndex of the .dly files: the byte offsets of the lines of
+        each element and year, saved the first time each file is read. Like the catalog
+        (see getCatalog), it is saved in the cache directory if a cache is set, otherwise
+        next to the stations metadata file.
+        """
+        if self.dlyIndex == None:
+            if self.cache != None:
+                indexDir = os.path.join(self.cache.cacheDir, "ghcnd-dly.index")
+            else:
+                indexDir = os.path.join(os.path.dirname(os.path.abspath(self.stationsFile)), "ghcnd-dly.index")
+            self.dlyIndex = catalog.DlyIndex(indexDir)
+        return self.dlyIndex
             
     def clearStations(self):
         self.stations = []
+
+    def setCache(self,cacheDirectory,maxSize=2*1024**3):
+        """
+        keeps the parsed .dly files in an on-disk cache. Later calls to
+        processDlyFiles and iterStations read unchanged files from the cache
+        instead of parsing the text again. see the cache module.
+
+        Parameters:
+        -----------
+        cacheDirectory: string
+            path to the directory that holds the cache
+        maxSize: int
+            the maximum size of the cache in bytes. When it grows past this,
+            the least recently used stations are removed. default is 2 GB
+        """
+        self.cache = cache.DlyCache(cacheDirectory, maxSize, self.filterSpec)
+
+    def setFilter(self,filterSpec=None):
+        """
+        sets the rules the daily values must pass when the .dly files are read
+        (accepted source, quality and measurement flags and the physical range of
+        each element). Values that fail a rule are set to NaN. The rules apply to the
+        following reads. Cached data that was filtered with other rules is parsed again.
+
+        Parameters:
+        -----------
+        filterSpec: filters.FilterSpec
+            the rules. default is None (the default rules, see processDlyFiles)
+        """
+        if filterSpec is None:
+            filterSpec = filters.DEFAULT_FILTER
+        self.filterSpec = filterSpec
+        if self.cache != None:
+            self.cache.filterSpec = filterSpec
+
+    def invalidateCache(self,stationIds=None):
+        """
+        removes stations from the cache so they are parsed again on the next read.
+
+        Parameters:
+        -----------
+        stationIds: list
+            the station IDs to remove. default is None (clear the whole cache)
+        """
+        if self.cache == None:
+            print("error: no cache set. use setCache first")
+            return
+        self.cache.invalidate(stationIds)
         
-    def processDlyFiles(self,variablesOfInterest):
+    def processDlyFiles(self,variablesOfInterest,workers=None,useInventory=True,lazy=False,startYear=None,endYear=None):
         """
         parses the fixed width .dly files associated with each Station object present
         in the StationPreprocessor. For each station, create a ClimateVar object
-        that will store the daily data and datetime objects.
+        that will store the daily data and dates.
         
         Data will only be processed for variables defined by variablesOfInterest.
         If the station does not contain the variable, it will be dropped from
         the StationPreprocessor.
 
         running this function when the station preprocessor has many countries/states
-        consumes a lot of RAM. So in cases where you need to process many states/countries
-        chunk them up.
+        consumes a lot of RAM, because every station is held in memory. To process many
+        states/countries, use iterStations() instead. It yields the stations one at a time.
 
-        Daily data values will only be included if...
+        With the default rules (see setFilter to change them),
+        daily data values will only be included if...
         1) the measurement did not fail the quality assurance check 
         (indicated by the quality flag)
         2) the measurement's source is from one of these:
@@ -571,77 +728,325 @@ class StationPreprocessor(object):
         ----------------
         variablesOfInterest: list
             the data that will be included in the output stations
+        workers: int
+            the number of processes used to parse the .dly files. default is None
+            (the files are parsed one at a time in this process). Each file is parsed
+            independently, so this scales with the number of cores.
+        useInventory: boolean
+            if True (the default) and the inventory file exists, the .dly files of
+            stations that have none of the variablesOfInterest in the inventory are
+            not opened. Those stations would be removed by the filtering anyway.
+            Set this to False if the inventory is older than the .dly files.
+        lazy: boolean
+            if True, the values are not decoded. Each ClimateVar only holds the byte ranges
+            of its lines in the .dly file and its record period, and decodes its values the
+            first time they are used (see ClimateVar.setSource). Only the element and date
+            columns of the files are read, so metadata only work such as exportToShapefile
+            never decodes a value. Lazy variables are not checked for being all NaN, and the
+            cache is not used. default is False
+        startYear: int
+            only read the data from this year on. default is None (from the first year)
+        endYear: int
+            only read the data up to this year (inclusive). default is None (to the last year)
+
+        The first time a .dly file is read, the byte offsets of the lines of each element
+        and year are saved next to the catalog (see getDlyIndex). Later reads of only some
+        variables or years seek to those lines and read nothing else. Files read for a range
+        of years are not added to the cache.
         
         Returns
         ------------
         None
         """
+        if lazy and _isArchive(self.dlyFileDir):
+            print("error: lazy reading needs the extracted .dly files, not an archive")
+            return
+        startprocesstime = time.time()
+        self.stations = [station for station in self.iterStations(variablesOfInterest,workers,useInventory,lazy,startYear,endYear)]
+        print("done reading stations. " + str(len(self.stations)) + " stations left after filtering")
+        print("total data read time: " + str(time.time() - startprocesstime))                                        
+
+    def iterStations(self,variablesOfInterest,workers=None,useInventory=True,lazy=False,startYear=None,endYear=None):
+        """
+        parses the .dly files of the stations in the StationPreprocessor and yields
+        the stations one at a time. Each yielded Station has all its daily data and
+        has passed the same filtering as processDlyFiles (see processDlyFiles). Stations
+        that don't have data for any of the variablesOfInterest are not yielded.
+
+        The stations in the StationPreprocessor are not modified. The yielded Station
+        objects are new objects, so only the stations the caller holds on to stay in memory.
+        This lets any number of stations be processed with a fixed memory ceiling.
+
+        If the StationPreprocessor was given a tar or tar.gz archive instead of a directory,
+        the archive is read in one sequential pass and the stations are yielded in the order
+        their files are stored in the archive, not in the order of the StationPreprocessor.
+        The files of other stations are skipped, and reading stops after the last wanted
+        file. The cache, the line index (see getDlyIndex) and lazy reading need the extracted
+        files, so they aren't used. For example:
+            for station in sp.iterStations(["TMAX","TMIN"]):
+                stats.calculateStationMean(station, "month")
+        or chain the stages:
+            sp.exportToJSON(filename, stats.iterMeans(sp.iterStations(["PRCP"]), "month"))
+
+        Parameters
+        ----------------
+        variablesOfInterest: list
+            the data that will be included in the output stations
+        workers: int
+            the number of processes used to parse the .dly files. see processDlyFiles.
+        useInventory: boolean
+            skip the stations that don't have any of the variablesOfInterest in the
+            inventory. see processDlyFiles.
+        lazy: boolean
+            yield stations with lazy ClimateVars. see processDlyFiles.
+        startYear: int
+            see processDlyFiles.
+        endYear: int
+            see processDlyFiles.
+
+        Returns
+        ------------
+        generator of Station objects
+        """
         count = 0
-        newstationlist = [] # this station list will only contain stations that have recorded data for the variablesOfInterest. (essentially removing stations that didn;t record data we wanted)
-        numberOfStations = len(self.stations)
+        stations = self.stations
+        if useInventory and self.getInventory() != None:
+            withData = set(self.inventory.stationsWith(variablesOfInterest, startYear, endYear).tolist())
+            stations = [station for station in self.stations if station.stationId in withData]
+            if len(stations) < len(self.stations):
+                print("skipping " + str(len(self.stations) - len(stations)) + " stations without the variables in the inventory")
+        numberOfStations = len(stations)
         print("reading " + str(numberOfStations) + " stations")
-        startprocesstime = time.time()
-        for station in self.stations: # iterate through the Station objects
-            infile = open(os.path.join(self.dlyFileDir,station.stationId + ".dly"))
-            line = infile.readline()
-            datacount = 0
-            varinfile = False
-            while line != "":
-                dataIdx = 21 # add 8 to get to the next data value
-                qFlagIdx = 27 # add 8 to get the qFlag for the next data value
-                sFlagIdx = 28 # add 8 to get the sFlag for the next data value. (source flag).
-                # only include data that does not fail the quality assurance check (QFLAG1 must be blank (i.e. line[27] == " "))
-                # other specifications could exist. For example, checking the MFLAG (measurement flag) or SFLAGE (source flag)
-                curYear = int(line[11:15].strip())
-                curMonth = int(line[15:17].strip())
-                curDay = 1
-                varName = line[17:21].strip() # TAVG, TMAX, TMIN, PRCP, etc...
-                if varName in variablesOfInterest: # only process the stations that have the variables of interest. Otherwise, skip them
-                    varinfile = True
-                    if varName not in station.variables: # if variable not already in the station variables, create it
-                        station.variables[varName] = ClimateVar(varName, "daily")
-                    while dataIdx <= 261: # the last dataIdx is 261. iterate through the file line appending data and datetime objects to the ClimateVar object
-                        if curDay <= calendar.monthrange(curYear,curMonth)[1]: # only process data in the time range of the month.
-                            value = float(line[dataIdx:dataIdx+5].strip()) # the data value occupies 4 spaces in the txt, so slice appropriately.
-                            qFlag = line[qFlagIdx] # the qFlag occupies only 1 space in the txt
-                            sFlag = line[sFlagIdx] # the sFlag occupies only 1 space in the txt
-                            # source flag must be coop summary of the day, asos network, environment canada, or global observing system
-                            if qFlag == " " and value != -9999 and sFlag in ["0","6","7","A","C","G","R"]: # only include data passing quality assurance, and data that is not NoData
-                                station.variables[varName].data.append(value)
-                                station.variables[varName].timelist.append(datetime.date(year=curYear,month=curMonth,day=curDay))
-                                datacount+=1
-                            else:
-                                station.variables[varName].data.append(np.nan) # if it didn't pass the quality assurance or it was NoData, append NaN
-                                station.variables[varName].timelist.append(datetime.date(year=curYear,month=curMonth,day=curDay))
-                                datacount+=1
-                        dataIdx+=8
-                        qFlagIdx+=8
-                        sFlagIdx+=8
-                        curDay+=1
-                line = infile.readline()
-            infile.close()
-            #print("file processed: " + (os.path.join(self.dlyFileDir,station.stationId + ".dly")) + " time to process: " + str(time.time() - s))
+        years = None
+        if startYear != None or endYear != None:
+            years = (startYear, endYear)
+        archive = _isArchive(self.dlyFileDir)
+        if archive:
+            if lazy:
+                print("error: lazy reading needs the extracted .dly files, not an archive")
+                return
+            byId = dict([(station.stationId, station) for station in stations])
+            members = _archiveMembers(self.dlyFileDir, set(byId))
+            pairs = ((byId[stationId], parsed) for stationId, parsed in _parseDlyFiles(members, _readDlyMember, (variablesOfInterest, years, self.filterSpec), workers))
+        else:
+            filenames = [os.path.join(self.dlyFileDir,station.stationId + ".dly") for station in stations]
+            reader = _scanDlyFile if lazy else _readDlyFile
+            args = (variablesOfInterest, self.cache, self.getDlyIndex(), years, self.filterSpec)
+            pairs = zip(stations, _parseDlyFiles(filenames, reader, args, workers))
+        for station, parsed in pairs: # iterate through the Station objects
+            newStation = station.copyMetadata()
+            if self.cache != None and not archive: # remember which version of the file the data came from
+                self.dlyVersions[station.stationId] = self.cache.version(filenames[count])
+                self.dlyYears[station.stationId] = years
+            if lazy: # the ClimateVars were made by _scanDlyFile
+                newStation.variables = parsed
+                parsed = {}
+            for varName in parsed: # only the variables of interest are returned by the parser
+                data, days = parsed[varName]
+                # filter out all variables with only nan values
+                if np.nansum(data, dtype=np.float64) > 0: # if there are real values in the data (not just NaN)
+                    newStation.variables[varName] = ClimateVar(varName, "daily")
+                    newStation.variables[varName].setAll(data, days)
             count+=1
             if count % 200 == 0: # print a status report every so often. count is the number of stations processed
                 print("done with " + str(count) + " stations. " + str(int((count / float(numberOfStations))*100)) + "% complete.")
-            if len(station.variables) > 0: # append the station to the new list only if it has variables with recorded data
-                newstationlist.append(station)
-        
-        finalStationList = []
-        for s in newstationlist: # filter out all variables with only nan values and all stations with only nan values
-            newVarDict = {} # rebuild the station's variable dictionary. Only include variables that include valid values (not all nan)
-            for v in s.variables:
-                if np.nansum(s.variables[v].data) > 0: # if there are real values in the data (not just NaN)
-                    newVarDict[v] = ClimateVar(v,"daily")
-                    newVarDict[v].setAll(s.variables[v].data, s.variables[v].timelist)
-            s.variables = newVarDict
-            if s not in finalStationList and len(s.variables) > 0: # only append the station if it has variables that don't have all nan
-                finalStationList.append(s)
-        self.stations = finalStationList
-        print("done reading stations. " + str(len(self.stations)) + " stations left after filtering")
-        print("total data read time: " + str(time.time() - startprocesstime))                                        
+            if len(newStation.variables) > 0: # only yield the station if it has variables with recorded data that isn't all nan
+                yield newStation
+        if self.cache != None and not archive:
+            self.cache.evict()
     
-    def exportToDat(self,out_dir):
+    def refreshDlyFiles(self,verify=True):
+        """
+        brings the data of the stations in the StationPreprocessor up to date after
+        the .dly files were downloaded again. This needs a cache (see setCache) that
+        was filled when the data was first read.
+
+        NOAA republishes the .dly files daily, but only rewrites the lines of the latest
+        month and appends new ones. For each .dly file that changed, only the lines past
+        the byte offset stored in the cache are parsed, and the new values are added
+        to the existing variables. Daily variables are extended and monthly means
+        (see stats.calculateMean) are recalculated only for the new months. Files that were
+        changed in other ways are read again in full.
+
+        Only the variables the stations already have are updated. Stations and variables
+        that were dropped by the filtering in processDlyFiles are not added back. The years
+        outside the startYear and endYear the files were read with are not added either.
+
+        Only daily variables and monthly means can be updated. If any station has seasonal
+        or annual means or anomalies, nothing is refreshed: read the .dly files again and
+        recalculate them instead.
+
+        Parameters
+        ----------------
+        verify: boolean
+            if True (the default), the unchanged part of each file is checked against a
+            checksum, so changes to older lines are caught and the file is parsed in full.
+            This still reads the whole file but only parses the new lines. If False, the
+            older lines are trusted to be unchanged and are not read at all.
+
+        Returns
+        ------------
+        None
+        """
+        if self.cache == None:
+            print("error: no cache set. refreshing needs the cache from the first read. use setCache first")
+            return
+        if _isArchive(self.dlyFileDir):
+            print("error: refreshing needs the extracted .dly files, not an archive")
+            return
+        for station in self.stations:
+            for varName in station.variables:
+                if station.variables[varName].dataDescription not in ["daily","monthly_mean"]:
+                    print("error: " + station.stationId + " " + varName + " holds " + station.variables[varName].dataDescription + " data. only daily data and monthly means can be refreshed")
+                    print("please read the .dly files again with processDlyFiles and recalculate the means or anomalies")
+                    return
+        count = 0
+        updated = 0
+        reparsed = 0
+        startprocesstime = time.time()
+        for station in self.stations:
+            filename = os.path.join(self.dlyFileDir,station.stationId + ".dly")
+            variables = list(station.variables)
+            years = self.dlyYears.get(station.stationId)
+            tail = self.cache.refresh(filename, self.dlyVersions.get(station.stationId), verify)
+            replaceAll = tail == None
+            if replaceAll: # can't be updated incrementally. read the whole file and replace everything
+                tail = _readDlyFile(filename, variables, self.cache, self.getDlyIndex(), years, self.filterSpec)
+                reparsed+=1
+            else:
+                if len(tail) > 0:
+                    updated+=1
+                tail = _clipYears(tail, years) # new lines past endYear are left out
+            for varName in tail:
+                if varName not in station.variables:
+                    continue
+                data, days = tail[varName]
+                climateVariable = station.variables[varName]
+                if climateVariable.dataDescription == "daily": # the new values are in the units of the .dly files
+                    data = conversion.convertArray(data, conversion.nativeUnit(varName), climateVariable.unit)
+                if replaceAll:
+                    climateVariable.setAll(np.zeros(0, dtype=data.dtype), np.zeros(0, dtype="datetime64[D]"))
+                if climateVariable.dataDescription == "daily":
+                    climateVariable.replaceFrom(data, days)
+                else:
+                    stats.updateMean(climateVariable, data, days)
+            self.dlyVersions[station.stationId] = self.cache.version(filename)
+            count+=1
+            if count % 200 == 0: # print a status report every so often
+                print("done with " + str(count) + " stations. " + str(int((count / float(len(self.stations)))*100)) + "% complete.")
+        self.cache.evict()
+        print("updated " + str(updated) + " stations. parsed " + str(reparsed) + " stations in full")
+        print("total refresh time: " + str(time.time() - startprocesstime))
+
+    def toCube(self,variable,timeframe):
+        """
+        returns a cube.DataCube: one dense float32 array of a variable of all the stations,
+        with one row per station and a time axis shared by all the stations. Use it for
+        calculations across stations, then write the results back with DataCube.writeBack.
+
+        Parameters:
+        -----------
+        variable: string
+            the variable name ("TMAX","TMIN","PRCP", etc...)
+        timeframe: string
+            "day" for daily data, or "month", "season" or "year" for means (see stats.calculateMean)
+            and anomalies. Stations without data of the timeframe for the variable are left out.
+        """
+        return cube.stackStations(self, variable, timeframe)
+
+    def buildStore(self,directory,variablesOfInterest,timeframes=["day","month"],startDate=None,endDate=None,workers=None):
+        """
+        parses the .dly files of the stations in the StationPreprocessor and writes their
+        data to an on-disk store (see the store module), one station at a time, so the
+        collection never has to fit in memory. Later sessions open the store with openStore
+        instead of parsing the text again. The stations in the StationPreprocessor are not modified.
+
+        Parameters:
+        -----------
+        directory: string
+            path to the directory of the store. An existing store there is replaced
+        variablesOfInterest: list
+            the variables to store (see processDlyFiles)
+        timeframes: list
+            "day" for the daily data and any of "month", "season" and "year" for the means,
+            which are calculated with stats.calculateMeans. default is ["day","month"]
+        startDate: date
+            the first day of the time axis. default is None (January 1 of the first year
+            of the variables in the inventory)
+        endDate: date
+            the last day of the time axis. default is None (December 31 of the last year
+            of the variables in the inventory)
+        workers: int
+            see processDlyFiles
+
+        Returns:
+        ---------
+        the opened store.CubeStore
+        """
+        if startDate is None or endDate is None:
+            inventory = self.getInventory()
+            if inventory == None:
+                print("error: no store built. startDate and endDate are needed when there is no inventory file")
+                return
+            c = inventory.columns
+            rows = np.isin(c["stationId"], [station.stationId for station in self.stations]) & np.isin(c["element"], variablesOfInterest)
+            if rows.sum() == 0:
+                print("error: no store built. none of the stations have the variables in the inventory")
+                return
+            if startDate is None:
+                startDate = np.datetime64(str(c["firstYear"][rows].min()) + "-01-01")
+            if endDate is None:
+                endDate = np.datetime64(str(c["lastYear"][rows].max()) + "-12-31")
+        stationArgs = [(s.name,s.stationId,s.country,s.state,s.lat,s.lon,s.elev,s.hcn,s.crn,s.gsn,s.wmoId) for s in self.stations]
+        writer = store.StoreWriter(directory, stationArgs, variablesOfInterest, timeframes, startDate, endDate, self.filterSpec)
+        meanTimeframes = [timeframe for timeframe in timeframes if timeframe != "day"]
+        for station in self.iterStations(variablesOfInterest, workers):
+            if "day" in timeframes:
+                writer.writeStation(station, "day")
+            if len(meanTimeframes) > 0:
+                means = stats.calculateMeans([station], meanTimeframes)
+                for timeframe in meanTimeframes:
+                    for meanStation in means[timeframe]:
+                        writer.writeStation(meanStation, timeframe)
+        return writer.close()
+
+    def openStore(self,directory,variables=None,timeframe="day"):
+        """
+        opens a store written by buildStore and replaces the stations in the StationPreprocessor
+        with the stations of the store. No text is parsed.
+
+        Parameters:
+        -----------
+        directory: string
+            path to the directory of the store
+        variables: list
+            variables to give the stations as ClimateVars. Their data are views into the
+            store's files, so they are only read from disk when used. default is None
+            (the stations have no variables. Slice the store instead)
+        timeframe: string
+            the timeframe of the variables ("day", "month", "season" or "year"). default is "day"
+
+        Returns:
+        ---------
+        the store.CubeStore. Use its cube method to slice it by station, variable and date range
+        """
+        cubeStore = store.CubeStore(directory)
+        self.stations = [Station(*args) for args in cubeStore.stationArgs()]
+        if variables is not None:
+            description = {"day": "daily", "month": "monthly_mean", "season": "seasonal_mean", "year": "annual_mean"}[timeframe]
+            for varName in variables:
+                dataCube = cubeStore.cube(varName, timeframe)
+                if dataCube is None:
+                    continue
+                for row, station in enumerate(self.stations):
+                    first, last = dataCube.spans[row]
+                    if last >= first:
+                        station.variables[varName] = ClimateVar(varName, description)
+                        station.variables[varName].unit = dataCube.unit # None for stores written without units
+                        station.variables[varName].setAll(dataCube.data[row, first:last+1], dataCube.times[first:last+1])
+        return cubeStore
+
+    def exportToDat(self,out_dir,stations=None):
         """
         will write every station in the StationPreprocessor to a .dat file 
         for gap filling in the ssa-mtm toolkit.
@@ -649,12 +1054,17 @@ class StationPreprocessor(object):
         A dat file here is a file with a single column of data
         This also writes out a metadata file. The output filename is the same as the 
         data's station ID and variable. 
+
+        stations can be any iterable of Station objects (for example the generator
+        returned by iterStations). default is None (the stations in the StationPreprocessor)
         """
+        if stations == None:
+            stations = self.stations
         if os.path.isfile(os.path.join(out_dir,"metadata_log.txt")): # the log file already exists, append to it.
             outmetadata = open(os.path.join(out_dir,"metadata_log.txt"),"a")
         else:
             outmetadata = open(os.path.join(out_dir,"metadata_log.txt"),"w")
-        for station in self.stations:
+        for station in stations:
             for var in station.variables:
                 out_filename = station.stationId + "_" + var + ".dat"
                 outmetadata.write(str(station) + "," + str(station.variables[var]) + "\n") # keep a log of meteadata about each file. this includes the station and variable information
@@ -665,133 +1075,516 @@ class StationPreprocessor(object):
                 	else:
                 		outfile.write(str(value))
                 	outfile.write("\n")     
+                outfile.close()
+        outmetadata.close()
 
-    def exportToJSON(self,filename):
-        outfile = open(filename,"w")
+    def exportToJSON(self,filename,stations=None,layout="object"):
         """ 
         will write the station and climate var data to json 
         this data is not geographic though. it will be queried based
         on stationId
+
+        stations can be any iterable of Station objects (for example the generator
+        returned by iterStations). default is None (the stations in the StationPreprocessor).
+        The file is written one station at a time, so only one station's data
+        is held in memory.
+
+        layout is one of:
+        "object" (the default): one JSON object keyed by stationId
+        "ndjson": one line per station, {"stationId": ..., "variables": {...}}. An index
+            (filename + ".index.json") holds the byte offset and length of each station's
+            line, so a web page can fetch a single station with an HTTP range request
+        "sharded": filename is a directory that gets one file per station (stationId + ".json")
+            and an index.json manifest with the file, location and variables of every station,
+            so a web page only downloads the index and the stations it shows
+        The "ndjson" and "sharded" layouts encode the arrays straight from the numpy buffers
+        and write missing values as null. Their index records the filter rules of the
+        StationPreprocessor (see setFilter) under "filter".
         """
-        outdata = {}
-        for station in self.stations:
-            outdata[station.stationId] = {}
+        if stations == None:
+            stations = self.stations
+        if layout == "ndjson":
+            _exportNDJSON(filename, stations, self.filterSpec)
+            return
+        if layout == "sharded":
+            _exportJSONShards(filename, stations, self.filterSpec)
+            return
+        if layout != "object":
+            print("error: did not enter a valid layout")
+            print("please enter a layout from the following: ")
+            print(["object","ndjson","sharded"])
+            return
+        outfile = open(filename,"w")
+        outfile.write("{")
+        first = True
+        for station in stations:
+            stationdata = {}
             for var in station.variables:
-                # datetime objects and numpy arrays are not json serializeable
-                outdata[station.stationId][var] = {"data": [val for val in station.variables[var].data],
-                                                    "timelist": [str(time)[:-9] for time in station.variables[var].timelist]}
-        json_string = json.dumps(outdata)
-        outfile.write(json_string)
+                # numpy arrays are not json serializeable
+                stationdata[var] = {"data": station.variables[var].data.tolist(),
+                                    "timelist": np.datetime_as_string(station.variables[var].timelist).tolist()}
+            if not first:
+                outfile.write(", ")
+            outfile.write(json.dumps(station.stationId) + ": " + json.dumps(stationdata))
+            first = False
+        outfile.write("}")
         outfile.close()
 
+    def exportToColumnar(self,directory,stations=None,rowGroupSize=1000000,compress=False):
+        """
+        will write the climate var data in long format (one row per stationId, variable,
+        date and value) to a directory of columnar row groups. see the columnar module.
+        Read it back with columnar.ColumnarReader, which only opens the row groups that
+        can match a query by station, variable or date range. The manifest records the
+        filter rules of the StationPreprocessor (see setFilter).
+
+        Parameters:
+        -----------
+        directory: string
+            path to the directory of the export. An existing export there is replaced
+        stations: iterable
+            any iterable of Station objects (for example the generator returned by
+            iterStations). default is None (the stations in the StationPreprocessor).
+            Only rowGroupSize rows are held in memory at a time
+        rowGroupSize: int
+            the number of rows in each row group. default is 1000000
+        compress: boolean
+            zlib compress the row groups. default is False
+
+        Returns:
+        ---------
+        the columnar.ColumnarReader of the export
+        """
+        if stations == None:
+            stations = self.stations
+        writer = columnar.ColumnarWriter(directory, rowGroupSize, compress, self.filterSpec)
+        for station in stations:
+            writer.writeStation(station)
+        return writer.close()
+
+    def exportToShapefile(self,filename,stations=None): # could export a shapefile with climate data for a timeslice included.. maybe later
+        """
+        writes a point shapefile of the stations with their metadata and the period of
+        record of TMAX, TMIN and PRCP (see VECTOR_FIELDS). No data values are read, so
+        lazy ClimateVars (see processDlyFiles) are never decoded.
+
+        stations can be any iterable of Station objects (for example the generator
+        returned by iterStations). default is None (the stations in the StationPreprocessor)
+        """
+        self.__exportPoints(filename, "ESRI Shapefile", stations)
+        # dont know why the spatial reference isn't being set when I create the layer.
+        # so, mannually edit the .prj file.
+        spatialRef = osr.SpatialReference()
+        spatialRef.SetWellKnownGeogCS("WGS84")
+        spatialRef.MorphToESRI()
+        file = open(os.path.splitext(filename)[0] + ".prj", 'w')
+        file.write(spatialRef.ExportToWkt())
+        file.close()
 
-    def exportToShapefile(self,filename): # could export a shapefile with climate data for a timeslice included.. maybe later
-        driver = ogr.GetDriverByName("ESRI Shapefile")
+    def exportToGeoPackage(self,filename,stations=None):
+        """
+        writes the same points as exportToShapefile to a GeoPackage (.gpkg). Unlike a
+        shapefile it's a single file, has no limits on field names or file size, and
+        the features are written in a few large transactions.
+
+        stations can be any iterable of Station objects (for example the generator
+        returned by iterStations). default is None (the stations in the StationPreprocessor)
+        """
+        self.__exportPoints(filename, "GPKG", stations)
+
+    def __exportPoints(self,filename,driverName,stations):
+        """
+        writes a point layer of the stations with the OGR driver driverName
+        """
+        if stations == None:
+            stations = self.stations
+        driver = ogr.GetDriverByName(driverName)
+        if os.path.exists(filename):
+            driver.DeleteDataSource(filename)
         dataSource = driver.CreateDataSource(filename)
         spatialRef = osr.SpatialReference()
         spatialRef.SetWellKnownGeogCS("WGS84") # ImportFromEPSG() was not working. more gdal troubles.. :(
-        layerName = filename.split("/")[-1][:-4] # the layerName is the shapefile name without the path and its file extension
+        layerName = os.path.splitext(os.path.basename(filename))[0] # the layerName is the file name without the path and its file extension
         layer = dataSource.CreateLayer(layerName, spatialRef, ogr.wkbPoint)
-        # create the fields
-        layer.CreateField(ogr.FieldDefn("name", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("stationID", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("country", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("state", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("lat", ogr.OFTReal))
-        layer.CreateField(ogr.FieldDefn("lon", ogr.OFTReal))
-        layer.CreateField(ogr.FieldDefn("elev", ogr.OFTReal))
-        layer.CreateField(ogr.FieldDefn("TMAX", ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn("TMAX_Begin", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("TMAX_End", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("TMIN", ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn("TMIN_Begin", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("TMIN_End", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("PRCP", ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn("PRCP_Begin", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("PRCP_End", ogr.OFTString))
-        layer.CreateField(ogr.FieldDefn("hcn", ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn("crn", ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn("gsn", ogr.OFTInteger))
-        layer.CreateField(ogr.FieldDefn("wmoID", ogr.OFTString))
+        for fieldName, fieldType in VECTOR_FIELDS: # create the fields
+            layer.CreateField(ogr.FieldDefn(fieldName, fieldType))
+        layerDefn = layer.GetLayerDefn()
+        fields = dict([(fieldName, layerDefn.GetFieldIndex(fieldName)) for fieldName, fieldType in VECTOR_FIELDS]) # set the fields by index, not by name
+        # the full names of the countries and states. If two names share a code, the first one is used
+        countryNames = {}
+        for name in self.countryMap:
+            countryNames.setdefault(self.countryMap[name], name)
+        stateNames = {}
+        for name in self.stateMap:
+            stateNames.setdefault(self.stateMap[name], name)
 
+        useTransactions = dataSource.TestCapability(ogr.ODsCTransactions)
+        if useTransactions:
+            dataSource.StartTransaction()
+        count = 0
         # iterate through stations, create features, and add their attributes
-        for station in self.stations:
-            if "TMAX" in station.variables:
-                tmax = 1
-                tmaxBegin = station.variables["TMAX"].getStart()
-                tmaxEnd = station.variables["TMAX"].getEnd()
-            else:
-                tmax = 0
-                tmaxBegin = "" # the earliest representable time. Couldn't figure out how to set null OGR Date types
-                tmaxEnd = ""
-            if "TMIN" in station.variables:
-                tmin = 1
-                tminBegin = station.variables["TMIN"].getStart()
-                tminEnd = station.variables["TMIN"].getEnd()
-            else:
-                tmin = 0
-                tminBegin = ""
-                tminEnd = ""
-            if "PRCP" in station.variables:
-                prcp = 1
-                prcpBegin = station.variables["PRCP"].getStart()
-                prcpEnd = station.variables["PRCP"].getEnd()
-            else:
-                prcp = 0
-                prcpBegin = ""
-                prcpEnd = ""
-
-            # create the feature
-            feature = ogr.Feature(layer.GetLayerDefn())
-            # set the attributes
-            feature.SetField("name", station.name)
-            feature.SetField("stationID", station.stationId)
-            feature.SetField("country", self.countryMap.keys()[self.countryMap.values().index(station.country)]) # country will be the full name, not the abreviation
-            feature.SetField("state", self.stateMap.keys()[self.stateMap.values().index(station.state)])
-            feature.SetField("lat", station.lat)
-            feature.SetField("lon", station.lon)
-            feature.SetField("elev", station.elev)
-            feature.SetField("TMAX", tmax)
-            feature.SetField("TMAX_Begin", str(tmaxBegin))
-            feature.SetField("TMAX_End", str(tmaxEnd))
-            feature.SetField("TMIN", tmin)
-            feature.SetField("TMIN_Begin", str(tminBegin))
-            feature.SetField("TMIN_End", str(tminEnd))
-            feature.SetField("PRCP", prcp)
-            feature.SetField("PRCP_Begin", str(prcpBegin))
-            feature.SetField("PRCP_End", str(prcpEnd))
-            feature.SetField("hcn", int(station.hcn)) # convert the boolean to int
-            feature.SetField("crn", int(station.crn))
-            feature.SetField("gsn", int(station.gsn))
-            feature.SetField("wmoID", station.wmoId)
+        for station in stations:
+            feature = ogr.Feature(layerDefn)
+            feature.SetField(fields["name"], station.name)
+            feature.SetField(fields["stationID"], station.stationId)
+            feature.SetField(fields["country"], countryNames.get(station.country, "")) # country will be the full name, not the abreviation
+            feature.SetField(fields["state"], stateNames.get(station.state, ""))
+            feature.SetField(fields["lat"], float(station.lat))
+            feature.SetField(fields["lon"], float(station.lon))
+            feature.SetField(fields["elev"], float(station.elev))
+            for varName in VECTOR_VARIABLES:
+                if varName in station.variables:
+                    feature.SetField(fields[varName], 1)
+                    feature.SetField(fields[varName + "_Begin"], str(station.variables[varName].getStart()))
+                    feature.SetField(fields[varName + "_End"], str(station.variables[varName].getEnd()))
+                else:
+                    feature.SetField(fields[varName], 0) # couldn't figure out how to set null OGR Date types, so the dates are left empty
+                    feature.SetField(fields[varName + "_Begin"], "")
+                    feature.SetField(fields[varName + "_End"], "")
+            feature.SetField(fields["hcn"], int(station.hcn)) # convert the boolean to int
+            feature.SetField(fields["crn"], int(station.crn))
+            feature.SetField(fields["gsn"], int(station.gsn))
+            feature.SetField(fields["wmoID"], station.wmoId)
             # create and set the geometry
-            wkt = "POINT(%f %f)" % (float(station.lon), float(station.lat))
-            point = ogr.CreateGeometryFromWkt(wkt)
+            point = ogr.Geometry(ogr.wkbPoint)
+            point.AddPoint_2D(float(station.lon), float(station.lat))
             feature.SetGeometry(point)
             layer.CreateFeature(feature)
-            # close the feature
-            feature = None
+            count+=1
+            if useTransactions and count % VECTOR_TRANSACTION_SIZE == 0:
+                dataSource.CommitTransaction()
+                dataSource.StartTransaction()
+        if useTransactions:
+            dataSource.CommitTransaction()
         # close the dataSource
         dataSource = None
 
-        # dont know why the spatial reference isn't being set when I create the layer.
-        # so, mannually edit the .prj file.
-        spatialRef.MorphToESRI()
-        file = open(filename[:-4] + ".prj", 'w')
-        file.write(spatialRef.ExportToWkt())
-        file.close()
+def _parseDlyFiles(filenames,reader,args,workers=None):
+    """
+    yields the parsed contents of the .dly files in the same order as filenames.
+    reader is the module level function that reads one file (_readDlyFile,
+    _scanDlyFile or _readDlyMember), called with each item of filenames followed by args.
+    When workers is more than 1, the files are parsed in a pool of processes.
+    Only a few files per worker are in flight at a time, so memory use stays
+    bounded even if the caller consumes the results slowly.
+    """
+    if workers == None or workers <= 1:
+        for filename in filenames:
+            yield reader(filename, *args)
+        return
+    pool = ProcessPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for filename in filenames:
+            pending.append(pool.submit(reader, filename, *args))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for future in pending: # the caller stopped early
+            future.cancel()
+        pool.shutdown()
+
+def _readDlyFile(filename,variablesOfInterest,dlyCache=None,dlyIndex=None,years=None,filterSpec=None):
+    """
+    parses a .dly file and returns a dictionary of (data, days) tuples where data
+    is a float32 array and days is an int32 array of days since 1970-01-01.
+    This is module level so it can be sent to worker processes. The arrays are
+    sent back as compact buffers instead of lists of floats and dates.
+
+    If dlyCache is given, an up to date cached copy is returned without
+    parsing the file, and newly parsed files are added to the cache.
+
+    If dlyIndex (a catalog.DlyIndex) is given, the file is indexed the first time
+    it is read. After that, only the blocks of lines of the variablesOfInterest
+    (and years) are read, unless the whole file is needed to fill the cache.
+
+    years is None (every year) or a (startYear, endYear) tuple. Either can be None.
+    Files read for a range of years are not added to the cache.
+
+    filterSpec is the filters.FilterSpec the values must pass. The rules of dlyCache
+    must be the same. default is None (filters.DEFAULT_FILTER)
+    """
+    if dlyCache != None:
+        parsed = dlyCache.get(filename, variablesOfInterest)
+        if parsed != None:
+            return _clipYears(parsed, years)
+    fillCache = dlyCache != None and years == None
+    index = None
+    if dlyIndex != None:
+        index = dlyIndex.get(filename)
+    if index is not None and not fillCache:
+        found = dlyreader.blockRanges(index, variablesOfInterest, *(years or (None, None)))
+        ranges = np.array([r for varName in found for r in found[varName][0]], dtype=np.int64).reshape(-1, 2)
+        chars = dlyreader.readRanges(filename, dlyreader.mergeRanges(ranges[:, 0], ranges.sum(axis=1))) # the ranges of the variables can overlap
+    else:
+        chars = dlyreader.readDlyFile(filename)
+        if dlyIndex != None and index is None:
+            dlyIndex.put(filename, dlyreader.blockIndex(chars, os.path.getsize(filename)))
+        if fillCache:
+            parsed = dlyreader.compact(dlyreader.parseLines(chars, variablesOfInterest, filterSpec))
+            dlyCache.put(filename, variablesOfInterest, parsed, dlyreader.resumePoint(chars, os.path.getsize(filename)))
+            return parsed
+    chars = _linesInYears(chars, years) # merged ranges read through the lines of other years of the other variables
+    return dlyreader.compact(dlyreader.parseLines(chars, variablesOfInterest, filterSpec))
+
+def _scanDlyFile(filename,variablesOfInterest,dlyCache=None,dlyIndex=None,years=None,filterSpec=None):
+    """
+    returns a dictionary of lazy "daily" ClimateVars of a .dly file (see ClimateVar.setSource).
+    Only the element and date columns are decoded, and if dlyIndex has an index of the
+    file, the file isn't read at all. Files that are not made of fixed width lines are
+    decoded in full, because the byte ranges of their lines aren't known.
+    dlyCache is not used. The arguments are the same as _readDlyFile
+    """
+    index = None
+    if dlyIndex != None:
+        index = dlyIndex.get(filename)
+    if index is None:
+        chars = dlyreader.readDlyFile(filename)
+        index = dlyreader.blockIndex(chars, os.path.getsize(filename))
+        if dlyIndex != None:
+            dlyIndex.put(filename, index)
+    variables = {}
+    if index is None:
+        parsed = dlyreader.compact(dlyreader.parseLines(_linesInYears(chars, years), variablesOfInterest, filterSpec))
+        for varName in parsed:
+            variables[varName] = ClimateVar(varName, "daily")
+            variables[varName].setAll(*parsed[varName])
+        return variables
+    found = dlyreader.blockRanges(index, variablesOfInterest, *(years or (None, None)))
+    for varName in found:
+        ranges, firstMonth, lastMonth = found[varName]
+        start = np.datetime64(firstMonth, "M").astype("datetime64[D]").item()
+        end = (np.datetime64(lastMonth + 1, "M").astype("datetime64[D]") - 1).item()
+        variables[varName] = ClimateVar(varName, "daily")
+        variables[varName].setSource(filename, ranges, start, end, years, filterSpec)
+    return variables
+
+def _jsonVariables(station):
+    """
+    returns the JSON text of the variables of a station:
+        {"TMAX": {"dataDescription": "daily", "unit": "tenths_C", "timeframe": "day", "runs": [["1950-01-01", 3652], ...], "data": [...]}, ...}
+    unit is the unit of the data (see the conversion module). The dates are not written one
+    by one. runs holds the first date and the number of values of each run of consecutive
+    days (or months, seasons, years for means, see timeframe). The numbers are encoded
+    with one numpy conversion per array, and NaN is written as null. Variables with fill
+    flags (see the gapfill module) also get "fillFlags": [...]
+    """
+    parts = []
+    for varName in station.variables:
+        climateVariable = station.variables[varName]
+        timeframe = "day"
+        for key in cube.cubeDescriptions:
+            if climateVariable.dataDescription in cube.cubeDescriptions[key]:
+                timeframe = key
+        keys = cube._timeKeys(climateVariable.days, timeframe)
+        starts = np.concatenate([[0], np.nonzero(np.diff(keys) != 1)[0] + 1]) if len(keys) > 0 else np.zeros(0, dtype=np.int64)
+        lengths = np.diff(np.append(starts, len(keys)))
+        runs = list(zip(np.datetime_as_string(cube._timeStarts(keys[starts], timeframe)).tolist(), lengths.tolist()))
+        parts.append(json.dumps(varName) + ": {" + '"dataDescription": ' + json.dumps(climateVariable.dataDescription) +
+                     ', "unit": ' + json.dumps(climateVariable.unit) +
+                     ', "timeframe": ' + json.dumps(timeframe) + ', "runs": ' + json.dumps(runs) +
+                     ', "data": [' + _jsonNumbers(climateVariable.data) + "]" +
+                     (', "fillFlags": [' + _jsonNumbers(climateVariable.fillFlags) + "]" if climateVariable.fillFlags is not None else "") + "}")
+    return "{" + ", ".join(parts) + "}"
+
+def _jsonNumbers(values):
+    """
+    returns the values of an array as comma separated JSON numbers, with null for NaN.
+    Daily data are whole tenths, so they are written as integers
+    """
+    values = np.asarray(values)
+    isValid = np.isfinite(values)
+    filled = np.where(isValid, values, 0)
+    if np.array_equal(filled, np.round(filled)) and np.abs(filled).max(initial=0) < 2**53:
+        text = list(map(str, filled.astype(np.int64).tolist()))
+    elif filled.dtype == np.float64:
+        text = list(map(repr, filled.tolist()))
+    else:
+        text = filled.astype(str).tolist() # the shortest text that reads back as the same float32
+    for i in np.nonzero(~isValid)[0].tolist(): # JSON has no NaN or infinity
+        text[i] = "null"
+    return ",".join(text)
+
+def _jsonStationInfo(station):
+    """
+    returns a dictionary of the metadata of a station and the period of record of its variables
+    """
+    return {"name": station.name, "country": station.country, "state": station.state,
+            "lat": float(station.lat), "lon": float(station.lon), "elev": float(station.elev),
+            "variables": dict([(varName, [str(station.variables[varName].start), str(station.variables[varName].end)]) for varName in station.variables])}
+
+def _exportNDJSON(filename,stations,filterSpec=None):
+    """
+    writes one line of JSON per station and an index of the byte range of each line
+    (see StationPreprocessor.exportToJSON)
+    """
+    index = {}
+    offset = 0
+    outfile = open(filename, "wb")
+    for station in stations:
+        line = ('{"stationId": ' + json.dumps(station.stationId) + ', "variables": ' + _jsonVariables(station) + '}\n').encode("utf-8")
+        outfile.write(line)
+        info = _jsonStationInfo(station)
+        info["offset"] = offset
+        info["length"] = len(line)
+        index[station.stationId] = info
+        offset += len(line)
+    outfile.close()
+    outfile = open(filename + ".index.json", "w")
+    json.dump({"file": os.path.basename(filename), "filter": filters.describe(filterSpec), "stations": index}, outfile)
+    outfile.close()
+
+def _exportJSONShards(directory,stations,filterSpec=None):
+    """
+    writes one JSON file per station and an index.json manifest (see StationPreprocessor.exportToJSON)
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    index = {}
+    for station in stations:
+        outfile = open(os.path.join(directory, station.stationId + ".json"), "w")
+        outfile.write(_jsonVariables(station))
+        outfile.close()
+        info = _jsonStationInfo(station)
+        info["file"] = station.stationId + ".json"
+        index[station.stationId] = info
+    outfile = open(os.path.join(directory, "index.json"), "w")
+    json.dump({"filter": filters.describe(filterSpec), "stations": index}, outfile)
+    outfile.close()
+
+def _isArchive(path):
+    """
+    returns True if path is a tar or compressed tar file rather than a directory of .dly files
+    """
+    return os.path.isfile(path) and tarfile.is_tarfile(path)
+
+def _archiveMembers(archive,stationIds):
+    """
+    yields (stationId, contents) of the .dly files of stationIds (a set) in a tar or tar.gz
+    archive, in the order they are stored. The archive is read in one sequential pass, and
+    stops after the last of the stationIds. The data of the other members is skipped without
+    being read into Python objects (a compressed archive still has to be decompressed to get past it).
+    """
+    remaining = set(stationIds)
+    tar = tarfile.open(archive, "r:*")
+    try:
+        member = tar.next()
+        while member != None and len(remaining) > 0:
+            name = os.path.basename(member.name)
+            if member.isfile() and name.endswith(".dly") and name[:-4] in remaining:
+                remaining.discard(name[:-4])
+                infile = tar.extractfile(member)
+                yield name[:-4], infile.read()
+                infile.close()
+            tar.members = [] # don't hold on to the headers of more than 100k members
+            member = tar.next()
+    finally:
+        tar.close()
+
+def _readDlyMember(member,variablesOfInterest,years=None,filterSpec=None):
+    """
+    parses a (stationId, contents) tuple from _archiveMembers and returns (stationId, parsed)
+    where parsed is the same as the output of _readDlyFile
+    """
+    stationId, buf = member
+    chars = _linesInYears(dlyreader.toCharArray(buf), years)
+    return stationId, dlyreader.compact(dlyreader.parseLines(chars, variablesOfInterest, filterSpec))
+
+def _linesInYears(chars,years):
+    """
+    returns the lines of a .dly file in a (startYear, endYear) range. years can be None
+    """
+    if years == None:
+        return chars
+    lineYears = dlyreader.yearsOf(chars)
+    keep = np.ones(len(chars), dtype=bool)
+    if years[0] != None:
+        keep &= lineYears >= years[0]
+    if years[1] != None:
+        keep &= lineYears <= years[1]
+    return chars[keep]
+
+def _clipYears(parsed,years):
+    """
+    returns the (data, days) tuples of parsed with only the days in a
+    (startYear, endYear) range. years can be None
+    """
+    if years == None:
+        return parsed
+    first = -2**31 if years[0] == None else np.datetime64(str(years[0]) + "-01-01").astype(np.int64)
+    last = 2**31 - 1 if years[1] == None else np.datetime64(str(years[1]) + "-12-31").astype(np.int64)
+    clipped = {}
+    for varName in parsed:
+        data, days = parsed[varName]
+        keep = (days >= first) & (days <= last)
+        if keep.sum() > 0:
+            clipped[varName] = (data[keep], days[keep])
+    return clipped
+
 
 class ClimateVar(object):
+    """
+    holds the data for a single variable of a station.
+
+    The values are stored in one contiguous numpy array (float32 for daily data)
+    and the dates as one int32 array of day numbers (days since 1970-01-01).
+    The timelist is returned as an array of datetime64[D].
+
+    unit is the unit of the data (see the conversion module). The data read from
+    the .dly files is in the units of the files, for example tenths of a degree
+    celsius for TMAX. It's None if the unit isn't known.
+
+    fillFlags is None, or a uint8 array with a flag for every value telling
+    whether it was observed (0) or filled, and by which method (see the gapfill module).
+
+    A ClimateVar can also be lazy (see setSource). It then only holds the .dly
+    file, the byte ranges of the variable's lines and the record period, and the
+    values are decoded the first time data, timelist or days is used. Metadata
+    such as start and end never decodes them.
+    """
+    __slots__ = ["name", "dataDescription", "unit", "fillFlags", "start", "end", "duration", "_data", "_days", "_source"]
     
-    def __init__(self,initName,initDataDescription):
+    def __init__(self,initName,initDataDescription,initUnit=None):
         self.name = initName #TMAX, TMIN, PRCP, etc..
-        self.dataDescription = initDataDescription # should be "daily", "monthly mean", "seasonal mean", "annual mean", "monthly anomaly"
+        self.dataDescription = initDataDescription # should be "daily", "monthly_mean", "seasonal_mean", "annual_mean", "monthly_anomaly", "seasonal_anomaly", "annual_anomaly"
+        self.unit = initUnit if initUnit != None else conversion.nativeUnit(initName) # "tenths_C", "C", "tenths_mm", etc... the units of the .dly files by default
+        self.fillFlags = None # how each value was filled, if any were. see the gapfill module
         
         self.start = None
         self.end = None
         self.duration = None
-        self.data = []
-        self.timelist = []
+        self._data = np.zeros(0, dtype=np.float32)
+        self._days = np.zeros(0, dtype=np.int32) # day numbers. days since 1970-01-01
+        self._source = None # (filename, byte ranges, size, mtime, years, filterSpec) of a lazy ClimateVar
+
+    @property
+    def data(self):
+        if self._source is not None:
+            self.__decode()
+        return self._data
+
+    @data.setter
+    def data(self,newData):
+        self.setData(newData)
+
+    @property
+    def timelist(self):
+        return self.days.astype("datetime64[D]")
+
+    @timelist.setter
+    def timelist(self,newTimelist):
+        self.setTimelist(newTimelist)
+
+    @property
+    def days(self):
+        """
+        the dates as an int32 array of days since 1970-01-01
+        """
+        if self._source is not None:
+            self.__decode()
+        return self._days
         
     def getName(self):
         return self.name
@@ -815,29 +1608,151 @@ class ClimateVar(object):
         return self.data
         
     def setData(self,newData):
-        self.data = newData
+        if self._source is not None: # keep the dates
+            self.__decode()
+        self._data = np.asarray(newData)
         
     def getTimelist(self):
         return self.timelist
         
     def setTimelist(self,newTimelist):
-        self.timelist = newTimelist
-        self.start = self.timelist[0]
-        self.end = self.timelist[-1]
-        self.duration = self.end - self.start
+        """
+        newTimelist can be an array of datetime64 or a list of date/datetime objects
+        """
+        if self._source is not None: # keep the values
+            self.__decode()
+        self._days = np.asarray(newTimelist, dtype="datetime64[D]").astype(np.int32)
+        self.__updateRecordPeriod()
 
     def setAll(self,newData,newTimelist):
         """
-        will set all relevant attributes of the ClimateVar
+        will set all relevant attributes of the ClimateVar. The fill flags are cleared
         """
+        self._source = None # nothing left to decode
+        self.fillFlags = None
         self.setData(newData)
         self.setTimelist(newTimelist)
 
+    def copy(self):
+        """
+        returns a new ClimateVar with the same attributes. The arrays are shared
+        until either ClimateVar is given new data. The shared data is read only, so a
+        conversion (see the conversion module) of one ClimateVar makes it a new array
+        instead of changing the other. The copy of a lazy ClimateVar is lazy
+        """
+        newVar = ClimateVar(self.name, self.dataDescription, self.unit)
+        newVar.unit = self.unit # even if it's None
+        newVar.fillFlags = self.fillFlags
+        if self._data.flags.writeable:
+            self._data = self._data.view()
+            self._data.flags.writeable = False
+        newVar._data = self._data
+        newVar._days = self._days
+        newVar._source = self._source
+        newVar.start = self.start
+        newVar.end = self.end
+        newVar.duration = self.duration
+        return newVar
+
+    def extend(self,newData,newTimelist):
+        """
+        appends data and dates to the end of the ClimateVar
+        """
+        newDays = np.asarray(newTimelist, dtype="datetime64[D]").astype(np.int32)
+        if self._source is not None:
+            self.__decode()
+        if self.fillFlags is not None: # the new values are observed
+            self.fillFlags = np.concatenate([self.fillFlags, np.zeros(len(newDays), dtype=np.uint8)])
+        if len(self._days) == 0:
+            self._data = np.asarray(newData)
+            self._days = newDays
+        else:
+            self._data = np.concatenate([self._data, newData])
+            self._days = np.concatenate([self._days, newDays])
+        self.__updateRecordPeriod()
+
+    def replaceFrom(self,newData,newTimelist):
+        """
+        replaces the values from the first date in newTimelist onwards with newData.
+        Values before that date are kept.
+        """
+        newDays = np.asarray(newTimelist, dtype="datetime64[D]").astype(np.int32)
+        if len(newDays) == 0:
+            return
+        if self._source is not None:
+            self.__decode()
+        keep = self._days < newDays[0]
+        if self.fillFlags is not None: # the new values are observed
+            self.fillFlags = np.concatenate([self.fillFlags[keep], np.zeros(len(newDays), dtype=np.uint8)])
+        self._data = np.concatenate([self._data[keep], newData])
+        self._days = np.concatenate([self._days[keep], newDays])
+        self.__updateRecordPeriod()
+
+    def setSource(self,filename,ranges,start,end,years=None,filterSpec=None):
+        """
+        makes the ClimateVar lazy. Nothing is read until the values are used.
+
+        Parameters:
+        -----------
+        filename: string
+            full file path to the .dly file
+        ranges: list
+            (byte offset, byte length) tuples of the lines of the variable in the file
+            (see dlyreader.elementRanges)
+        start: datetime.date
+            the first day of the record
+        end: datetime.date
+            the last day of the record
+        years: tuple
+            the (startYear, endYear) the ranges were limited to. Only used if the file
+            changes before the values are decoded. default is None (every year)
+        filterSpec: filters.FilterSpec
+            the rules the values must pass when they are decoded. default is None
+            (filters.DEFAULT_FILTER)
+        """
+        info = os.stat(filename)
+        self._source = (filename, ranges, info.st_size, info.st_mtime, years, filterSpec)
+        self._data = np.zeros(0, dtype=np.float32)
+        self._days = np.zeros(0, dtype=np.int32)
+        self.start = start
+        self.end = end
+        self.duration = end - start
+
+    def isLoaded(self):
+        """
+        returns False if the ClimateVar is lazy and its values haven't been decoded yet
+        """
+        return self._source is None
+
+    def __decode(self):
+        filename, ranges, size, mtime, years, filterSpec = self._source
+        self._source = None
+        info = os.stat(filename)
+        if info.st_size == size and info.st_mtime == mtime:
+            chars = dlyreader.readRanges(filename, ranges)
+        else: # the file changed since the byte ranges were found, so they may be wrong
+            chars = _linesInYears(dlyreader.readDlyFile(filename), years)
+        parsed = dlyreader.compact(dlyreader.parseLines(chars, [self.name], filterSpec))
+        if self.name in parsed:
+            self._data, self._days = parsed[self.name]
+        self.__updateRecordPeriod()
+
+    def __updateRecordPeriod(self):
+        if len(self._days) == 0:
+            self.start = None
+            self.end = None
+            self.duration = None
+            return
+        self.start = self._days[:1].astype("datetime64[D]")[0].item() # datetime.date
+        self.end = self._days[-1:].astype("datetime64[D]")[0].item()
+        self.duration = self.end - self.start
+
     def __str__(self):
         return self.name + "," + self.dataDescription + "," + str(self.start) + "," + str(self.end)
             
 
 class Station(object):
+    __slots__ = ["name", "stationId", "country", "state", "lat", "lon", "elev", "variables", "hcn", "crn", "gsn", "wmoId"]
     
     def __init__(self,initName,initStationId,initCountry,initState,initLat,initLon,initElev,initHCN,initCRN,initGSN,initWMOId):
         """
@@ -870,5 +1785,11 @@ class Station(object):
         self.gsn = initGSN
         self.wmoId = initWMOId
 
+    def copyMetadata(self):
+        """
+        returns a new Station with the same metadata and no variables
+        """
+        return Station(self.name,self.stationId,self.country,self.state,self.lat,self.lon,self.elev,self.hcn,self.crn,self.gsn,self.wmoId)
+
     def __str__(self):
-        return str(self.stationId) + "," + self.country + "," + self.state + "," + str(self.lat) + "," + str(self.lon) + "," + str(self.elev) + "," + str(self.hcn) + "," + str(self.crn) + "," + str(self.gsn) + "," + str(self.wmoId)
+        return str(self.stationId) + "," + str(self.country) + "," + str(self.state) + "," + str(self.lat) + "," + str(self.lon) + "," + str(self.elev) + "," + str(self.hcn) + "," + str(self.crn) + "," + str(self.gsn) + "," + str(self.wmoId)
@@ -1,15 +1,18 @@
 import numpy as np
-import datetime
-import calendar
 from GHCND import conversion
 
 validtimeframes = ["month","season","year"]
+cumulativeVariables = ["PRCP","SNOW"] # these are summed when aggregating, all other variables are averaged
 # default seasons are DJF, MAM, JJA, SON 
+maxMissingDays = {"month": 5, "season": 15, "year": 60} # a mean is set to NaN if more days than this are missing
+meanDescriptions = {"month": "monthly_mean", "season": "seasonal_mean", "year": "annual_mean"}
+anomalyDescriptions = {"month": "monthly_anomaly", "season": "seasonal_anomaly", "year": "annual_anomaly"}
 
-def calculateMean(stationCollection,timeframe):
+def calculateMean(stationCollection,timeframe,maxMissing=None):
     """
     input data will be modified so that the data is in the form
-    of monthly, seasonal, or annual means.
+    of monthly, seasonal, or annual means. Variables that fail the
+    filtering are removed, and so are stations with no variables left.
     
     Parameters
     ------------
@@ -17,124 +20,465 @@ def calculateMean(stationCollection,timeframe):
         a StationPreprocessor object that has stations and climate variables
     timeframe: string
         a string that indicates the timestep for which the mean will be calculated.
-        monthly, seasonal, and annual means can be calculated
+        monthly ("month"), seasonal ("season": DJF, MAM, JJA, SON) and annual ("year")
+        means can be calculated. December counts towards the winter of the next year.
+    maxMissing: dict
+        the number of missing days allowed in a month, season or year before its
+        mean is set to NaN, for example {"season": 10}. Timeframes that aren't in the
+        dict use maxMissingDays. default is None (use maxMissingDays)
         
     Returns
     ----------
     None 
     """
+    if not __isValidTimeframe(timeframe):
+        return
+    keep = []
+    for station in stationCollection.stations: # for each station in the StationPreprocessor
+        if __calculateStationMean(station,timeframe,maxMissing):
+            keep.append(station)
+    stationCollection.stations = keep # if all the variables of a station were removed, remove the station
+
+def calculateStationMean(station,timeframe,maxMissing=None):
+    """
+    same as calculateMean, but for a single Station object. Use this
+    to calculate means on the stations yielded by StationPreprocessor.iterStations()
+
+    Parameters
+    ------------
+    station: Station
+        a Station object that has climate variables
+    timeframe: string
+        see calculateMean
+    maxMissing: dict
+        see calculateMean
+
+    Returns
+    ----------
+    False if all the variables of the station were removed by the filtering, otherwise True
+    """
+    if not __isValidTimeframe(timeframe):
+        return
+    return __calculateStationMean(station,timeframe,maxMissing)
+
+def iterMeans(stations,timeframe,maxMissing=None):
+    """
+    calculates the mean for each station in stations and yields the stations one at
+    a time. Stations that have no variables left after the filtering are not yielded.
+    stations can be any iterable of Station objects, so this can be chained between
+    StationPreprocessor.iterStations() and the export functions without holding every
+    station in memory.
+
+    Parameters
+    ------------
+    stations: iterable
+        Station objects. For example the generator returned by StationPreprocessor.iterStations()
+    timeframe: string
+        see calculateMean
+    maxMissing: dict
+        see calculateMean
+
+    Returns
+    ----------
+    generator of Station objects
+    """
+    if not __isValidTimeframe(timeframe):
+        return
+    for station in stations:
+        if __calculateStationMean(station,timeframe,maxMissing): # stations with no variables left are not yielded
+            yield station
+
+def __isValidTimeframe(timeframe):
     if timeframe not in validtimeframes:
         print("error: did not enter a valid timeframe")
         print("please enter a timeframe from the following: ")
         print(validtimeframes)
-        return
-    for station in stationCollection.stations: # for each station in the StationPreprocessor
-        for varName in station.variables: # for each climate variable in the station object
-            if timeframe == "month":
-                __calculateMonthlyMean(station.variables[varName])
-            elif timeframe == "season":
-                __calculateSeasonalMean(station.variables[varName])
-            else:           
-                __calculateAnnualMean(station.variables[varName])
-    conversion.TenthsCelsiusToCelsius(stationCollection) # convert all temperature data in the preprocessor to celsius
-
-def __calculateMonthlyMean(climateVariable):
-    timestep = 0
-    
-    monthlyMeans = []
-    newTimelist = []
-    while timestep < len(climateVariable.timelist):
-        curDatetime = climateVariable.timelist[timestep]
-        curDay = climateVariable.timelist[timestep].day
-        curMonth = climateVariable.timelist[timestep].month
-        curYear = climateVariable.timelist[timestep].year
-        daysInMonth = calendar.monthrange(curYear,curMonth)[1] # number of days in the current month
-        dataChunk = climateVariable.data[timestep:timestep+daysInMonth]
-        if np.isnan(dataChunk).sum() > 5: # set the monthly mean to missing if more than 5 days of data are missing in the month
-            monthlyMeans.append(np.nan)
+        return False
+    return True
+
+def __calculateStationMean(station,timeframe,maxMissing=None):
+    """
+    returns False if every variable of the station was removed by the filtering
+    """
+    for varName in list(station.variables): # for each climate variable in the station object
+        climateVariable = station.variables[varName]
+        means = _periodMeans(climateVariable.name, climateVariable.data, climateVariable.days, [timeframe], maxMissing)
+        if timeframe not in means: # the variable is invalid, so remove
+            del station.variables[varName]
         else:
-            if climateVariable.name == "PRCP": # for prcp, it's cumulative
-                monthlyMeans.append(np.nansum(dataChunk))
-            elif climateVariable.name in ["TMAX","TMIN","TAVG"]: # for tmin, tmax, and tavg it's the mean
-                monthlyMeans.append(np.nanmean(dataChunk))
-        newTimelist.append(datetime.datetime(year=curYear,month=curMonth,day=1))
-        timestep+=daysInMonth
-        if timestep < len(climateVariable.timelist): # need to check if there are missing months
-            nextDatetime = climateVariable.timelist[timestep] # the next month of data is this. Check to see if gaps need to be filled with nan
-            if  (nextDatetime - curDatetime) == datetime.timedelta(days=daysInMonth): # if the next datetime object follows the current datetime object just processed, all is well
-                pass
-            else: # this means there are months of missing data. 
-                missingDatetime = curDatetime + datetime.timedelta(days=calendar.monthrange(curDatetime.year, curDatetime.month)[1])
-                while nextDatetime != missingDatetime: # iteratively add missing months until we hit the month that we know there is data for. 
-                    monthlyMeans.append(np.nan)
-                    newTimelist.append(missingDatetime)
-                    missingDatetime = missingDatetime + datetime.timedelta(days=calendar.monthrange(missingDatetime.year, missingDatetime.month)[1])
-    if (np.isnan(monthlyMeans).sum() / float(len(monthlyMeans))) > 0.75: # if more than 75% of the monthly values are missing. data is invalid, so remove
-        climateVariable = None
-    elif newTimelist[-1].year < 2016: # if the station was not operating past the year 2015, consider the data invalid
-        climateVariable = None
-    else:
-        climateVariable.setAll(np.array(monthlyMeans), np.array(newTimelist)) # set all the ClimateVar's attributes
-        climateVariable.dataDescription = "monthly_mean"
+            climateVariable.setAll(*means[timeframe]) # set all the ClimateVar's attributes
+            climateVariable.dataDescription = meanDescriptions[timeframe]
+    conversion.TenthsCelsiusToCelsius(station) # convert the temperature data in the station to celsius (once, see the conversion module)
+    return len(station.variables) > 0
+
+def __isValidMean(means,lastDay):
+    if len(means) == 0:
+        return False
+    if (np.isnan(means).sum() / float(len(means))) > 0.75: # if more than 75% of the values are missing. data is invalid, so remove
+        return False
+    if np.datetime64(int(lastDay), "D").astype(object).year < 2016: # if the station was not operating past the year 2015, consider the data invalid
+        return False
+    return True
+
+def _periodMeans(name,data,days,timeframes,maxMissing=None):
+    """
+    aggregates daily data to the means of one or more timeframes in one pass over
+    the daily values. The daily values are reduced to monthly totals and counts
+    once, and the seasons and years are reduced from those.
+
+    Parameters
+    ------------
+    name: string
+        the variable name. the values of cumulativeVariables are summed, all others are averaged
+    data: numpy array
+        the daily values. NaN is missing
+    days: numpy array
+        the dates of the daily values as days since 1970-01-01. They don't need to be in order
+    timeframes: list
+        any of "month", "season" and "year"
+    maxMissing: dict
+        the number of missing days allowed in each timeframe. see maxMissingDays
+
+    Returns
+    ----------
+    dict of timeframe -> (values, dates) where dates are the first day of each period.
+    Timeframes that fail the filtering (see calculateMean) are not included.
+    """
+    out = {}
+    if len(days) == 0:
+        return out
+    thresholds = dict(maxMissingDays)
+    if maxMissing != None:
+        thresholds.update(maxMissing)
+    groups, denseMonths = _monthGroups(days)
+    data = np.asarray(data, dtype=np.float64)
+    isValid = ~np.isnan(data)
+    # the only pass over the daily values
+    counts = np.bincount(groups, weights=isValid, minlength=len(denseMonths))
+    # the daily values are whole numbers (tenths of a unit), so the float64 sums are exact and don't depend on the order
+    totals = np.bincount(groups, weights=np.where(isValid, data, 0.), minlength=len(denseMonths))
+    lastDay = np.max(days)
+    for timeframe in timeframes:
+        periodGroups, periodStarts = _periodGroups(denseMonths, timeframe)
+        if timeframe == "month":
+            periodCounts, periodTotals = counts, totals
+        else:
+            periodCounts = np.bincount(periodGroups, weights=counts, minlength=len(periodStarts)-1)
+            periodTotals = np.bincount(periodGroups, weights=totals, minlength=len(periodStarts)-1)
+        expected = np.diff(periodStarts.astype(np.int64)) # number of days in each period
+        means = _reduce(name, periodTotals, periodCounts, expected, thresholds[timeframe])
+        if __isValidMean(means, lastDay):
+            out[timeframe] = (means, periodStarts[:-1])
+    return out
+
+def _monthGroups(days):
+    """
+    returns the month of every day as an index into a dense array of months (every month
+    from the first to the last month of days), and that array of months as datetime64[M]
+    """
+    days = np.asarray(days, dtype=np.int64)
+    firstDay, lastDay = days.min(), days.max()
+    firstMonth = np.datetime64(int(firstDay), "D").astype("datetime64[M]")
+    denseMonths = np.arange(firstMonth, np.datetime64(int(lastDay), "D").astype("datetime64[M]") + 1)
+    # converting every day to datetime64[M] is slow, so look the months up in a table of the days of the whole period
+    monthStarts = np.append(denseMonths, denseMonths[-1] + 1).astype("datetime64[D]").astype(np.int64)
+    table = np.repeat(np.arange(len(denseMonths)), np.diff(monthStarts))
+    return table[days - monthStarts[0]], denseMonths
 
-def __calculateSeasonalMean():
-    return NotImplemented
+def _periodGroups(denseMonths,timeframe):
+    """
+    returns the period (an index into the periods from the first to the last month) of every
+    month in denseMonths, and the first day of every period plus the day after the last period.
+
+    Seasons are DJF, MAM, JJA and SON. December belongs to the winter of the next year,
+    so the winter starting in December 2015 holds December 2015, January 2016 and February 2016.
+    """
+    keys = _periodKeys(denseMonths, timeframe)
+    return keys - keys[0], _periodStarts(np.arange(keys[0], keys[-1] + 2), timeframe)
 
-def __calculateAnnualMean():
-    return NotImplemented
+def _reduce(name,totals,counts,expected,maxMissing):
+    """
+    turns the totals and counts of the valid values of each period into sums (for the
+    cumulativeVariables) or means (for all other variables). A period is NaN if more
+    than maxMissing of its expected values are missing.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if name in cumulativeVariables: # for prcp, it's cumulative
+            values = totals
+        else: # for tmin, tmax, tavg and the rest it's the mean
+            values = totals / counts
+    return np.where(expected - counts > maxMissing, np.nan, values)
 
-def calculateStandardizedAnomalies(stationCollection,timeframe,baselinePeriod):
-    return NotImplemented
+def calculateMeans(stationCollection,timeframes=validtimeframes,maxMissing=None):
     """
+    calculates the means of several timeframes at once. Every station's daily data
+    is read once and reduced to all the timeframes. The input stations are not modified.
+
+    Parameters
+    ------------
+    stationCollection: StationPreprocessor or iterable
+        a StationPreprocessor object, or any iterable of Station objects (for example
+        the generator returned by StationPreprocessor.iterStations())
+    timeframes: list
+        any of "month", "season" and "year". default is all three
+    maxMissing: dict
+        see calculateMean
+
+    Returns
+    ----------
+    dict of timeframe -> list of new Station objects holding the means. Variables and
+    stations are removed by the same filtering as in calculateMean.
+    """
+    for timeframe in timeframes:
+        if not __isValidTimeframe(timeframe):
+            return
+    stations = stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection
+    out = dict([(timeframe, []) for timeframe in timeframes])
+    for station in stations:
+        newStations = dict([(timeframe, station.copyMetadata()) for timeframe in timeframes])
+        for varName in station.variables:
+            climateVariable = station.variables[varName]
+            means = _periodMeans(climateVariable.name, climateVariable.data, climateVariable.days, timeframes, maxMissing)
+            for timeframe in means:
+                newVariable = climateVariable.copy()
+                newVariable.setAll(*means[timeframe])
+                newVariable.dataDescription = meanDescriptions[timeframe]
+                newStations[timeframe].variables[varName] = newVariable
+        for timeframe in timeframes:
+            if len(newStations[timeframe].variables) > 0:
+                conversion.TenthsCelsiusToCelsius(newStations[timeframe])
+                out[timeframe].append(newStations[timeframe])
+    return out
+
+def updateMean(climateVariable,dailyData,dailyTimelist):
+    """
+    brings a monthly mean ClimateVar up to date with new daily data, without
+    recalculating the months before the new data. Every month from the first month
+    of dailyTimelist onwards is replaced by the means of the new data. Months
+    between the end of the old record and the new data are set to NaN. The new daily
+    data is in the units of the .dly files, and the new means are converted to the unit
+    of climateVariable (celsius for temperatures, see calculateMean).
+
+    This is used by StationPreprocessor.refreshDlyFiles().
+
+    Parameters
+    ------------
+    climateVariable: ClimateVar
+        a ClimateVar holding monthly means (dataDescription "monthly_mean")
+    dailyData: numpy array
+        the new daily values. It must start on the first day of a month.
+    dailyTimelist: numpy array
+        the dates of the new daily values
+
+    Returns
+    ----------
+    None
+    """
+    if climateVariable.dataDescription != "monthly_mean":
+        print("error: only monthly means can be updated")
+        return
+    if len(dailyData) == 0:
+        return
+    dailyDays = np.asarray(dailyTimelist, dtype="datetime64[D]").astype(np.int64)
+    groups, denseMonths = _monthGroups(dailyDays)
+    data = np.asarray(dailyData, dtype=np.float64)
+    isValid = ~np.isnan(data)
+    counts = np.bincount(groups, weights=isValid, minlength=len(denseMonths))
+    totals = np.bincount(groups, weights=np.where(isValid, data, 0.), minlength=len(denseMonths))
+    daysInMonth = np.diff(np.append(denseMonths, denseMonths[-1] + 1).astype("datetime64[D]").astype(np.int64))
+    newMeans = _reduce(climateVariable.name, totals, counts, daysInMonth, maxMissingDays["month"])
+    newTimelist = denseMonths
+    newMeans = conversion.convertArray(newMeans, conversion.nativeUnit(climateVariable.name), climateVariable.unit)
+    oldMonths = climateVariable.timelist.astype("datetime64[M]")
+    newMonths = np.array(newTimelist, dtype="datetime64[M]")
+    keep = oldMonths < newMonths[0]
+    gap = 0
+    if keep.sum() > 0:
+        gap = int((newMonths[0] - oldMonths[keep][-1]).astype(int)) - 1 # number of missing months between the old and new data
+    gapMonths = oldMonths[keep][-1:] + np.arange(1, gap+1) if gap > 0 else np.zeros(0, dtype="datetime64[M]")
+    climateVariable.setAll(np.concatenate([climateVariable.data[keep], np.full(gap, np.nan), newMeans]),
+                           np.concatenate([oldMonths[keep], gapMonths, newMonths]).astype("datetime64[D]"))
+
+def calculateStandardizedAnomalies(stationCollection,timeframe,baselinePeriod,maxMissing=None):
+    """
+    replaces the data of every variable with standardized anomalies: the difference
+    from the mean of the same calendar month (or season) in the baseline period, divided
+    by the standard deviation of that month (or season) in the baseline period. For
+    annual anomalies, all the years of the baseline period are used.
+
+    Daily variables are first aggregated to means of the timeframe with the same
+    filtering as calculateMean (so variables and stations can be removed). Variables
+    that already hold means of the timeframe are used as they are.
+
     Parameters
     ------------
     stationCollections: StationPreprocessor
         a StationPreprocessor object that has stations and climate variables
     timeframe: string
-        a string that indicates the timestep for which the mean will be calculated.
-        monthly, seasonal, and annual means can be calculated
+        "month", "season" or "year". see calculateMean
     baselinePeriod: list 
-        containing two datetime objects to describe the bounds (inclusive)
-        for the baseline period to calculate standardized anomalies
-        from. The day in the datetime objects should be set to 15 ALLWAYS!!
+        two dates (datetime.date, datetime.datetime or numpy.datetime64) that are the
+        bounds (inclusive) of the baseline period. The periods (months, seasons or
+        years) that hold the dates are included. For example
+        [datetime.date(1981,1,1), datetime.date(2010,12,31)]
+    maxMissing: dict
+        see calculateMean. Only used for daily variables
+
+    Returns
+    ----------
+    None
     """
-    if timeframe not in validtimeframes:
-        print("error: did not enter a valid timeframe")
-        print("please enter a timeframe from the following: ")
-        print(validtimeframes)
+    if not __isValidTimeframe(timeframe):
         return
+    keep = []
     for station in stationCollection.stations: # for each station in the StationPreprocessor
-        for varName in station.variables: # for each climate variable in the station object
-            
-            # so... the data is assumed to be either daily, or at the same resolution
-            # that the anomalies will be calculated for. For example, things will get wierd
-            # if you try to calculate monthly anomalies by passing in annual data.
-            if timeframe == "month":
-                if station.variables[varName].dataDescription == "daily":
-                    self.__calculateMonthlyMean(station.variables[varName])
-                self.__calculateMonthlyAnomalies(station.variables[varName],baselinePeriod)
-            elif timeframe == "season":
-                if station.variables[varName].dataDescription == "daily":
-                    self.__calculateSeasonalMean(station.variables[varName])
-                self.__calculateSeasonalAnomalies(station.variables[varName],baselinePeriod)
+        if not __calculateStationAnomalies(station,timeframe,baselinePeriod,maxMissing):
+            continue
+        keep.append(station)
+    stationCollection.stations = keep # if all the variables of a station were removed, remove the station
+
+def calculateStandardizedAnomaliesBatch(stationCollection,varName,timeframe,baselinePeriod,maxMissing=None):
+    """
+    same as calculateStandardizedAnomalies, but for one variable of every station at once.
+    The series of all the stations are stacked into a 2-D (station x time) array on a
+    common time axis, and every anomaly is calculated in one pass. The anomalies are
+    written back to the variables of the stations, and also returned.
+
+    Parameters
+    ------------
+    stationCollection: StationPreprocessor or iterable
+        a StationPreprocessor object, or any iterable of Station objects
+    varName: string
+        the variable ("TMAX","TMIN","PRCP", etc...). Stations without it are skipped
+    timeframe: string
+        see calculateStandardizedAnomalies
+    baselinePeriod: list
+        see calculateStandardizedAnomalies
+    maxMissing: dict
+        see calculateMean. Only used for daily variables
+
+    Returns
+    ----------
+    (anomalies, stationIds, dates). anomalies is a float64 array with one row per station
+    in stationIds and one column per date in dates (the first day of each period). Periods
+    that a station has no data for are NaN.
+    """
+    if not __isValidTimeframe(timeframe):
+        return
+    stations = stationCollection.stations if hasattr(stationCollection, "stations") else stationCollection
+    variables = []
+    stationIds = []
+    for station in stations:
+        if varName in station.variables:
+            climateVariable = station.variables[varName]
+            if __toMeans(climateVariable,timeframe,maxMissing):
+                variables.append(climateVariable)
+                stationIds.append(station.stationId)
             else:
-                if station.variables[varName].dataDescription == "daily":
-                    self.__calculateAnnualMean(station.variables[varName])
-                self.__calculateAnnualAnomalies(station.variables[varName],baselinePeriod)
-                
-def __calculateMonthlyAnomalies(climateVariable,baselinePeriod):
-    newdata = []
-    first = climateVariable.timelist.index(baselinePeriod[0])
-    last = climateVariable.timelist.index(baselinePeriod[1])
-    baselineData = climateVariable.data[first:last+1]
-    baselineTimelist = climateVariable.timelist[first:last+1]
-    baselineMeanAndStd = [] # has the form [ [mean,standard deviation], [mean,standard deviation], ... , [mean,standard deviation]]
-    for m in range(12):
-        baselineMeanAndStd.append(np.mean(baselineData[m::12]),np.std(baselineData[m::12]))
-    t = 0
-    while t < len(climateVariable.data):
-        anom = climateVariable.data[t] - baselineMeanAndStd[climateVariable.timelist[t].month-1][0] # the anomaly
-        stdAnom = anom / baselineMeanAndStd[climateVariable.timelist[t].month-1][1]
-        newdata.append(stdAnom)
-        t+=1
-    climateVariable.setData(newdata)
+                del station.variables[varName]
+    if len(variables) == 0:
+        return np.zeros((0, 0)), [], np.zeros(0, dtype="datetime64[D]")
+    keys = [_periodKeys(climateVariable.timelist, timeframe) for climateVariable in variables]
+    firstKey = min([k[0] for k in keys])
+    lastKey = max([k[-1] for k in keys])
+    stacked = np.full((len(variables), lastKey - firstKey + 1), np.nan)
+    for i in range(len(variables)):
+        stacked[i, keys[i] - firstKey] = variables[i].data
+    anomalies = _standardize(stacked, firstKey, timeframe, _periodKeys(baselinePeriod, timeframe))
+    for i in range(len(variables)):
+        variables[i].setData(anomalies[i, keys[i] - firstKey])
+        variables[i].dataDescription = anomalyDescriptions[timeframe]
+        variables[i].unit = None # standardized anomalies have no unit
+    return anomalies, stationIds, _periodStarts(np.arange(firstKey, lastKey + 1), timeframe)
+
+def __calculateStationAnomalies(station,timeframe,baselinePeriod,maxMissing):
+    """
+    returns False if every variable of the station was removed
+    """
+    baselineKeys = _periodKeys(baselinePeriod, timeframe)
+    for varName in list(station.variables):
+        climateVariable = station.variables[varName]
+        if not __toMeans(climateVariable,timeframe,maxMissing):
+            del station.variables[varName]
+            continue
+        keys = _periodKeys(climateVariable.timelist, timeframe)
+        series = np.full((1, keys[-1] - keys[0] + 1), np.nan)
+        series[0, keys - keys[0]] = climateVariable.data
+        climateVariable.setData(_standardize(series, keys[0], timeframe, baselineKeys)[0, keys - keys[0]])
+        climateVariable.dataDescription = anomalyDescriptions[timeframe]
+        climateVariable.unit = None # standardized anomalies have no unit
+    return len(station.variables) > 0
+
+def __toMeans(climateVariable,timeframe,maxMissing):
+    """
+    aggregates a daily variable to means of the timeframe (and converts temperatures to celsius).
+    returns False if the variable fails the filtering or doesn't hold data of the timeframe
+    """
+    if climateVariable.dataDescription == meanDescriptions[timeframe]:
+        return len(climateVariable.data) > 0
+    if climateVariable.dataDescription != "daily":
+        print("error: " + climateVariable.name + " holds " + climateVariable.dataDescription + " data. It must be daily or " + meanDescriptions[timeframe])
+        return False
+    means = _periodMeans(climateVariable.name, climateVariable.data, climateVariable.days, [timeframe], maxMissing)
+    if timeframe not in means:
+        return False
+    climateVariable.setAll(*means[timeframe])
+    climateVariable.dataDescription = meanDescriptions[timeframe]
+    if climateVariable.unit == "tenths_C": # the same as conversion.TenthsCelsiusToCelsius
+        conversion.convertVariable(climateVariable, "C")
+    return True
+
+def _periodKeys(dates,timeframe):
+    """
+    returns the number of the month, season or year that holds each date. Months
+    count from January 1970, seasons from the winter of 1970 (DJF), years from 1970
+    """
+    months = np.asarray(dates, dtype="datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    if timeframe == "month":
+        return months
+    elif timeframe == "season":
+        return (months + 1) // 3 # December counts towards the next year's winter
+    return months // 12
+
+def _periodStarts(keys,timeframe):
+    """
+    returns the first day of each period numbered by _periodKeys
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if timeframe == "month":
+        months = keys
+    elif timeframe == "season":
+        months = keys * 3 - 1
+    else:
+        months = keys * 12
+    return months.astype("datetime64[M]").astype("datetime64[D]")
+
+def _standardize(series,firstKey,timeframe,baselineKeys):
+    """
+    returns the standardized anomalies of a 2-D (series x periods) array whose first
+    column is the period firstKey (see _periodKeys). The columns are padded to whole
+    years and reshaped to (series x years x periods in a year), so the climatology of
+    every calendar month (or season) of every series is a reduction over one axis.
+
+    baselineKeys are the first and last period of the baseline (inclusive).
+    """
+    periodsPerYear = {"month": 12, "season": 4, "year": 1}[timeframe]
+    lead = firstKey % periodsPerYear # position of the first column in its year
+    numSeries, numPeriods = series.shape
+    years = -(-(lead + numPeriods) // periodsPerYear)
+    padded = np.full((numSeries, years * periodsPerYear), np.nan)
+    padded[:, lead:lead+numPeriods] = series
+    padded = padded.reshape(numSeries, years, periodsPerYear)
+    keys = (firstKey - lead + np.arange(years * periodsPerYear)).reshape(years, periodsPerYear)
+    inBaseline = (keys >= baselineKeys[0]) & (keys <= baselineKeys[1])
+
+    baseline = np.where(inBaseline, padded, np.nan)
+    isValid = ~np.isnan(baseline)
+    counts = isValid.sum(axis=1) # (series x periods in a year)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(isValid, baseline, 0.).sum(axis=1) / counts
+        deviation = np.where(isValid, baseline - mean[:, None, :], 0.)
+        std = np.sqrt((deviation**2).sum(axis=1) / counts) # population standard deviation, like np.std
+        anomalies = (padded - mean[:, None, :]) / std[:, None, :]
+    anomalies[~np.isfinite(anomalies)] = np.nan # no baseline data, or no variation in the baseline
+    return anomalies.reshape(numSeries, -1)[:, lead:lead+numPeriods]
@@ -0,0 +1,238 @@
+import os
+import json
+import numpy as np
+from GHCND import cube
+from GHCND import filters
+from GHCND import conversion
+
+"""
+An on-disk store of the daily and aggregated data of a collection of stations,
+for data sets that don't fit in memory.
+
+Each variable and timeframe is one raw float32 file with a fixed layout: one
+row per station and one column per day (or month, season, year) from the start
+to the end date of the store. The files are opened with np.memmap, so slicing
+a station, a date range, or a block of stations only reads those bytes from
+disk, and slices of whole rows or of all the stations are views (no copy).
+A JSON sidecar (metadata.json) holds the Station attributes, the time axis of
+each array, the span of each station's record, the unit of each array (see the
+conversion module) and the filter rules the daily
+values passed (see the filters module). The sidecar is written last,
+so a store that was only partly written is never opened.
+
+Usually the store is used through the StationPreprocessor:
+    sp.buildStore("D:/GHCND_data/store", ["TMAX","TMIN","PRCP"]) # parses the text once
+    store = sp.openStore("D:/GHCND_data/store") # in a later session
+    tmax = store.cube("TMAX", "day", start="1980-01-01", end="2009-12-31")
+"""
+
+METADATA_FILE = "metadata.json"
+STATION_FIELDS = ["name","stationId","country","state","lat","lon","elev","hcn","crn","gsn","wmoId"]
+
+
+class CubeStore(object):
+
+    def __init__(self,initDirectory):
+        """
+        opens an existing store. The data files are only opened when they are first sliced.
+
+        Parameters:
+        -----------
+        initDirectory: string
+            path to the directory of the store
+        """
+        self.directory = initDirectory
+        infile = open(os.path.join(self.directory, METADATA_FILE), "r")
+        self.metadata = json.load(infile)
+        infile.close()
+        self.stationIds = self.metadata["stations"]["stationId"]
+        self.index = dict(zip(self.stationIds, range(len(self.stationIds)))) # station id -> row
+        self.arrays = {} # (variable, timeframe) -> np.memmap, opened on first use
+        self.filter = self.metadata.get("filter") # {"fingerprint": ..., "rules": ...} of the filter rules. None for older stores
+
+    def __len__(self):
+        return len(self.stationIds)
+
+    def variables(self):
+        """
+        returns a list of (variable, timeframe) tuples held in the store
+        """
+        return [tuple(key.split("/")) for key in self.metadata["arrays"]]
+
+    def stationArgs(self):
+        """
+        returns a list with the arguments to construct a preprocessor.Station for each
+        row of the store (see catalog.StationCatalog.stationArgs)
+        """
+        stations = self.metadata["stations"]
+        return list(zip(*[stations[field] for field in STATION_FIELDS]))
+
+    def array(self,variable,timeframe="day"):
+        """
+        returns the whole (stations x time) array of a variable as a read only np.memmap
+        """
+        key = variable + "/" + timeframe
+        if key not in self.metadata["arrays"]:
+            print("error: " + key + " is not in the store")
+            return None
+        if key not in self.arrays:
+            info = self.metadata["arrays"][key]
+            self.arrays[key] = np.memmap(os.path.join(self.directory, info["file"]), dtype=info["dtype"],
+                                         mode="r", shape=(len(self.stationIds), info["length"]))
+        return self.arrays[key]
+
+    def times(self,variable,timeframe="day"):
+        """
+        returns the dates (datetime64[D], the first day of each period) of the columns of an array
+        """
+        info = self.metadata["arrays"][variable + "/" + timeframe]
+        firstKey = cube._timeKeys([info["start"]], timeframe)[0]
+        return cube._timeStarts(np.arange(firstKey, firstKey + info["length"]), timeframe)
+
+    def row(self,stationId,variable,timeframe="day"):
+        """
+        returns the values of one station (a view into the file) and their dates
+        """
+        array = self.array(variable, timeframe)
+        if array is None:
+            return None
+        return array[self.index[stationId]], self.times(variable, timeframe)
+
+    def cube(self,variable,timeframe="day",stationIds=None,start=None,end=None):
+        """
+        returns a cube.DataCube of a slice of the store. The data of the cube is a view
+        into the file if stationIds is None (all the stations), so nothing is read until it's
+        used. Selecting stations reads only their rows.
+
+        Parameters:
+        -----------
+        variable: string
+            the variable name ("TMAX","TMIN","PRCP", etc...)
+        timeframe: string
+            "day", "month", "season" or "year"
+        stationIds: list
+            the stations to read. default is None (all the stations)
+        start: date
+            the first date to read (a datetime.date, numpy.datetime64 or string like "1980-01-01").
+            default is None (the start of the store)
+        end: date
+            the last date to read (inclusive). default is None (the end of the store)
+        """
+        array = self.array(variable, timeframe)
+        if array is None:
+            return None
+        info = self.metadata["arrays"][variable + "/" + timeframe]
+        firstKey = cube._timeKeys([info["start"]], timeframe)[0]
+        first = 0 if start is None else max(0, int(cube._timeKeys([start], timeframe)[0] - firstKey))
+        last = info["length"] - 1 if end is None else min(info["length"] - 1, int(cube._timeKeys([end], timeframe)[0] - firstKey))
+        if stationIds is None:
+            rows = np.arange(len(self.stationIds))
+            data = array[:, first:last+1]
+            ids = self.stationIds
+        else:
+            rows = np.array([self.index[s] for s in stationIds if s in self.index], dtype=np.int64)
+            data = array[rows, first:last+1]
+            ids = [self.stationIds[r] for r in rows]
+        spans = np.array(info["spans"], dtype=np.int64).reshape(-1, 2)[rows]
+        empty = (spans[:, 1] < first) | (spans[:, 0] > last) | (spans[:, 1] < spans[:, 0])
+        spans = np.clip(spans - first, 0, max(last - first, 0))
+        spans[empty] = [0, -1] # no data in the slice
+        return cube.DataCube(variable, timeframe, data, ids, self.times(variable, timeframe)[first:last+1], spans, info.get("unit"))
+
+    def close(self):
+        """
+        closes the open data files
+        """
+        self.arrays = {}
+
+
+class StoreWriter(object):
+
+    def __init__(self,initDirectory,initStationArgs,initVariables,initTimeframes,initStart,initEnd,initFilterSpec=None):
+        """
+        creates the data files of a new store. Write the stations with writeStation, then
+        call close to write the metadata.
+
+        Parameters:
+        -----------
+        initDirectory: string
+            path to the directory of the store. It is created if it doesn't exist
+        initStationArgs: list
+            the Station constructor arguments of each row (see STATION_FIELDS)
+        initVariables: list
+            variable names
+        initTimeframes: list
+            any of "day", "month", "season" and "year"
+        initStart: date
+            the first day of the time axis
+        initEnd: date
+            the last day of the time axis
+        initFilterSpec: filters.FilterSpec
+            the filter rules of the data, recorded in the metadata. default is None
+            (filters.DEFAULT_FILTER)
+        """
+        self.directory = initDirectory
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if os.path.isfile(os.path.join(self.directory, METADATA_FILE)): # the old store is invalid once its files are rewritten
+            os.remove(os.path.join(self.directory, METADATA_FILE))
+        self.stationArgs = list(initStationArgs)
+        self.filterSpec = initFilterSpec
+        self.index = dict([(args[1], i) for i, args in enumerate(self.stationArgs)])
+        self.arrays = {}
+        self.info = {}
+        for variable in initVariables:
+            for timeframe in initTimeframes:
+                keys = cube._timeKeys([initStart, initEnd], timeframe)
+                key = variable + "/" + timeframe
+                info = {"file": variable + "_" + timeframe + ".f32", "dtype": "float32",
+                        "start": str(cube._timeStarts(keys[:1], timeframe)[0]), "firstKey": int(keys[0]),
+                        "length": int(keys[1] - keys[0] + 1), "spans": [[0, -1]] * len(self.stationArgs)}
+                array = np.memmap(os.path.join(self.directory, info["file"]), dtype=np.float32,
+                                  mode="w+", shape=(len(self.stationArgs), info["length"]))
+                array[:] = np.nan # rows of stations that are never written stay NaN
+                self.arrays[key] = array
+                self.info[key] = info
+
+    def writeStation(self,station,timeframe="day"):
+        """
+        writes the ClimateVars of a station that hold data of the timeframe ("daily" data
+        for "day", means for the others). Values outside the time axis of the store are dropped.
+        An array is in the unit of the first ClimateVar written to it. The values of ClimateVars
+        in other units of the same quantity are converted as they are written.
+        """
+        row = self.index[station.stationId]
+        for varName in station.variables:
+            key = varName + "/" + timeframe
+            climateVariable = station.variables[varName]
+            if key not in self.arrays or climateVariable.dataDescription not in cube.cubeDescriptions[timeframe]:
+                continue
+            info = self.info[key]
+            columns = cube._timeKeys(climateVariable.days, timeframe) - info["firstKey"]
+            inside = (columns >= 0) & (columns < info["length"])
+            if inside.sum() == 0:
+                continue
+            columns = columns[inside]
+            if "unit" not in info:
+                info["unit"] = climateVariable.unit
+            self.arrays[key][row, columns] = climateVariable.data[inside]
+            if climateVariable.unit != info["unit"]:
+                conversion.convertArray(self.arrays[key][row, columns.min():columns.max()+1], climateVariable.unit, info["unit"]) # in place, a view of the row
+            info["spans"][row] = [int(columns.min()), int(columns.max())]
+
+    def close(self):
+        """
+        flushes the data files and writes the metadata sidecar. Returns the opened CubeStore
+        """
+        for key in self.arrays:
+            self.arrays[key].flush()
+        self.arrays = {}
+        stations = dict([(field, [args[i] for args in self.stationArgs]) for i, field in enumerate(STATION_FIELDS)])
+        for key in self.info:
+            self.info[key]["spans"] = [v for span in self.info[key]["spans"] for v in span] # flat, to keep the file small
+        tmpPath = os.path.join(self.directory, METADATA_FILE + ".tmp")
+        outfile = open(tmpPath, "w")
+        json.dump({"stations": stations, "filter": filters.describe(self.filterSpec), "arrays": self.info}, outfile)
+        outfile.close()
+        os.rename(tmpPath, os.path.join(self.directory, METADATA_FILE))
+        return CubeStore(self.directory)
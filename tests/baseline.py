@@ -0,0 +1,85 @@
+import calendar
+import datetime
+import numpy as np
+
+"""
+The per-value loops the package started with, kept as the reference the
+vectorized code is checked and timed against. Only the loops themselves are
+here: they were methods working on Station and ClimateVar objects, and are
+functions working on plain lists now. The logic is unchanged.
+"""
+
+
+def parseDlyLines(lines,variablesOfInterest):
+    """
+    decodes the lines of a .dly file one character at a time, the way
+    StationPreprocessor.processDlyFiles first did.
+    Returns a dict of variable name -> (data, timelist) lists.
+    """
+    variables = {}
+    for line in lines:
+        dataIdx = 21 # add 8 to get to the next data value
+        qFlagIdx = 27 # add 8 to get the qFlag for the next data value
+        sFlagIdx = 28 # add 8 to get the sFlag for the next data value. (source flag).
+        curYear = int(line[11:15].strip())
+        curMonth = int(line[15:17].strip())
+        curDay = 1
+        varName = line[17:21].strip() # TAVG, TMAX, TMIN, PRCP, etc...
+        if varName in variablesOfInterest:
+            if varName not in variables:
+                variables[varName] = ([], [])
+            data, timelist = variables[varName]
+            while dataIdx <= 261: # the last dataIdx is 261
+                if curDay <= calendar.monthrange(curYear,curMonth)[1]: # only process data in the time range of the month.
+                    value = float(line[dataIdx:dataIdx+5].strip())
+                    qFlag = line[qFlagIdx]
+                    sFlag = line[sFlagIdx]
+                    if qFlag == " " and value != -9999 and sFlag in ["0","6","7","A","C","G","R"]:
+                        data.append(value)
+                    else:
+                        data.append(np.nan)
+                    timelist.append(datetime.date(year=curYear,month=curMonth,day=curDay))
+                dataIdx+=8
+                qFlagIdx+=8
+                sFlagIdx+=8
+                curDay+=1
+    return variables
+
+
+def monthlyMean(name,data,timelist):
+    """
+    the monthly means of a daily series, the way stats.calculateMean first
+    calculated them. The series must hold whole months of days, as the .dly
+    files do. Returns (means, timelist), or None if the variable is invalid.
+    """
+    timestep = 0
+    monthlyMeans = []
+    newTimelist = []
+    while timestep < len(timelist):
+        curDatetime = timelist[timestep]
+        curMonth = timelist[timestep].month
+        curYear = timelist[timestep].year
+        daysInMonth = calendar.monthrange(curYear,curMonth)[1] # number of days in the current month
+        dataChunk = data[timestep:timestep+daysInMonth]
+        if np.isnan(dataChunk).sum() > 5: # set the monthly mean to missing if more than 5 days of data are missing in the month
+            monthlyMeans.append(np.nan)
+        else:
+            if name == "PRCP": # for prcp, it's cumulative
+                monthlyMeans.append(np.nansum(dataChunk))
+            elif name in ["TMAX","TMIN","TAVG"]: # for tmin, tmax, and tavg it's the mean
+                monthlyMeans.append(np.nanmean(dataChunk))
+        newTimelist.append(datetime.datetime(year=curYear,month=curMonth,day=1))
+        timestep+=daysInMonth
+        if timestep < len(timelist): # need to check if there are missing months
+            nextDatetime = timelist[timestep]
+            if (nextDatetime - curDatetime) != datetime.timedelta(days=daysInMonth): # there are months of missing data
+                missingDatetime = curDatetime + datetime.timedelta(days=calendar.monthrange(curDatetime.year, curDatetime.month)[1])
+                while nextDatetime != missingDatetime:
+                    monthlyMeans.append(np.nan)
+                    newTimelist.append(missingDatetime)
+                    missingDatetime = missingDatetime + datetime.timedelta(days=calendar.monthrange(missingDatetime.year, missingDatetime.month)[1])
+    if (np.isnan(monthlyMeans).sum() / float(len(monthlyMeans))) > 0.75: # if more than 75% of the monthly values are missing. data is invalid
+        return None
+    if newTimelist[-1].year < 2016: # if the station was not operating past the year 2015, consider the data invalid
+        return None
+    return np.array(monthlyMeans), np.array(newTimelist)
@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import random
+import shutil
+import calendar
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from GHCND import dlyreader
+import baseline
+
+"""
+Times the decoding of synthetic .dly files by dlyreader against the
+per-character loop the package started with (see baseline.parseDlyLines),
+and checks that both give the same output. Run it from the repository:
+    python tests/bench_dlyreader.py [number of stations]
+"""
+
+VARIABLES = ["TMAX","TMIN","PRCP"]
+
+
+def writeStations(directory,numberOfStations,seed=1):
+    """
+    writes numberOfStations synthetic .dly files with 25 to 115 years of TMAX, TMIN, PRCP
+    and SNOW, a few missing months, -9999 days and mixed QFLAG, SFLAG and MFLAG values.
+    Returns the file names
+    """
+    rng = random.Random(seed)
+    filenames = []
+    for i in range(numberOfStations):
+        stationId = "USC%08d" % i
+        lines = []
+        for year in range(rng.randint(1900, 1990), rng.randint(2014, 2018) + 1):
+            for month in range(1, 13):
+                if rng.random() < 0.03:
+                    continue
+                for element in ["TMAX","TMIN","PRCP","SNOW"]:
+                    line = "%s%04d%02d%s" % (stationId, year, month, element)
+                    for day in range(31):
+                        if day >= calendar.monthrange(year, month)[1] or rng.random() < 0.05:
+                            line += "-9999   "
+                        else:
+                            value = rng.randint(0, 500) if element == "PRCP" else rng.randint(-300, 350)
+                            line += "%5d%s%s%s" % (value, rng.choice("  TB"), " " if rng.random() > 0.02 else "I", rng.choice("0067ACGRRRRXH"))
+                    lines.append(line)
+        filenames.append(os.path.join(directory, stationId + ".dly"))
+        outfile = open(filenames[-1], "w")
+        outfile.write("\n".join(lines) + "\n")
+        outfile.close()
+    return filenames
+
+def main(numberOfStations=40):
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = writeStations(directory, numberOfStations)
+        start = time.time()
+        expected = []
+        for filename in filenames:
+            infile = open(filename)
+            expected.append(baseline.parseDlyLines(infile.read().splitlines(), VARIABLES))
+            infile.close()
+        loopTime = time.time() - start
+        start = time.time()
+        parsed = [dlyreader.compact(dlyreader.parseLines(dlyreader.readDlyFile(filename), VARIABLES)) for filename in filenames]
+        vectorTime = time.time() - start
+        for old, new in zip(expected, parsed):
+            assert list(old) == list(new)
+            for varName in old:
+                assert np.array_equal(new[varName][0], np.array(old[varName][0]), equal_nan=True)
+                assert np.array_equal(new[varName][1], np.array(old[varName][1], dtype="datetime64[D]").astype(np.int32))
+        lines = sum(os.path.getsize(filename) for filename in filenames) // (dlyreader.LINE_LENGTH + 1)
+        print("%d stations, %d lines: identical output" % (numberOfStations, lines))
+        print("per-character loop %.2f s, dlyreader %.2f s, %.1fx faster" % (loopTime, vectorTime, loopTime / vectorTime))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
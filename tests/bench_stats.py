@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from GHCND import stats
+import baseline
+
+"""
+Times the monthly means of stats._periodMeans against the per-month loop the
+package started with (see baseline.monthlyMean), and checks that the PRCP sums
+and the TMAX and TMIN means are bit for bit the same. Run it from the repository:
+    python tests/bench_stats.py [number of stations]
+"""
+
+VARIABLES = ["TMAX","TMIN","PRCP"]
+YEARS = (1976, 2020)
+
+
+def makeStations(numberOfStations,seed=0):
+    """
+    returns a list of stations, each a list of (name, data, days) tuples of daily whole
+    number values from YEARS[0] to YEARS[1] with 3% missing days and 5 missing months
+    """
+    rng = np.random.default_rng(seed)
+    days = np.arange(np.datetime64("%d-01-01" % YEARS[0]), np.datetime64("%d-01-01" % (YEARS[1] + 1)))
+    months = days.astype("datetime64[M]")
+    stations = []
+    for i in range(numberOfStations):
+        variables = []
+        for name in VARIABLES:
+            data = rng.integers(-300, 400, len(days)).astype(np.float64)
+            data[rng.random(len(days)) < 0.03] = np.nan
+            keep = ~np.isin(months, rng.choice(np.unique(months), 5, replace=False))
+            variables.append((name, data[keep], days[keep]))
+        stations.append(variables)
+    return stations
+
+def main(numberOfStations=1000):
+    stations = makeStations(numberOfStations)
+    # the loop worked on lists of dates, so they are made before timing it
+    inputs = [[(name, list(data), days.astype(object).tolist()) for name, data, days in variables] for variables in stations]
+    start = time.time()
+    expected = [[baseline.monthlyMean(*args) for args in variables] for variables in inputs]
+    loopTime = time.time() - start
+    start = time.time()
+    means = [[stats._periodMeans(name, data.astype(np.float32), days.astype(np.int64), ["month"]) for name, data, days in variables] for variables in stations]
+    vectorTime = time.time() - start
+    for oldVariables, newVariables in zip(expected, means):
+        for old, new in zip(oldVariables, newVariables):
+            if old is None:
+                assert "month" not in new
+                continue
+            assert new["month"][0].tobytes() == old[0].astype(np.float64).tobytes()
+            assert np.array_equal(np.asarray(new["month"][1], dtype="datetime64[D]"), old[1].astype("datetime64[D]"))
+    print("%d stations x %d variables x %d years: bit-identical means" % (numberOfStations, len(VARIABLES), YEARS[1] - YEARS[0] + 1))
+    print("per-month loop %.2f s, stats._periodMeans %.2f s, %.0fx faster" % (loopTime, vectorTime, loopTime / vectorTime))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
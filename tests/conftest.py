@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the tests import the GHCND package from this checkout, and the baseline module next to them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,87 @@
+import random
+import numpy as np
+from GHCND import dlyreader
+import baseline
+
+"""
+Checks that dlyreader decodes .dly lines exactly like the per-character loop
+the package started with (see baseline.parseDlyLines): the same variables in
+the same order, the same dates and the same values, NaN for NaN.
+"""
+
+VARIABLES = ["TMAX","TMIN","PRCP"]
+
+
+def _line(year,month,element,days,stationId="USC00000001"):
+    """
+    a .dly line. days is a list of up to 31 (value, mflag, qflag, sflag) tuples.
+    The remaining days are -9999 with blank flags
+    """
+    days = list(days) + [(-9999, " ", " ", " ")] * (31 - len(days))
+    return "%s%04d%02d%s" % (stationId, year, month, element) + "".join("%5d%s%s%s" % day for day in days)
+
+def _compare(lines,variablesOfInterest=VARIABLES):
+    expected = baseline.parseDlyLines(lines, variablesOfInterest)
+    parsed = dlyreader.parseLines(dlyreader.toCharArray(("\n".join(lines) + "\n").encode("ascii")), variablesOfInterest)
+    assert list(parsed) == list(expected)
+    for varName in expected:
+        data, timelist = expected[varName]
+        assert np.array_equal(parsed[varName][0], np.array(data), equal_nan=True), varName
+        assert np.array_equal(parsed[varName][1], np.array(timelist, dtype="datetime64[D]")), varName
+
+def test_invalid_days():
+    # days past the end of the month are dropped even when they hold values
+    good = (150, " ", " ", "0")
+    _compare([_line(2001, 2, "TMAX", [good] * 31), # 28 days
+              _line(2004, 2, "TMAX", [good] * 31), # leap year
+              _line(2000, 2, "TMIN", [good] * 31),
+              _line(1900, 2, "TMIN", [good] * 31), # not a leap year
+              _line(2001, 4, "PRCP", [good] * 31)])
+
+def test_nodata():
+    _compare([_line(2010, 1, "TMAX", [(-9999, " ", " ", "0"), (-9998, " ", " ", "0"), (0, " ", " ", "0"), (-12, " ", " ", "7")]),
+              _line(2010, 1, "PRCP", [(-9999, " ", " ", " ")] * 31)])
+
+def test_flags():
+    # every QFLAG and SFLAG the loop treats differently, with MFLAGs that must be ignored
+    days = []
+    for qFlag in [" ", "I", "D", "S"]:
+        for sFlag in [" ", "0", "6", "7", "A", "C", "G", "R", "H", "X"]:
+            days.append((len(days) * 7 - 100, " BT"[len(days) % 3], qFlag, sFlag))
+    lines = [_line(2015, month, "TMAX", days[(month - 1) * 31:month * 31]) for month in range(1, 3)]
+    _compare(lines)
+
+def test_order():
+    # months out of order and elements interleaved with ones that aren't wanted
+    good = [(i * 3, " ", " ", "R") for i in range(31)]
+    _compare([_line(2003, 5, "PRCP", good),
+              _line(2003, 5, "SNOW", good),
+              _line(2003, 2, "TMAX", good),
+              _line(2003, 5, "TMAX", good),
+              _line(2002, 12, "TMIN", good),
+              _line(2003, 1, "PRCP", good),
+              _line(1999, 7, "TMAX", good)])
+
+def test_unwanted():
+    good = [(1, " ", " ", "0")] * 31
+    _compare([_line(2003, 5, "SNOW", good), _line(2003, 5, "SNWD", good)])
+    _compare([_line(2003, 5, "TMAX", good)], ["TAVG"])
+
+def test_random_lines():
+    rng = random.Random(5)
+    lines = []
+    for i in range(2000):
+        days = [(rng.choice([-9999, rng.randint(-999, 9999)]), rng.choice(" BTP"), rng.choice("  IDGS"), rng.choice(" 067ACGRRHXZ")) for d in range(31)]
+        lines.append(_line(rng.randint(1850, 2025), rng.randint(1, 12), rng.choice(["TMAX","TMIN","PRCP","SNOW","TAVG"]), days))
+    _compare(lines, ["TMAX","TMIN","PRCP","TAVG"])
+
+def test_read_file(tmp_path):
+    good = [(i, " ", " ", "C") for i in range(31)]
+    lines = [_line(2016, 2, "TMAX", good), _line(2016, 3, "TMIN", good)]
+    filename = tmp_path / "USC00000001.dly"
+    filename.write_bytes(("\n".join(lines) + "\n").encode("ascii"))
+    parsed = dlyreader.parseLines(dlyreader.readDlyFile(str(filename)), VARIABLES)
+    expected = baseline.parseDlyLines(open(str(filename)).read().splitlines(), VARIABLES)
+    assert list(parsed) == list(expected)
+    for varName in expected:
+        assert np.array_equal(parsed[varName][0], np.array(expected[varName][0]), equal_nan=True)
@@ -0,0 +1,56 @@
+import numpy as np
+from GHCND import stats
+import baseline
+
+"""
+Checks that the monthly means of stats._periodMeans are bit for bit the ones
+of the per-month loop the package started with (see baseline.monthlyMean):
+PRCP sums and TMAX, TMIN and TAVG means, with the same months set to NaN and
+the same variables rejected.
+"""
+
+
+def _series(rng,firstYear,lastYear,missing=0.03,missingMonths=5):
+    """
+    daily whole number values (tenths of a unit, like the .dly files) from January of firstYear
+    to December of lastYear, with missing days and whole missing months
+    """
+    days = np.arange(np.datetime64("%d-01-01" % firstYear), np.datetime64("%d-01-01" % (lastYear + 1)))
+    data = rng.integers(-300, 400, len(days)).astype(np.float64)
+    data[rng.random(len(days)) < missing] = np.nan
+    months = days.astype("datetime64[M]")
+    keep = ~np.isin(months, rng.choice(np.unique(months)[1:-1], missingMonths, replace=False))
+    return data[keep], days[keep]
+
+def _compare(name,data,days):
+    expected = baseline.monthlyMean(name, list(data), days.astype(object).tolist())
+    means = stats._periodMeans(name, data.astype(np.float32), days.astype(np.int64), ["month"])
+    if expected is None:
+        assert "month" not in means
+        return
+    values, dates = means["month"]
+    assert values.tobytes() == expected[0].astype(np.float64).tobytes(), name
+    assert np.array_equal(np.asarray(dates, dtype="datetime64[D]"), expected[1].astype("datetime64[D]")), name
+
+def test_means():
+    rng = np.random.default_rng(0)
+    for name in ["TMAX","TMIN","TAVG","PRCP"]:
+        for i in range(5):
+            _compare(name, *_series(rng, 1990 + i, 2017))
+
+def test_missing_days():
+    # months with 5 and with 6 missing days sit on either side of the threshold
+    rng = np.random.default_rng(1)
+    data, days = _series(rng, 2010, 2016, missing=0.)
+    months = days.astype("datetime64[M]")
+    for i, month in enumerate(np.unique(months)):
+        data[np.nonzero(months == month)[0][:i % 8]] = np.nan
+    for name in ["TMAX","PRCP"]:
+        _compare(name, data, days)
+
+def test_rejected():
+    rng = np.random.default_rng(2)
+    _compare("TMAX", *_series(rng, 1980, 2015)) # the station stopped before 2016
+    data, days = _series(rng, 2000, 2020)
+    data[:int(len(data) * 0.9)] = np.nan # more than 75% of the months are missing
+    _compare("PRCP", data, days)